@@ -1,7 +1,17 @@
+import json
+
 import streamlit as st
 from streamlit_chat import message
 
-from ultima.shared_arrtibs import APP_NAME, PAGE_ICON, UPLOAD_HELP, USAGE_HELP
+from ultima.shared_arrtibs import (
+    APP_NAME,
+    LATENCY_HELP,
+    PAGE_ICON,
+    UPLOAD_HELP,
+    USAGE_HELP,
+)
+from ultima.dataset_pool import dataset_pool
+from ultima.metrics import metrics
 from ultima.utils import (
     authentication_and_options_side_bar,
     generate_response,
@@ -64,13 +74,7 @@ if clear_button:
     # clear all chat related caches
     st.session_state["past"] = []
     st.session_state["generated"] = []
-    st.session_state["chat_history"] = []
-
-if submit_button and user_input:
-    text_container.empty()
-    output = generate_response(user_input)
-    st.session_state["past"].append(user_input)
-    st.session_state["generated"].append(output)
+    st.session_state["chat_history"].clear()
 
 if st.session_state["generated"]:
     with response_container:
@@ -78,6 +82,19 @@ if st.session_state["generated"]:
             message(st.session_state["past"][i], is_user=True, key=str(i) + "_user")
             message(st.session_state["generated"][i], key=str(i))
 
+if submit_button and user_input:
+    text_container.empty()
+    i = len(st.session_state["generated"])
+    with response_container:
+        message(user_input, is_user=True, key=str(i) + "_user")
+        # the answer is rendered here token by token while it is generated
+        answer_placeholder = st.empty()
+        output = generate_response(user_input, answer_placeholder.markdown)
+        with answer_placeholder.container():
+            message(output, key=str(i))
+    st.session_state["past"].append(user_input)
+    st.session_state["generated"].append(output)
+
 
 # Usage sidebar with total used tokens and costs
 # We put this at the end to be able to show usage after the first response
@@ -88,3 +105,53 @@ with st.sidebar:
         col1, col2 = st.columns(2)
         col1.metric("Total Tokens", st.session_state["usage"]["total_tokens"])
         col2.metric("Total Costs in $", st.session_state["usage"]["total_cost"])
+        if "saved_tokens" in st.session_state["usage"]:
+            # answers served from the answer cache
+            col1.metric("Saved Tokens", st.session_state["usage"]["saved_tokens"])
+            col2.metric("Saved Costs in $", st.session_state["usage"]["saved_cost"])
+        if "context_tokens_saved" in st.session_state["usage"]:
+            # overlapping, duplicate and over budget context
+            col2.metric(
+                "Context Tokens Saved",
+                st.session_state["usage"]["context_tokens_saved"],
+            )
+        if "history_tokens_saved" in st.session_state["usage"]:
+            # prompt tokens not sent thanks to the chat history summary
+            col1.metric(
+                "History Tokens Saved",
+                st.session_state["usage"]["history_tokens_saved"],
+            )
+        if st.session_state["stream_stats"]:
+            # latency of the last streamed response
+            last = st.session_state["stream_stats"][-1]
+            col1.metric("Time to First Token in s", f"{last.time_to_first_token:.2f}")
+            col2.metric("Tokens per s", f"{last.tokens_per_second:.1f}")
+    if st.session_state["last_trace"] is not None:
+        # seconds per pipeline stage of the last response
+        st.divider()
+        st.title("Latency", help=LATENCY_HELP)
+        st.table(
+            [
+                {"Stage": stage, "Seconds": f"{seconds:.3f}"}
+                for stage, seconds in st.session_state["last_trace"].breakdown().items()
+            ]
+        )
+        col1, col2 = st.columns(2)
+        col1.download_button(
+            "Metrics JSON",
+            json.dumps(metrics.to_json(), indent=2),
+            file_name="metrics.json",
+            mime="application/json",
+        )
+        col2.download_button(
+            "Prometheus",
+            metrics.to_prometheus(),
+            file_name="ultima.prom",
+            mime="text/plain",
+        )
+        # stores shared between sessions and the disk they take
+        pool = dataset_pool.stats()
+        st.caption(
+            f"Datasets: {pool['hit_rate']:.0%} opened from the pool, "
+            f"{pool['bytes_stored'] / 1024**2:.1f} MB stored"
+        )
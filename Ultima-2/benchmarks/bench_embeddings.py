@@ -0,0 +1,116 @@
+# Embedding throughput of the batched executor against one call to the model,
+# and recall and index memory of compact vector storage against float32, on
+# the chunks of the sample PDFs.
+#
+#   python -m benchmarks.bench_embeddings
+#   python -m benchmarks.bench_embeddings --model stub --k 8 --workers 1,2,4
+import argparse
+import json
+import tempfile
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from benchmarks.common import latency_stats, time_it
+from ultima.embedding_executor import BatchedEmbeddings
+from ultima.load_data import get_text_splitter, load_document
+from ultima.local_vector_store import STORAGE_TYPES, NumpyVectorStore
+from ultima.models import MODELS, get_embeddings
+from ultima.retrieval_chain import get_default_options
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+SAMPLE_PDFS = sorted(str(p) for p in ROOT_PATH.parent.glob("*.pdf"))
+
+
+def load_chunks(files: List[str], options: dict) -> List[str]:
+    docs = [doc for file in files for doc in load_document(file)]
+    chunks = get_text_splitter(options).split_documents(docs)
+    return [chunk.page_content for chunk in chunks]
+
+
+def bench_throughput(
+    embeddings: BatchedEmbeddings, texts: List[str], workers: int
+) -> dict:
+    model = embeddings.embeddings
+    single = time_it(lambda: model.embed_documents(texts))
+    batched = BatchedEmbeddings(model, workers=workers)
+    seconds = time_it(lambda: batched.embed_documents(texts))
+    return {
+        "workers": workers,
+        "batches": len(batched.get_batches(texts)),
+        "single_call_chunks_per_s": len(texts) / single,
+        "batched_chunks_per_s": len(texts) / seconds,
+    }
+
+
+def bench_storage(
+    path: Path,
+    embeddings: BatchedEmbeddings,
+    texts: List[str],
+    vectors: np.ndarray,
+    queries: List[str],
+    k: int,
+) -> List[dict]:
+    search_kwargs = {"distance_metric": "cos", "k": k, "fetch_k": k}
+    results, exact = [], None
+    for storage in STORAGE_TYPES:
+        store = NumpyVectorStore(embeddings, path=path / storage, storage=storage)
+        store.add_embeddings(texts, vectors, ids=[str(i) for i in range(len(texts))])
+        store.persist()
+        store = NumpyVectorStore.load(path / storage, embeddings, storage=storage)
+        found = [
+            {doc.page_content for doc in store.similarity_search(q, **search_kwargs)}
+            for q in queries
+        ]
+        exact = exact or found
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact) if e])
+        samples = [
+            time_it(lambda: store.similarity_search(q, **search_kwargs))
+            for q in queries
+        ]
+        results.append(
+            {
+                "storage": storage,
+                "index_bytes": store.index_bytes(),
+                f"recall_at_{k}": float(recall),
+                **latency_stats(samples),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=MODELS.GPT4ALL.name)
+    parser.add_argument("--files", default=",".join(SAMPLE_PDFS))
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--k", type=int, default=8)
+    # the sample PDFs are short, small chunks give enough of them to measure
+    parser.add_argument("--chunk-size", type=int, default=128)
+    parser.add_argument("--chunk-overlap", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    options = get_default_options(MODELS.by_name(args.model))
+    options["chunk_size"] = args.chunk_size
+    options["chunk_overlap"] = args.chunk_overlap
+    embeddings = get_embeddings(options, {})
+    texts = load_chunks(args.files.split(","), options)
+    result = {"model": args.model, "chunks": len(texts), "throughput": []}
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result["throughput"].append(bench_throughput(embeddings, texts, workers))
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    # the first words of chunks spread over the documents as questions
+    step = max(1, len(texts) // args.queries)
+    queries = [" ".join(text.split()[:12]) for text in texts[::step][: args.queries]]
+    with tempfile.TemporaryDirectory() as tmp:
+        result["storage"] = bench_storage(
+            Path(tmp), embeddings, texts, vectors, queries, args.k
+        )
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
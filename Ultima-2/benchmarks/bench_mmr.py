@@ -0,0 +1,53 @@
+# Compare ultima.mmr with the iterative implementation shipped with langchain.
+#
+#   python -m benchmarks.bench_mmr --fetch-k 26,100,500 --k 26
+import argparse
+import json
+
+from langchain.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+
+from benchmarks.common import latency_stats, random_vectors, time_it
+from ultima.mmr import batch_maximal_marginal_relevance, maximal_marginal_relevance
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fetch-k", default="26,100,500")
+    parser.add_argument("--k", type=int, default=26)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=32)
+    parser.add_argument("--lambda-mult", type=float, default=0.5)
+    args = parser.parse_args()
+
+    queries = random_vectors(args.queries, args.dim, seed=1)
+    for fetch_k in [int(f) for f in args.fetch_k.split(",")]:
+        candidates = [
+            random_vectors(fetch_k, args.dim, seed=100 + q) for q in range(args.queries)
+        ]
+        kwargs = {"k": args.k, "lambda_mult": args.lambda_mult}
+        baseline = [
+            time_it(lambda: langchain_mmr(queries[q], candidates[q], **kwargs))
+            for q in range(args.queries)
+        ]
+        single = [
+            time_it(lambda: maximal_marginal_relevance(queries[q], candidates[q], **kwargs))
+            for q in range(args.queries)
+        ]
+        batch = time_it(
+            lambda: batch_maximal_marginal_relevance(queries, candidates, **kwargs)
+        )
+        print(
+            json.dumps(
+                {
+                    "fetch_k": fetch_k,
+                    "k": args.k,
+                    "langchain": latency_stats(baseline),
+                    "ultima": latency_stats(single),
+                    "ultima_batch_per_query_ms": 1000 * batch / args.queries,
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Split throughput of the token-offset splitter against the previous
+# RecursiveCharacterTextSplitter with a token counting length_function.
+#
+#   python -m benchmarks.bench_splitter
+#   python -m benchmarks.bench_splitter --hf-tokenizer hkunlp/instructor-xl
+import argparse
+import json
+from pathlib import Path
+
+from langchain.document_loaders import CSVLoader, PDFMinerLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from benchmarks.common import time_it
+from ultima.shared_arrtibs import CHUNK_OVERLAP, CHUNK_SIZE
+from ultima.text_splitter import TokenOffsetTextSplitter
+
+SAMPLES_PATH = Path(__file__).resolve().parents[2]
+
+
+def load_samples():
+    docs = []
+    for pdf in sorted(SAMPLES_PATH.glob("*.pdf")):
+        docs.extend(PDFMinerLoader(str(pdf)).load())
+    for csv in sorted((SAMPLES_PATH / "Ultima-2").glob("*.csv")):
+        docs.extend(CSVLoader(str(csv), encoding="utf-8").load())
+    return docs
+
+
+def get_tokenizer(hf_tokenizer: str):
+    if hf_tokenizer:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(hf_tokenizer)
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hf-tokenizer", default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    docs = load_samples()
+    tokenizer = get_tokenizer(args.hf_tokenizer)
+    megabytes = sum(len(d.page_content.encode("utf-8")) for d in docs) / 1024**2
+    splitters = {
+        "recursive_character": RecursiveCharacterTextSplitter(
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            length_function=lambda text: len(tokenizer.encode(text)),
+        ),
+        "token_offset": TokenOffsetTextSplitter(
+            tokenizer, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap
+        ),
+    }
+    for name, splitter in splitters.items():
+        chunks = splitter.split_documents(docs)
+        seconds = min(
+            time_it(lambda: splitter.split_documents(docs)) for _ in range(args.repeat)
+        )
+        print(
+            json.dumps(
+                {
+                    "splitter": name,
+                    "documents": len(docs),
+                    "chunks": len(chunks),
+                    "seconds": seconds,
+                    "mb_per_s": megabytes / seconds,
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
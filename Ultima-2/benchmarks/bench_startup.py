@@ -0,0 +1,81 @@
+# Cold import time of the app modules, measured with python -X importtime in a
+# fresh interpreter per run, and which heavy backends got imported on the way.
+#
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup --module ultima.vector_store --repeat 5
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "sentence_transformers",
+    "InstructorEmbedding",
+    "tiktoken",
+    "openai",
+    "deeplake",
+    "pygpt4all",
+]
+
+
+def import_times(module: str) -> dict:
+    # cumulative microseconds per imported module, plus the loaded backends
+    script = (
+        f"import sys, json; import {module}; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        cwd=ROOT_PATH,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            # header line
+            continue
+    return {"times": times, "backends": json.loads(result.stdout.splitlines()[-1])}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="ultima.utils")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    totals = [run["times"][args.module] / 1e6 for run in runs]
+    slowest = sorted(runs[-1]["times"].items(), key=lambda item: -item[1])
+    print(
+        json.dumps(
+            {
+                "module": args.module,
+                "seconds_median": statistics.median(totals),
+                "seconds_min": min(totals),
+                "backends_imported": runs[-1]["backends"],
+                "slowest_imports_s": {
+                    name: us / 1e6
+                    for name, us in slowest[: args.top]
+                    if name != args.module
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
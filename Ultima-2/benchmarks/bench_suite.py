@@ -0,0 +1,234 @@
+# Offline benchmark of the whole pipeline with the deterministic fakes: load,
+# split (every splitter), embed, index build, retrieval and end-to-end answers
+# over corpora of growing size. Results go to a JSON file per commit, compare
+# two of them to spot regressions.
+#
+#   python -m benchmarks.bench_suite
+#   python -m benchmarks.bench_suite --sizes 10,100 \
+#       --compare benchmarks/results/bench_suite-<commit>.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+SAMPLES_PATH = ROOT_PATH.parent
+RESULTS_PATH = ROOT_PATH / "benchmarks" / "results"
+
+# ultima resolves DATA_PATH from the working directory on import, datasets and
+# caches of the benchmark must not end up next to the real ones
+START_PATH = Path.cwd()
+SCRATCH_PATH = Path(tempfile.mkdtemp(prefix="ultima-bench-"))
+os.chdir(SCRATCH_PATH)
+
+from benchmarks.common import latency_stats, time_it  # noqa: E402
+from ultima.lexical_index import LexicalIndex  # noqa: E402
+from ultima.load_data import SPLITTERS, load_data_source, split_docs  # noqa: E402
+from ultima.local_vector_store import NumpyVectorStore  # noqa: E402
+from ultima.models import MODELS, get_embeddings  # noqa: E402
+from ultima.retrieval_chain import get_chain, get_default_options  # noqa: E402
+from ultima.service import QuestionAnsweringService  # noqa: E402
+
+QUESTIONS = [
+    "What is the Q1 price of Biktarvy?",
+    "total TRx for genvoya in Q4 2022",
+    "Which text splitter gives the most complete answers?",
+    "How many scripts did odefsey have in the last 4 weeks?",
+    "What is Ultima-2 used for?",
+]
+# words of one synthetic document
+DOCUMENT_WORDS = 2000
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_PATH, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_corpus(path: Path, size: int, seed: int = 0) -> Path:
+    # the sample files plus `size` text files of lines drawn from them
+    os.makedirs(path, exist_ok=True)
+    samples = sorted(SAMPLES_PATH.glob("*.pdf")) + sorted(ROOT_PATH.glob("*.csv"))
+    for sample in samples:
+        shutil.copy(sample, path / sample.name)
+    lines = [
+        line
+        for doc in load_data_source(str(path))
+        for line in doc.page_content.splitlines()
+        if len(line.split()) > 2
+    ]
+    rng = random.Random(seed)
+    for i in range(size):
+        words, text = 0, []
+        while words < DOCUMENT_WORDS:
+            line = rng.choice(lines)
+            text.append(line)
+            words += len(line.split())
+        (path / f"synthetic-{i:05d}.txt").write_text("\n".join(text), encoding="utf-8")
+    return path
+
+
+def bench_split(docs, options: dict) -> Dict[str, dict]:
+    results = {}
+    for splitter in SPLITTERS.all():
+        splitter_options = {**options, "text_splitter": splitter}
+        try:
+            start = time.perf_counter()
+            chunks = split_docs(docs, splitter_options)
+            results[splitter] = {
+                "seconds": time.perf_counter() - start,
+                "chunks": len(chunks),
+            }
+        except (ImportError, LookupError) as e:
+            # e.g. nltk or its punkt data not installed
+            results[splitter] = {"error": str(e)}
+    return results
+
+
+def bench_index(path: Path, texts: List[str], options: dict) -> dict:
+    embeddings = get_embeddings(options, {})
+    start = time.perf_counter()
+    vectors = embeddings.embed_documents(texts)
+    embed_seconds = time.perf_counter() - start
+    ids = [str(i) for i in range(len(texts))]
+
+    def build():
+        store = NumpyVectorStore(embeddings, path=str(path / "vectors"))
+        store.add_embeddings(texts, vectors, ids=ids)
+        store.persist()
+        index = LexicalIndex(str(path / "lexical"))
+        index.add(ids, texts)
+        index.persist()
+
+    return {
+        "embed_seconds": embed_seconds,
+        "chunks_per_s": len(texts) / max(embed_seconds, 1e-9),
+        "build_seconds": time_it(build),
+    }
+
+
+def bench_answers(corpus: str, options: dict, repeat: int) -> dict:
+    chain_seconds = time_it(lambda: get_chain(corpus, options, {}))
+    chain = get_chain(corpus, options, {})
+    retrieval = [
+        time_it(lambda: chain.retriever.get_relevant_documents(question))
+        for _ in range(repeat)
+        for question in QUESTIONS
+    ]
+    # the headless equivalent of utils.generate_response, without streamlit
+    service = QuestionAnsweringService(corpus, options, {})
+
+    async def answer_all() -> List[float]:
+        samples = []
+        for _ in range(repeat):
+            for question in QUESTIONS:
+                start = time.perf_counter()
+                await service.answer(question, [], corpus, options)
+                samples.append(time.perf_counter() - start)
+        return samples
+
+    return {
+        "chain_build_seconds": chain_seconds,
+        "retrieval": latency_stats(retrieval),
+        "end_to_end": latency_stats(asyncio.run(answer_all())),
+    }
+
+
+def bench_size(size: int, options: dict, repeat: int) -> dict:
+    corpus = make_corpus(SCRATCH_PATH / f"corpus-{size}", size)
+    start = time.perf_counter()
+    docs = load_data_source(str(corpus))
+    load_seconds = time.perf_counter() - start
+    texts = [chunk.page_content for chunk in split_docs(docs, options)]
+    return {
+        "documents": size,
+        "megabytes": sum(len(d.page_content.encode("utf-8")) for d in docs) / 1024**2,
+        "load_seconds": load_seconds,
+        "split": bench_split(docs, options),
+        "index": bench_index(SCRATCH_PATH / f"index-{size}", texts, options),
+        **bench_answers(str(corpus), options, repeat),
+    }
+
+
+def flatten(result, prefix: str = "") -> Dict[str, float]:
+    if isinstance(result, dict):
+        items = result.items()
+    elif isinstance(result, list):
+        items = ((str(r.get("documents", i)), r) for i, r in enumerate(result))
+    else:
+        return {prefix: result} if isinstance(result, (int, float)) else {}
+    flat = {}
+    for key, value in items:
+        flat.update(flatten(value, f"{prefix}.{key}" if prefix else key))
+    return flat
+
+
+def compare(old: dict, new: dict, threshold: float = 0.1) -> List[str]:
+    # timings that got more than `threshold` slower
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    lines = []
+    for key, value in new_flat.items():
+        before = old_flat.get(key)
+        timing = key.endswith(("seconds", "_ms"))
+        if timing and before and value > before * (1 + threshold):
+            change = value / before - 1
+            lines.append(f"{key}: {before:.4f} -> {value:.4f} (+{change:.0%})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,100,1000")
+    parser.add_argument("--model", default=MODELS.STUB.name)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    options = get_default_options(MODELS.by_name(args.model))
+    report = {
+        "commit": get_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": {key: str(value) for key, value in options.items()},
+        "results": [],
+    }
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            result = bench_size(size, options, args.repeat)
+            print(json.dumps(result))
+            report["results"].append(result)
+    finally:
+        shutil.rmtree(SCRATCH_PATH, ignore_errors=True)
+
+    output = START_PATH / (
+        args.output or RESULTS_PATH / f"bench_suite-{report['commit']}.json"
+    )
+    os.makedirs(output.parent, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(START_PATH / args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report)
+        print("\n".join(regressions) or "No regressions")
+    return report
+
+
+if __name__ == "__main__":
+    main()
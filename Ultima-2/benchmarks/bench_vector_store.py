@@ -0,0 +1,91 @@
+# Compare the in-process NumPy index with the DeepLake path used for hub datasets.
+#
+#   python -m benchmarks.bench_vector_store --sizes 10000,100000,1000000
+import argparse
+import json
+import tempfile
+from pathlib import Path
+
+from benchmarks.common import LookupEmbeddings, latency_stats, random_vectors, time_it
+from ultima.local_vector_store import NumpyVectorStore
+
+SEARCH_KWARGS = {"distance_metric": "cos", "k": 26, "fetch_k": 26}
+
+
+def bench_numpy(path: Path, embeddings: LookupEmbeddings, n: int, queries: int) -> dict:
+    texts = [f"chunk-{i}" for i in range(n)]
+    store = NumpyVectorStore(embeddings, path=path)
+    build = time_it(
+        lambda: store.add_embeddings(texts, embeddings.documents[:n], [{}] * n)
+    )
+    persist = time_it(store.persist)
+    load = time_it(lambda: NumpyVectorStore.load(path, embeddings))
+    store = NumpyVectorStore.load(path, embeddings)
+    samples = [
+        time_it(lambda: store.similarity_search(f"query-{q}", **SEARCH_KWARGS))
+        for q in range(queries)
+    ]
+    return {"build_s": build + persist, "load_s": load, **latency_stats(samples)}
+
+
+def bench_deeplake(path: Path, embeddings: LookupEmbeddings, n: int, queries: int) -> dict:
+    from langchain.vectorstores import DeepLake
+
+    texts = [f"chunk-{i}" for i in range(n)]
+    build = time_it(
+        lambda: DeepLake.from_texts(
+            texts, embeddings, dataset_path=str(path), verbose=False
+        )
+    )
+    load = time_it(
+        lambda: DeepLake(
+            dataset_path=str(path),
+            embedding_function=embeddings,
+            read_only=True,
+            verbose=False,
+        )
+    )
+    store = DeepLake(
+        dataset_path=str(path),
+        embedding_function=embeddings,
+        read_only=True,
+        verbose=False,
+    )
+    samples = [
+        time_it(lambda: store.similarity_search(f"query-{q}", **SEARCH_KWARGS))
+        for q in range(queries)
+    ]
+    return {"build_s": build, "load_s": load, **latency_stats(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--skip-deeplake", action="store_true")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    embeddings = LookupEmbeddings(
+        random_vectors(max(sizes), args.dim, seed=0),
+        random_vectors(args.queries, args.dim, seed=1),
+    )
+    results = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = {
+                "chunks": n,
+                "numpy": bench_numpy(Path(tmp) / "numpy", embeddings, n, args.queries),
+            }
+            if not args.skip_deeplake:
+                result["deeplake"] = bench_deeplake(
+                    Path(tmp) / "deeplake", embeddings, n, args.queries
+                )
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    main()
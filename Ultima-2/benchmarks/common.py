@@ -0,0 +1,41 @@
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class LookupEmbeddings(Embeddings):
+    # Serves precomputed vectors so benchmarks measure the store, not the model.
+    # Texts are expected to be "chunk-<row>", queries "query-<row>".
+
+    def __init__(self, documents: np.ndarray, queries: np.ndarray):
+        self.documents = documents
+        self.queries = queries
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.documents[int(t.rsplit("-", 1)[1])].tolist() for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.queries[int(text.rsplit("-", 1)[1])].tolist()
+
+
+def random_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n, dim), dtype=np.float32)
+
+
+def time_it(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def latency_stats(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        "p50_ms": 1000 * statistics.median(samples),
+        "p95_ms": 1000 * samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        "mean_ms": 1000 * statistics.fmean(samples),
+    }
@@ -0,0 +1,22 @@
+import pytest
+
+from ultima import embedding_cache, lexical_index, manifest, vector_store
+from ultima.dataset_pool import dataset_pool
+from ultima.embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def data_source(tmp_path, monkeypatch):
+    # a small data source, indexed under tmp_path instead of the data folder
+    monkeypatch.setattr(vector_store, "DATA_PATH", tmp_path / "data")
+    monkeypatch.setattr(lexical_index, "LEXICAL_INDEX_PATH", tmp_path / "lexical")
+    monkeypatch.setattr(manifest, "MANIFEST_PATH", tmp_path / "manifests")
+    monkeypatch.setattr(
+        embedding_cache, "_cache", EmbeddingCache(path=tmp_path / "cache.sqlite")
+    )
+    monkeypatch.setattr(dataset_pool, "root", tmp_path / "data")
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "cats.txt").write_text("Cats sleep for most of the day.")
+    (source / "owls.txt").write_text("Owls hunt mice at night.")
+    return str(source)
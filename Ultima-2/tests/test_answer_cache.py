@@ -0,0 +1,55 @@
+import time
+
+from ultima.answer_cache import AnswerCache, get_answer_cache_key
+from ultima.models import MODELS
+from ultima.retrieval_chain import get_default_options
+
+OPTIONS = get_default_options(MODELS.STUB)
+
+
+def test_similar_questions_hit_above_the_threshold():
+    cache = AnswerCache(threshold=0.95)
+    key = get_answer_cache_key("data/a", OPTIONS)
+    cache.put(key, "When do owls hunt?", [1.0, 0.0, 0.0], "At night.")
+    # scaled embeddings are normalized, cosine 0.995
+    hit = cache.get(key, "When do the owls hunt?", [2.0, 0.2, 0.0])
+    assert hit is not None and hit.answer == "At night."
+    assert cache.get(key, "When do cats sleep?", [0.8, 0.6, 0.0]) is None
+    # the same question needs no similar embedding
+    assert cache.get(key, " When do owls  hunt? ", [0.0, 0.0, 1.0]) is not None
+    # answers are not shared across retrieval settings
+    other = get_answer_cache_key("data/a", {**OPTIONS, "k": OPTIONS["k"] + 1})
+    assert other != key
+    assert cache.get(other, "When do owls hunt?", [1.0, 0.0, 0.0]) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_answers_expire_after_the_ttl():
+    cache = AnswerCache(ttl=0.05)
+    cache.put("data/a#key", "q", [1.0, 0.0], "a", {"total_tokens": 10})
+    assert cache.get("data/a#key", "q", [1.0, 0.0]) is not None
+    assert cache.tokens_saved == 10
+    time.sleep(0.1)
+    assert cache.get("data/a#key", "q", [1.0, 0.0]) is None
+    assert len(cache) == 0
+    assert cache.evictions == 1
+
+
+def test_least_recently_used_answers_are_dropped():
+    cache = AnswerCache(max_entries=2)
+    for question, embedding in [("a", [1.0, 0.0]), ("b", [0.0, 1.0])]:
+        cache.put("data/a#key", question, embedding, question)
+    cache.get("data/a#key", "a", [1.0, 0.0])
+    cache.put("data/a#key", "c", [-1.0, 0.0], "c")
+    assert cache.get("data/a#key", "b", [0.0, 1.0]) is None
+    assert cache.get("data/a#key", "a", [1.0, 0.0]) is not None
+
+
+def test_invalidate_drops_the_answers_of_one_dataset():
+    cache = AnswerCache()
+    keys = [get_answer_cache_key(p, OPTIONS) for p in ["data/a", "data/ab"]]
+    for key in keys:
+        cache.put(key, "q", [1.0, 0.0], key)
+    cache.invalidate("data/a")
+    assert cache.get(keys[0], "q", [1.0, 0.0]) is None
+    assert cache.get(keys[1], "q", [1.0, 0.0]).answer == keys[1]
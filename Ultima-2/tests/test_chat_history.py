@@ -0,0 +1,71 @@
+from typing import List
+
+from langchain.schema import SystemMessage
+
+from ultima.chat_history import ChatHistory, Turn
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def add_turns(history: ChatHistory, n: int, start: int = 1) -> None:
+    for i in range(start, start + n):
+        history.append(f"q{i}", f"a{i}")
+
+
+def test_oldest_turns_are_dropped_beyond_the_token_budget():
+    history = ChatHistory(max_tokens=6, count_tokens=count_words, min_turns=0)
+    add_turns(history, 3)
+    assert history.turns == [("q1", "a1"), ("q2", "a2"), ("q3", "a3")]
+    add_turns(history, 2, start=4)
+    assert history.turns == [("q3", "a3"), ("q4", "a4"), ("q5", "a5")]
+    assert history.tokens == 6
+    assert history.tokens_saved == 4
+    assert len(history) == 5
+    assert history.for_chain() == history.turns
+
+
+def test_the_latest_turns_are_kept_over_the_budget():
+    history = ChatHistory(max_tokens=1, count_tokens=count_words, min_turns=2)
+    add_turns(history, 4)
+    assert history.turns == [("q3", "a3"), ("q4", "a4")]
+    assert history.tokens == 4
+
+
+def test_folded_turns_extend_the_summary():
+    calls = []
+
+    def summarize(summary: str, turns: List[Turn], callbacks=None) -> str:
+        calls.append((summary, turns))
+        return " ".join([summary, *(q for q, _ in turns)]).strip()
+
+    history = ChatHistory(
+        max_tokens=6, count_tokens=count_words, summarize=summarize, min_turns=0
+    )
+    add_turns(history, 5)
+    assert calls == [
+        ("", [("q1", "a1")]),
+        ("q1", [("q2", "a2"), ("q3", "a3")]),
+    ]
+    assert history.summary == "q1 q2 q3"
+    # the summary counts towards the budget
+    assert history.tokens == 3 + 4
+    assert history.for_chain() == [
+        SystemMessage(content="Summary of the conversation: q1 q2 q3"),
+        ("q4", "a4"),
+        ("q5", "a5"),
+    ]
+
+
+def test_turns_are_dropped_when_the_summary_fails():
+    def summarize(summary: str, turns: List[Turn], callbacks=None) -> str:
+        raise RuntimeError("model unavailable")
+
+    history = ChatHistory(
+        max_tokens=2, count_tokens=count_words, summarize=summarize, min_turns=0
+    )
+    add_turns(history, 2)
+    assert history.turns == [("q2", "a2")]
+    assert history.summary == ""
+    assert history.for_chain() == [("q2", "a2")]
@@ -0,0 +1,62 @@
+from langchain.schema import Document
+
+from ultima.context_assembler import merge_chunks
+
+
+def chunk(text: str, start: int, **metadata) -> Document:
+    return Document(
+        page_content=text[start : start + 6],
+        metadata={"start_index": start, "end_index": start + 6, **metadata},
+    )
+
+
+def test_merges_overlapping_chunks_of_a_document():
+    text = "abcdefghijklmnop"
+    docs = [chunk(text, 4, source="a.txt"), chunk(text, 0, source="a.txt")]
+    passages = merge_chunks(docs)
+    assert [p.doc.page_content for p in passages] == ["abcdefghij"]
+    assert passages[0].chunks == 2
+    assert passages[0].rank == 0
+
+
+def test_merges_contained_chunks():
+    text = "abcdefghijklmnop"
+    inner = Document(
+        page_content="cde", metadata={"source": "a", "start_index": 2, "end_index": 5}
+    )
+    passages = merge_chunks([chunk(text, 0, source="a"), inner])
+    assert [p.doc.page_content for p in passages] == ["abcdef"]
+
+
+def test_never_merges_csv_rows():
+    # every row is its own document starting at offset 0
+    rows = [
+        Document(
+            page_content=f"Product: {name}\nQ1 price: {price}",
+            metadata={"source": "Gild-Q1-Prices.csv", "row": i, "start_index": 0},
+        )
+        for i, (name, price) in enumerate([("biktarvy", 3795), ("odefsey", 4154)])
+    ]
+    passages = merge_chunks(rows)
+    assert [p.doc.page_content for p in passages] == [
+        "Product: biktarvy\nQ1 price: 3795",
+        "Product: odefsey\nQ1 price: 4154",
+    ]
+
+
+def test_never_merges_pages():
+    docs = [
+        chunk("abcdefgh", 0, source="a.pdf", page=1),
+        chunk("xyzdefgh", 2, source="a.pdf", page=2),
+    ]
+    assert len(merge_chunks(docs)) == 2
+
+
+def test_never_merges_different_text_at_overlapping_offsets():
+    docs = [chunk("abcdefgh", 0, source="a"), chunk("xyzuvwxy", 2, source="a")]
+    assert len(merge_chunks(docs)) == 2
+
+
+def test_chunks_without_offsets_are_kept():
+    docs = [Document(page_content="a", metadata={"source": "a"})] * 2
+    assert len(merge_chunks(docs)) == 2
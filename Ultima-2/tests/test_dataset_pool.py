@@ -0,0 +1,68 @@
+import gc
+import os
+
+import pytest
+
+from ultima import lexical_index, manifest
+from ultima.dataset_pool import DatasetPool, get_dataset_bytes
+from ultima.fakes import HashingEmbeddings
+from ultima.local_vector_store import NumpyVectorStore
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(lexical_index, "LEXICAL_INDEX_PATH", tmp_path / "lexical")
+    monkeypatch.setattr(manifest, "MANIFEST_PATH", tmp_path / "manifests")
+    return DatasetPool(quota=None, root=tmp_path / "data")
+
+
+def add_dataset(pool: DatasetPool, name: str, last_access: float) -> str:
+    path = str(pool.root / name)
+    store = NumpyVectorStore(HashingEmbeddings(), path=path)
+    store.add_texts([f"{name} chunk {i}" for i in range(8)])
+    store.persist()
+    os.utime(path, (last_access, last_access))
+    return path
+
+
+def test_least_recently_used_datasets_are_evicted_over_the_quota(pool):
+    a, b, c = (add_dataset(pool, n, t) for n, t in [("a", 1), ("b", 2), ("c", 3)])
+    assert set(pool.list_local_datasets()) == {a, b, c}
+    pool.quota = 2 * get_dataset_bytes(a)
+    pool.enforce_quota()
+    assert set(pool.list_local_datasets()) == {b, c}
+    assert not os.path.exists(a)
+    assert pool.evictions == 1
+
+    # opening a dataset makes it the most recently used
+    pool.get(b, lambda: NumpyVectorStore.load(b, HashingEmbeddings()))
+    add_dataset(pool, "d", 4)
+    pool.enforce_quota()
+    assert set(pool.list_local_datasets()) == {b, str(pool.root / "d")}
+
+
+def test_leased_datasets_are_never_evicted(pool):
+    a, b = add_dataset(pool, "a", 1), add_dataset(pool, "b", 2)
+    lease = pool.acquire(a)
+    pool.quota = 0
+    pool.enforce_quota()
+    assert set(pool.list_local_datasets()) == {a}
+    assert pool.stats()["referenced"] == 1
+
+    lease.release()
+    assert pool.stats()["referenced"] == 0
+    assert pool.list_local_datasets() == {}
+    assert not os.path.exists(b)
+
+
+def test_leases_are_released_when_garbage_collected(pool):
+    a = add_dataset(pool, "a", 1)
+    lease = pool.acquire(a)
+    pool.quota = 0
+    pool.enforce_quota()
+    assert os.path.exists(a)
+
+    del lease
+    gc.collect()
+    assert pool.stats()["referenced"] == 0
+    assert not os.path.exists(a)
@@ -0,0 +1,79 @@
+import numpy as np
+from langchain.schema import Document
+
+from ultima.dedup import (
+    MinHasher,
+    deduplicate_chunks,
+    estimate_similarity,
+    get_shingles,
+)
+
+rng = np.random.default_rng(0)
+WORDS = [f"w{i}" for i in range(500)]
+
+
+def get_text(size: int = 80) -> str:
+    return " ".join(rng.choice(WORDS, size))
+
+
+def edit(text: str, words: int) -> str:
+    # replaces a few words, e.g. a changed date in a repeated disclaimer
+    tokens = text.split()
+    for i in rng.choice(len(tokens), words, replace=False):
+        tokens[i] = "changed"
+    return " ".join(tokens)
+
+
+def test_shingles_ignore_case_and_whitespace():
+    assert get_shingles("A b  C d", 3) == ["a b c", "b c d"]
+    assert get_shingles("A\nB", 3) == get_shingles("a b", 3) == ["a b"]
+
+
+def test_similarity_estimates_jaccard():
+    hasher = MinHasher()
+    text = get_text()
+    assert estimate_similarity(hasher.signature(text), hasher.signature(text)) == 1
+    a, b = hasher.signature(text), hasher.signature(get_text())
+    assert estimate_similarity(a, b) < 0.1
+    edited = hasher.signature(edit(text, 2))
+    assert 0.75 <= estimate_similarity(hasher.signature(text), edited) < 1
+
+
+def test_near_duplicates_are_dropped_with_their_provenance():
+    text = get_text()
+    chunks = [
+        Document(page_content=text, metadata={"source": "a.pdf", "page": 1}),
+        Document(page_content=get_text(), metadata={"source": "a.pdf", "page": 2}),
+        Document(page_content=edit(text, 2), metadata={"source": "b.pdf", "page": 1}),
+        Document(page_content=text.upper(), metadata={"source": "a.pdf", "page": 7}),
+    ]
+    kept, report = deduplicate_chunks(chunks)
+    assert kept == chunks[:2]
+    assert (report.chunks, report.duplicates) == (4, 2)
+    assert report.duplicate_chars == len(chunks[2].page_content) + len(text)
+    assert kept[0].metadata["duplicates"] == 2
+    assert kept[0].metadata["duplicate_provenance"] == [
+        {"source": "b.pdf", "page": 1},
+        {"source": "a.pdf", "page": 7},
+    ]
+    assert "duplicates" not in kept[1].metadata
+
+
+def test_duplicates_from_the_same_page_add_no_provenance():
+    text = get_text()
+    chunks = [
+        Document(page_content=text, metadata={"source": "a.pdf", "page": 1}),
+        Document(page_content=text, metadata={"source": "a.pdf", "page": 1}),
+        Document(page_content=text, metadata={"source": "b.pdf", "page": 1}),
+        Document(page_content=text, metadata={"source": "b.pdf", "page": 1}),
+    ]
+    kept, _ = deduplicate_chunks(chunks)
+    assert kept[0].metadata["duplicates"] == 3
+    assert kept[0].metadata["duplicate_provenance"] == [{"source": "b.pdf", "page": 1}]
+
+
+def test_different_chunks_are_kept():
+    chunks = [Document(page_content=get_text()) for _ in range(50)]
+    kept, report = deduplicate_chunks(chunks)
+    assert kept == chunks
+    assert report.duplicates == 0
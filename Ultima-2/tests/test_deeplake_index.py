@@ -0,0 +1,140 @@
+import zlib
+from typing import List
+
+import numpy as np
+import pytest
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+
+from ultima.deeplake_index import DeepLakeRetriever, get_row_index
+from ultima.partitions import PartitionRetriever, metadata_filter
+
+rng = np.random.default_rng(0)
+WORDS = ["biktarvy", "odefsey", "price", "dose"] + [f"w{i}" for i in range(60)]
+# indexed before chunks had "file", they match on their source
+SOURCES = ["data/sub/a.txt", "data/b.csv", "data/c.pdf"]
+TEXTS = [" ".join(rng.choice(WORDS, 6)) for _ in range(60)]
+METADATAS = [{"source": SOURCES[i % 3], "page": i % 4} for i in range(len(TEXTS))]
+SEARCH_KWARGS = {
+    "k": 4,
+    "fetch_k": 20,
+    "distance_metric": "cos",
+    "maximal_marginal_relevance": False,
+    "lambda_mult": 0.5,
+}
+
+
+class RandomEmbeddings(Embeddings):
+    # a fixed random vector per text, rankings without ties
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        seed = zlib.crc32(text.encode("utf-8"))
+        return np.random.default_rng(seed).normal(size=32).tolist()
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    from langchain.vectorstores import DeepLake
+
+    store = DeepLake(
+        dataset_path=str(tmp_path_factory.mktemp("deeplake")),
+        embedding_function=RandomEmbeddings(),
+        overwrite=True,
+        verbose=False,
+    )
+    store.add_texts(TEXTS, METADATAS)
+    return store
+
+
+def nearest(rows, query: str, k: int):
+    # cosine ranking of rows, the way DeepLake ranks them
+    embeddings = RandomEmbeddings()
+    matrix = np.array(embeddings.embed_documents([TEXTS[i] for i in rows]))
+    q = np.array(embeddings.embed_query(query))
+    scores = matrix @ q / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(q))
+    return [rows[i] for i in np.argsort(-scores, kind="stable")[:k]]
+
+
+def test_index_is_shared_per_store(store):
+    assert get_row_index(store) is get_row_index(store)
+    assert len(get_row_index(store).partitions) == 3
+
+
+@pytest.mark.parametrize(
+    "filter",
+    [
+        None,
+        {"file": "sub/a.txt"},
+        {"file": ["b.csv", "c.pdf"]},
+        {"file": "c.pdf", "page": 2},
+    ],
+)
+def test_search_ranks_the_rows_of_the_filter(store, filter):
+    index = get_row_index(store)
+    rows = index.partitions.rows(filter)
+    rows = list(range(len(TEXTS))) if rows is None else rows.tolist()
+    results = index.search(
+        RandomEmbeddings().embed_query("biktarvy price"), k=5, filter=filter
+    )
+    assert [row for row, _ in results] == nearest(rows, "biktarvy price", 5)
+    docs = index.get_documents([row for row, _ in results])
+    assert [doc.page_content for doc in docs] == [TEXTS[row] for row, _ in results]
+    assert [doc.metadata for doc in docs] == [METADATAS[row] for row, _ in results]
+
+
+def test_search_of_a_missing_file(store):
+    index = get_row_index(store)
+    assert index.search([1.0] * 32, k=5, filter={"file": "missing.txt"}) == []
+
+
+def test_retriever_selects_with_mmr(store):
+    embeddings = RandomEmbeddings()
+    search_kwargs = {**SEARCH_KWARGS, "maximal_marginal_relevance": True}
+    retriever = DeepLakeRetriever(store, embeddings, search_kwargs)
+    docs = retriever.get_relevant_documents("odefsey dose")
+    candidates = nearest(list(range(len(TEXTS))), "odefsey dose", 20)
+    expected = langchain_mmr(
+        np.array(embeddings.embed_query("odefsey dose")),
+        embeddings.embed_documents([TEXTS[i] for i in candidates]),
+        k=4,
+    )
+    assert [d.page_content for d in docs] == [TEXTS[candidates[i]] for i in expected]
+
+
+def test_partition_retriever_scopes_a_legacy_dataset(store):
+    files = ["sub/a.txt", "b.csv", "c.pdf"]
+    retriever = DeepLakeRetriever(store, RandomEmbeddings(), SEARCH_KWARGS)
+    retriever = PartitionRetriever(retriever, files)
+    docs = retriever.get_relevant_documents("biktarvy in sub/a.txt")
+    assert len(docs) == 4
+    assert {doc.metadata["source"] for doc in docs} == {"data/sub/a.txt"}
+    token = metadata_filter.set({"file": ["b.csv", "c.pdf"]})
+    try:
+        docs = retriever.get_relevant_documents("biktarvy")
+    finally:
+        metadata_filter.reset(token)
+    assert {doc.metadata["source"] for doc in docs} <= {"data/b.csv", "data/c.pdf"}
+
+
+class QueryOnlyEmbeddings(RandomEmbeddings):
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise AssertionError("candidates are read from the store")
+
+
+def test_mmr_reads_the_candidate_vectors_from_the_store(store):
+    search_kwargs = {**SEARCH_KWARGS, "maximal_marginal_relevance": True}
+    retriever = DeepLakeRetriever(store, QueryOnlyEmbeddings(), search_kwargs)
+    assert len(retriever.get_relevant_documents("odefsey dose")) == 4
+    index = get_row_index(store)
+    assert np.allclose(
+        index.get_embeddings([3, 1]),
+        RandomEmbeddings().embed_documents([TEXTS[3], TEXTS[1]]),
+    )
+
+
+def test_rows_of_chunk_ids(store):
+    index = get_row_index(store)
+    ids = store.ds.ids.data()["value"]
+    assert index.get_rows([ids[5], "missing", ids[0]]) == [5, None, 0]
@@ -0,0 +1,83 @@
+import time
+from typing import List
+
+from ultima.embedding_cache import CachedEmbeddings, EmbeddingCache, hash_text
+from ultima.fakes import HashingEmbeddings
+
+# float32 vectors of 4 dimensions take 16 bytes in the cache
+SIZE = 4
+
+
+class RecordingEmbeddings(HashingEmbeddings):
+    # records the chunks it has to embed
+    def __init__(self):
+        super().__init__(SIZE)
+        self.embedded: List[str] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+def test_repeated_texts_are_embedded_once(tmp_path):
+    embeddings = RecordingEmbeddings()
+    cached = CachedEmbeddings(
+        embeddings, "hashing", EmbeddingCache(path=tmp_path / "cache.sqlite")
+    )
+    first = cached.embed_documents(["owls hunt", "cats sleep", "owls hunt"])
+    assert embeddings.embedded == ["owls hunt", "cats sleep"]
+    assert first[0] == first[2]
+
+    # whitespace variations hit the same entry, also after a restart
+    cached = CachedEmbeddings(
+        embeddings, "hashing", EmbeddingCache(path=tmp_path / "cache.sqlite")
+    )
+    again = cached.embed_documents([" owls  hunt\n", "cats sleep"])
+    assert embeddings.embedded == ["owls hunt", "cats sleep"]
+    assert again == first[:2]
+    assert cached.cache.stats()["hits"] == 2
+
+    # other models don't share vectors
+    other = CachedEmbeddings(embeddings, "other", cached.cache)
+    other.embed_documents(["owls hunt"])
+    assert embeddings.embedded[-1] == "owls hunt"
+
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    cache = EmbeddingCache(path=tmp_path / "cache.sqlite", max_bytes=2 * SIZE * 4)
+    embeddings = RecordingEmbeddings()
+    cached = CachedEmbeddings(embeddings, "hashing", cache)
+    for text in ["a", "b"]:
+        cached.embed_documents([text])
+        time.sleep(0.01)
+    # reading "a" makes "b" the least recently used
+    cached.embed_documents(["a"])
+    time.sleep(0.01)
+    cached.embed_documents(["c"])
+    assert cache.evictions == 1
+    assert cache.size_bytes == 2 * SIZE * 4
+    assert set(cache.get_many("hashing", [hash_text(t) for t in "abc"])) == {
+        hash_text("a"),
+        hash_text("c"),
+    }
+
+    embeddings.embedded.clear()
+    cached.embed_documents(["a", "b", "c"])
+    assert embeddings.embedded == ["b"]
+
+
+def test_counters(tmp_path):
+    cache = EmbeddingCache(path=tmp_path / "cache.sqlite")
+    cached = CachedEmbeddings(RecordingEmbeddings(), "hashing", cache)
+    cached.embed_documents(["a", "b"])
+    cached.embed_documents(["a", "b", "c", "a"])
+    cached.embed_query("a")
+    cached.embed_query("a")
+    stats = cache.stats()
+    # the query cache is kept apart from the document cache
+    assert (stats["hits"], stats["misses"]) == (4, 4)
+    assert stats["hit_rate"] == 0.5
+    assert stats["evictions"] == 0
+    assert stats["size_bytes"] == 4 * SIZE * 4
+    # the size is counted from the file after a restart
+    assert EmbeddingCache(path=tmp_path / "cache.sqlite").size_bytes == 4 * SIZE * 4
@@ -0,0 +1,125 @@
+from typing import List
+
+import numpy as np
+import pytest
+
+from ultima.fakes import HashingEmbeddings
+from ultima.hybrid_search import HybridRetriever, reciprocal_rank_fusion
+from ultima.lexical_index import LexicalIndex
+from ultima.local_vector_store import NumpyVectorStore
+
+rng = np.random.default_rng(0)
+WORDS = [f"w{i}" for i in range(50)] + ["biktarvy", "odefsey", "descovy"]
+FILES = ["a.pdf", "b.csv", "c.txt"]
+TEXTS = [" ".join(rng.choice(WORDS, size=rng.integers(3, 30))) for _ in range(300)]
+METADATAS = [
+    {"source": f"docs/{FILES[i % 3]}", "file": FILES[i % 3], "page": i % 5}
+    for i in range(len(TEXTS))
+]
+
+
+@pytest.fixture(scope="module")
+def index() -> LexicalIndex:
+    index = LexicalIndex()
+    index.add([str(i) for i in range(len(TEXTS))], TEXTS, METADATAS)
+    return index
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+    assert [key for key, _ in fused] == ["a", "c", "b"]
+    assert fused[0][1] == pytest.approx(1 / 61 + 1 / 62)
+    assert fused[2][1] == pytest.approx(1 / 62)
+
+
+def test_search_finds_exact_terms(index):
+    results = index.search("biktarvy", k=10)
+    assert results
+    assert all("biktarvy" in TEXTS[i].split() for i, _ in results)
+    scores = [score for _, score in results]
+    assert scores == sorted(scores, reverse=True)
+
+
+@pytest.mark.parametrize(
+    "filter",
+    [
+        {"file": "b.csv"},
+        {"file": ["a.pdf", "c.txt"]},
+        {"file": "a.pdf", "page": 3},
+        {"page": [1, 2]},
+    ],
+)
+def test_filtered_search_ranks_like_unfiltered(index, filter):
+    query = "biktarvy odefsey w7 w12"
+    rows = set(index.partitions.rows(filter).tolist())
+    expected = [(i, s) for i, s in index.search(query, k=len(TEXTS)) if i in rows]
+    results = index.search(query, k=5, filter=filter)
+    assert [i for i, _ in results] == [i for i, _ in expected[:5]]
+    assert [s for _, s in results] == pytest.approx([s for _, s in expected[:5]])
+
+
+def test_filtered_search_only_reads_postings_of_its_rows(index):
+    rows = index.partitions.rows({"file": "b.csv"})
+    term_id = index._term_ids["biktarvy"]
+    postings, docs, positions = index._postings(term_id, rows)
+    assert set(docs.tolist()) <= set(rows.tolist())
+    assert (rows[positions] == docs).all()
+    assert (index.doc_ids[postings] == docs).all()
+    assert index.search("biktarvy", k=5, filter={"file": "missing.txt"}) == []
+
+
+SEARCH_KWARGS = {
+    "k": 4,
+    "fetch_k": 20,
+    "distance_metric": "cos",
+    "maximal_marginal_relevance": False,
+    "lambda_mult": 0.5,
+}
+
+
+class QueryOnlyEmbeddings(HashingEmbeddings):
+    # records the chunks it has to embed
+    def __init__(self):
+        super().__init__()
+        self.embedded: List[str] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+@pytest.fixture(scope="module")
+def store() -> NumpyVectorStore:
+    ids = [str(i) for i in range(len(TEXTS))]
+    return NumpyVectorStore.from_texts(TEXTS, HashingEmbeddings(), METADATAS, ids)
+
+
+def test_hybrid_retriever_searches_the_filtered_files(index, store):
+    embeddings = HashingEmbeddings()
+    search_kwargs = {**SEARCH_KWARGS, "filter": {"file": "c.txt"}}
+    retriever = HybridRetriever(store, index, embeddings, search_kwargs)
+    docs = retriever.get_relevant_documents("biktarvy")
+    assert len(docs) == 4
+    assert all(doc.metadata["file"] == "c.txt" for doc in docs)
+    # the keyword match is ranked first by both searches or by fusion
+    assert "biktarvy" in docs[0].page_content.split()
+    retriever = retriever.with_search_kwargs(
+        {**search_kwargs, "maximal_marginal_relevance": True}
+    )
+    assert len(retriever.get_relevant_documents("biktarvy")) == 4
+
+
+def test_mmr_reads_the_candidate_vectors_from_the_store(index, store):
+    embeddings = QueryOnlyEmbeddings()
+    search_kwargs = {**SEARCH_KWARGS, "maximal_marginal_relevance": True}
+    retriever = HybridRetriever(store, index, embeddings, search_kwargs)
+    assert len(retriever.get_relevant_documents("biktarvy w3")) == 4
+    assert embeddings.embedded == []
+    # chunks missing from the store are embedded
+    partial = NumpyVectorStore.from_texts(
+        TEXTS[:100], HashingEmbeddings(), METADATAS[:100], [str(i) for i in range(100)]
+    )
+    retriever = HybridRetriever(partial, index, embeddings, search_kwargs)
+    assert len(retriever.get_relevant_documents("biktarvy w3")) == 4
+    assert embeddings.embedded
+    assert all(TEXTS.index(text) >= 100 for text in embeddings.embedded)
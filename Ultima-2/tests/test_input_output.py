@@ -0,0 +1,40 @@
+import gc
+import io
+
+from ultima.input_output import _upload_hashes, get_upload_data_source, hash_upload
+
+
+class Upload(io.BytesIO):
+    # like streamlit's UploadedFile: __eq__ without __hash__
+    __hash__ = None
+
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Upload) and self.getvalue() == other.getvalue()
+
+
+def test_hash_upload_of_unhashable_upload():
+    upload = Upload("a.txt", b"content")
+    assert hash_upload(upload) == hash_upload(Upload("b.txt", b"content"))
+    assert hash_upload(upload) != hash_upload(Upload("a.txt", b"other"))
+
+
+def test_hash_upload_forgets_collected_uploads():
+    upload = Upload("a.txt", b"content")
+    hash_upload(upload)
+    key = id(upload)
+    del upload
+    gc.collect()
+    assert key not in _upload_hashes
+
+
+def test_upload_data_source_depends_on_names_and_contents():
+    a = get_upload_data_source([Upload("a.txt", b"1"), Upload("b.txt", b"2")])
+    b = get_upload_data_source([Upload("b.txt", b"2"), Upload("a.txt", b"1")])
+    c = get_upload_data_source([Upload("a.txt", b"1"), Upload("b.txt", b"3")])
+    assert a == b
+    assert a != c
+    assert a.startswith("upload://")
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+
+from langchain.schema import Document
+
+from ultima.load_data import (
+    LoadTimeoutError,
+    iter_load_files,
+    load_with_timeout,
+    split_pages,
+)
+
+
+def load_or_crash(file: str, timeout):
+    # runs in loader processes, "crash" takes its process down
+    if file == "crash":
+        os._exit(1)
+    time.sleep(0.05)
+    return [Document(page_content=file, metadata={"source": file})], None
+
+
+def test_worker_crash_fails_only_its_file():
+    files = ["a", "crash", "b", "c"]
+    results = list(iter_load_files(files, workers=2, load_file=load_or_crash))
+    assert [file for file, _, _ in results] == files
+    failed = [file for file, _, failure in results if failure is not None]
+    assert failed == ["crash"]
+    for file, docs, failure in results:
+        if failure is None:
+            assert [doc.page_content for doc in docs] == [file]
+
+
+def test_timeout_outside_the_main_thread():
+    errors = []
+
+    def load():
+        try:
+            load_with_timeout(lambda: time.sleep(5) or [], timeout=0.2)
+        except LoadTimeoutError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=load)
+    start = time.perf_counter()
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+    assert time.perf_counter() - start < 2
+
+
+def test_errors_of_loads_in_threads_are_raised():
+    def fail():
+        raise ValueError("broken")
+
+    errors = []
+
+    def load():
+        try:
+            load_with_timeout(fail, timeout=1)
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=load)
+    thread.start()
+    thread.join()
+    assert [str(e) for e in errors] == ["broken"]
+
+
+def test_split_pages():
+    doc = Document(page_content="one\fTWO\f \fthree", metadata={"source": "a.pdf"})
+    pages = split_pages([doc])
+    assert [(p.page_content, p.metadata["page"]) for p in pages] == [
+        ("one", 1),
+        ("TWO", 2),
+        ("three", 4),
+    ]
+    assert all(p.metadata["source"] == "a.pdf" for p in pages)
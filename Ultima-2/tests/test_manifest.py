@@ -0,0 +1,67 @@
+import pytest
+
+from ultima import manifest as manifest_module
+from ultima.manifest import Manifest, find_base_manifest, hash_file
+
+
+@pytest.fixture(autouse=True)
+def manifest_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifest_module, "MANIFEST_PATH", tmp_path)
+
+
+def get_manifest(dataset_path: str = "datasets/a", **files: str) -> Manifest:
+    return Manifest(
+        dataset_path=dataset_path,
+        embedding="all-MiniLM-L6-v2",
+        chunk_size=1000,
+        chunk_overlap=100,
+        files={
+            name: {"hash": file_hash, "ids": [f"{name}-0", f"{name}-1"]}
+            for name, file_hash in files.items()
+        },
+    )
+
+
+def test_diff_of_new_changed_and_removed_files():
+    manifest = get_manifest(**{"a.txt": "1", "b.txt": "2", "c.txt": "3"})
+    changed, stale_ids = manifest.diff({"a.txt": "1", "b.txt": "20", "d.txt": "4"})
+    assert changed == ["b.txt", "d.txt"]
+    assert sorted(stale_ids) == ["b.txt-0", "b.txt-1", "c.txt-0", "c.txt-1"]
+    assert manifest.diff({"a.txt": "1", "b.txt": "2", "c.txt": "3"}) == ([], [])
+
+
+def test_update_keeps_the_ids_of_unchanged_files():
+    manifest = get_manifest(**{"a.txt": "1", "b.txt": "2"})
+    manifest.update({"a.txt": "1", "b.txt": "20"}, {"b.txt": ["new"]})
+    assert manifest.files == {
+        "a.txt": {"hash": "1", "ids": ["a.txt-0", "a.txt-1"]},
+        "b.txt": {"hash": "20", "ids": ["new"]},
+    }
+
+
+def test_save_and_load():
+    manifest = get_manifest(**{"a.txt": "1"})
+    manifest.save()
+    assert Manifest.load("datasets/a") == manifest
+    manifest.delete()
+    assert Manifest.load("datasets/a") is None
+
+
+def test_hash_file(tmp_path):
+    (tmp_path / "a.txt").write_bytes(b"content")
+    (tmp_path / "b.txt").write_bytes(b"content")
+    assert hash_file(str(tmp_path / "a.txt")) == hash_file(str(tmp_path / "b.txt"))
+
+
+def test_base_manifest_shares_most_files_and_its_options():
+    get_manifest("datasets/upload-1", **{"a.txt": "1", "b.txt": "2"}).save()
+    files = {"c.txt": "3", "d.txt": "4", "e.txt": "5"}
+    get_manifest("datasets/upload-2", **files).save()
+    other_options = get_manifest("datasets/upload-3", **{"a.txt": "1", "b.txt": "2"})
+    other_options.chunk_size = 500
+    other_options.save()
+    manifest = get_manifest("datasets/upload-4")
+    base = find_base_manifest(manifest, {"a.txt": "1", "b.txt": "2", "f.txt": "6"})
+    assert base.dataset_path == "datasets/upload-1"
+    # one of the three files of upload-2 isn't enough to copy it
+    assert find_base_manifest(manifest, {"c.txt": "3", "f.txt": "6"}) is None
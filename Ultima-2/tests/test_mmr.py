@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from langchain.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+
+from ultima.mmr import batch_maximal_marginal_relevance, maximal_marginal_relevance
+
+rng = np.random.default_rng(0)
+
+
+@pytest.mark.parametrize("lambda_mult", [0.0, 0.5, 1.0])
+def test_selects_like_langchain(lambda_mult):
+    query = rng.normal(size=16)
+    candidates = rng.normal(size=(30, 16))
+    expected = langchain_mmr(query, candidates, lambda_mult=lambda_mult, k=8)
+    selected = maximal_marginal_relevance(query, candidates, lambda_mult, k=8)
+    assert selected == expected
+
+
+def test_batch_of_ragged_candidate_lists():
+    queries = rng.normal(size=(3, 16))
+    candidates = [rng.normal(size=(n, 16)) for n in (12, 3, 0)]
+    results = batch_maximal_marginal_relevance(queries, candidates, 0.5, k=5)
+    assert results[0] == maximal_marginal_relevance(queries[0], candidates[0], k=5)
+    assert sorted(results[1]) == [0, 1, 2]
+    assert results[2] == []
@@ -0,0 +1,25 @@
+from ultima.partitions import Partitions
+
+# a dataset indexed before chunks had "file", and one indexed after
+LEGACY = [
+    {"source": "data/sub/a.txt"},
+    {"source": "data/b.csv", "row": 0},
+    {"source": "data/sub/a.txt"},
+    {"source": "data\\c.pdf", "page": 2},
+]
+CURRENT = [{"file": "sub/a.txt", "source": "data/sub/a.txt"}, {"file": "b.csv"}]
+
+
+def test_chunks_without_file_match_on_their_source():
+    partitions = Partitions(LEGACY)
+    assert partitions.rows({"file": "sub/a.txt"}).tolist() == [0, 2]
+    assert partitions.rows({"file": "a.txt"}).tolist() == [0, 2]
+    assert partitions.rows({"file": ["b.csv", "c.pdf"]}).tolist() == [1, 3]
+    assert partitions.rows({"file": "c.pdf", "page": 2}).tolist() == [3]
+    assert partitions.rows({"file": "missing.txt"}).tolist() == []
+
+
+def test_chunks_with_file_match_on_it():
+    partitions = Partitions(CURRENT)
+    assert partitions.rows({"file": "sub/a.txt"}).tolist() == [0]
+    assert partitions.rows({"file": ["b.csv", "sub/a.txt"]}).tolist() == [0, 1]
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+from ultima.dataset_pool import dataset_pool
+from ultima.lexical_index import LexicalIndex
+from ultima.models import MODELS
+from ultima.retrieval_chain import get_chain, get_default_options
+from ultima.vector_store import get_dataset_path
+
+
+def test_chains_share_the_lexical_index_of_their_dataset(data_source, monkeypatch):
+    loads = []
+    load = LexicalIndex.load.__func__
+
+    def counted_load(cls, path):
+        loads.append(path)
+        return load(cls, path)
+
+    monkeypatch.setattr(LexicalIndex, "load", classmethod(counted_load))
+    options = get_default_options(MODELS.STUB)
+    dataset_path = get_dataset_path(data_source, options, {})
+    get_chain(data_source, options, {})
+    built = dataset_pool.get_lexical_index(dataset_path, lambda: None)
+    assert built is not None and len(built) == 2
+
+    loads.clear()
+    get_chain(data_source, options, {})
+    get_chain(data_source, options, {})
+    assert loads == []
+    assert dataset_pool.get_lexical_index(dataset_path, lambda: None) is built
+
+    # a rebuild replaces the shared index
+    (Path(data_source) / "bats.txt").write_text("Bats sleep upside down.")
+    get_chain(data_source, options, {})
+    rebuilt = dataset_pool.get_lexical_index(dataset_path, lambda: None)
+    assert rebuilt is not built
+    assert "Bats sleep upside down." in rebuilt.texts
@@ -0,0 +1,81 @@
+import threading
+import time
+from typing import List, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.llms.base import LLM
+
+from ultima.models import get_model_lock
+from ultima.serialized_llm import SerializedLLM
+
+
+class ReentrancyCheckingLLM(LLM):
+    # fails calls that overlap, like a backend that is not re-entrant
+    running: int = 0
+    overlaps: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "check"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None):
+        self.running += 1
+        if self.running > 1:
+            self.overlaps += 1
+        time.sleep(0.05)
+        if run_manager is not None:
+            run_manager.on_llm_new_token(prompt)
+        self.running -= 1
+        return prompt
+
+
+class Tokens(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens = []
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.tokens.append(token)
+
+
+def test_calls_of_sessions_sharing_a_model_dont_overlap():
+    shared = ReentrancyCheckingLLM()
+    lock = get_model_lock(("model", "test"))
+    assert get_model_lock(("model", "test")) is lock
+    results, handlers = [], []
+
+    def call(i: int) -> None:
+        # every session and chain has its own wrapper around the shared model
+        handler = Tokens()
+        handlers.append(handler)
+        llm = SerializedLLM(llm=shared, lock=lock)
+        results.append(llm(f"q{i}", callbacks=[handler]))
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert shared.overlaps == 0
+    assert sorted(results) == ["q0", "q1", "q2", "q3"]
+    assert sorted(t for h in handlers for t in h.tokens) == ["q0", "q1", "q2", "q3"]
+
+
+class TemperatureLLM(LLM):
+    # answers with the temperature it was called with, like GPT4All's params
+    temp: float = 0.7
+
+    @property
+    def _llm_type(self) -> str:
+        return "temperature"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        return str(kwargs.get("temp", self.temp))
+
+
+def test_sessions_sharing_a_model_keep_their_temperature():
+    shared = TemperatureLLM()
+    lock = get_model_lock(("model", "temperature"))
+    cold = SerializedLLM(llm=shared, lock=lock, params={"temp": 0.0})
+    hot = SerializedLLM(llm=shared, lock=lock, params={"temp": 1.0})
+    assert (cold("q"), hot("q"), cold("q")) == ("0.0", "1.0", "0.0")
+    assert shared.temp == 0.7
@@ -0,0 +1,80 @@
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from ultima.metrics import PROMETHEUS_NAME, metrics
+from ultima.models import MODELS
+from ultima.retrieval_chain import get_default_options
+from ultima.service import QuestionAnsweringService
+
+
+def get_service() -> QuestionAnsweringService:
+    options = get_default_options(MODELS.STUB)
+    return QuestionAnsweringService("docs", options, {}, allowed_data_sources=["more"])
+
+
+def ask(service: QuestionAnsweringService, body: dict):
+    async def post():
+        async with TestClient(TestServer(service.create_app())) as client:
+            response = await client.post("/ask", json=body)
+            return response.status, await response.json()
+
+    return asyncio.run(post())
+
+
+def get(service: QuestionAnsweringService, path: str, json: bool = True):
+    async def request():
+        async with TestClient(TestServer(service.create_app())) as client:
+            response = await client.get(path)
+            body = await response.json() if json else await response.text()
+            return response.status, body
+
+    return asyncio.run(request())
+
+
+def test_request_data_sources_must_be_allowed():
+    service = get_service()
+    assert service.get_request_data_source(None) == "docs"
+    assert service.get_request_data_source("more") == "more"
+    status, body = ask(service, {"question": "q", "data_source": "/etc"})
+    assert status == 403
+    assert "not allowed" in body["error"]
+    assert len(service.chains) == 0
+
+
+def test_filter_must_be_an_object():
+    status, _ = ask(get_service(), {"question": "q", "filter": "a.csv"})
+    assert status == 400
+
+
+def test_answers_a_question_with_its_sources(data_source):
+    metrics.clear()
+    service = QuestionAnsweringService(
+        data_source, get_default_options(MODELS.STUB), {}
+    )
+    status, body = ask(service, {"question": "When do owls hunt?"})
+    assert status == 200
+    assert body["answer"]
+    assert body["sources"]
+    assert {"content", "metadata"} <= set(body["sources"][0])
+    assert {"retrieval", "answer", "chain"} <= set(body["timings"])
+    assert set(body["usage"]) == {
+        "total_tokens",
+        "prompt_tokens",
+        "completion_tokens",
+        "total_cost",
+    }
+
+    status, stats = get(service, "/stats")
+    assert status == 200
+    assert stats["requests"] == 1
+    assert stats["failures"] == 0
+    assert stats["chains"] == 1
+
+    status, stages = get(service, "/metrics?format=json")
+    assert status == 200
+    assert stages["chain"]["count"] == 1
+    assert stages["retrieval"]["count"] == 1
+    status, text = get(service, "/metrics", json=False)
+    assert status == 200
+    assert f'{PROMETHEUS_NAME}_count{{stage="chain"}} 1' in text.splitlines()
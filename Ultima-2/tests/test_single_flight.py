@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ultima.single_flight import SingleFlight, get_flight_key
+
+
+def test_flight_key_ignores_case_and_whitespace():
+    key = get_flight_key("chain", "How does  MMR work?", [])
+    assert key == get_flight_key("chain", "how does mmr work?", [])
+    assert key != get_flight_key("chain", "how does mmr work?", [["q", "a"]])
+    assert key != get_flight_key("other", "how does mmr work?", [])
+
+
+def test_threads_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+
+    def function():
+        calls.append(1)
+        time.sleep(0.2)
+        return "answer"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flights.do("k", function)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert {result for result, _ in results} == {"answer"}
+    assert flights.stats()["coalesced"] == 3
+
+
+def test_tasks_share_one_execution_and_its_error():
+    flights = SingleFlight()
+    calls = []
+
+    async def function():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        raise ValueError("failed")
+
+    async def main():
+        return await asyncio.gather(
+            *[flights.ado("k", function) for _ in range(3)], return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_cancelled_leader_doesnt_cancel_its_followers():
+    flights = SingleFlight()
+    calls = []
+
+    async def function():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return "answer"
+
+    async def main():
+        leader = asyncio.create_task(flights.ado("k", function))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(flights.ado("k", function))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == ("answer", True)
+    # the follower's answer is computed again without the leader
+    assert len(calls) == 2
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_cancelled_leader_without_followers():
+    flights = SingleFlight()
+
+    async def main():
+        leader = asyncio.create_task(flights.ado("k", lambda: asyncio.sleep(1)))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # a new call of the key runs again
+        return await flights.ado("k", lambda: asyncio.sleep(0, "again"))
+
+    assert asyncio.run(main()) == ("again", False)
+
+
+class RerunException(BaseException):
+    # like streamlit's, raised in the thread of a session that is rerun
+    pass
+
+
+def test_followers_call_again_when_the_leader_is_rerun():
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def leader():
+        calls.append("leader")
+        started.set()
+        time.sleep(0.2)
+        raise RerunException()
+
+    def follower():
+        calls.append("follower")
+        time.sleep(0.1)
+        return "answer"
+
+    errors, results = [], []
+
+    def run_leader():
+        try:
+            flights.do("k", leader)
+        except RerunException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_leader)]
+    threads[0].start()
+    started.wait()
+    threads += [
+        threading.Thread(target=lambda: results.append(flights.do("k", follower)))
+        for _ in range(3)
+    ]
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # only the leader's session is rerun, one follower answers the others
+    assert len(errors) == 1
+    assert calls == ["leader", "follower"]
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    assert {result for result, _ in results} == {"answer"}
+    assert flights.stats() == {
+        "executions": 2,
+        "coalesced": 2,
+        "in_flight": 0,
+        "tokens_saved": 0,
+        "cost_saved": 0.0,
+    }
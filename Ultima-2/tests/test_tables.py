@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import List
+
+import pytest
+from langchain.schema import BaseRetriever, Document
+
+from ultima.partitions import metadata_filter
+from ultima.tables import TableRetriever, TableStore
+
+ROOT = Path(__file__).resolve().parent.parent
+PRICES = "Gild-Q1-Prices.csv"
+SCRIPTS = "GILD-Scripts-4Q22-1Q23.csv"
+
+
+@pytest.fixture(scope="module")
+def store() -> TableStore:
+    return TableStore.from_files([str(ROOT / PRICES), str(ROOT / SCRIPTS)])
+
+
+class FixedRetriever(BaseRetriever):
+    def __init__(self, docs: List[Document]):
+        self.docs = docs
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return list(self.docs)
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return list(self.docs)
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "what is the most important point about biktarvy in the pdf?",
+        "what is biktarvy?",
+        "what is the overall message of the report?",
+    ],
+)
+def test_questions_without_a_number_are_not_computed(store, question):
+    assert store.answer(question) is None
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        f"what is the price of odefsey in {PRICES}",
+        "what is the price of odefsey",
+        "odefsey prices",
+    ],
+)
+def test_price_questions_look_up_the_price_table(store, question):
+    answer = store.answer(question)
+    assert answer.startswith(f"From {PRICES}:")
+    assert "odefsey" in answer
+
+
+def test_revenue_joins_the_price_table(store):
+    answer = store.answer("total revenue of biktarvy in Q1 2023")
+    assert answer.startswith("Sum of weekly TRx")
+    assert "(Q1 2023)" in answer
+    assert "x Q1 price 3,795" in answer
+
+
+def test_named_measure_is_summed(store):
+    answer = store.answer("how many TRx did biktarvy have in Q1 2023")
+    assert answer.startswith("Sum of weekly TRx")
+    assert "BIKTARVY" in answer
+
+
+def test_most_needs_a_quantity(store):
+    assert store.answer("which product sold the most in Q1 2023").startswith("Max")
+    assert store.answer("which product is the most important") is None
+
+
+def test_answer_only_uses_the_given_tables(store):
+    question = "total revenue of biktarvy in Q1 2023"
+    assert store.answer(question, [PRICES]) is None
+
+
+def test_retriever_adds_the_computed_document(store):
+    doc = Document(page_content="from the pdf", metadata={"source": "a.pdf"})
+    retriever = TableRetriever(FixedRetriever([doc]), store, [PRICES, SCRIPTS, "a.pdf"])
+    docs = retriever.get_relevant_documents("total TRx of biktarvy in Q1 2023")
+    assert len(docs) == 2
+    assert docs[0].page_content.startswith("Sum of weekly TRx")
+    assert docs[1] is doc
+    docs = retriever.get_relevant_documents("what does the pdf say about biktarvy")
+    assert docs == [doc]
+
+
+def test_retriever_respects_the_metadata_filter(store):
+    doc = Document(page_content="from the pdf", metadata={"source": "a.pdf"})
+    retriever = TableRetriever(FixedRetriever([doc]), store, [PRICES, SCRIPTS, "a.pdf"])
+    token = metadata_filter.set({"file": "a.pdf"})
+    try:
+        docs = retriever.get_relevant_documents("total TRx of biktarvy in Q1 2023")
+    finally:
+        metadata_filter.reset(token)
+    assert docs == [doc]
+
+
+def test_retriever_only_uses_tables_named_in_the_question(store):
+    retriever = TableRetriever(FixedRetriever([]), store, [PRICES, SCRIPTS, "a.pdf"])
+    question = f"what is the total price of odefsey in {PRICES}"
+    docs = retriever.get_relevant_documents(question)
+    assert docs[0].page_content.startswith(f"From {PRICES}:")
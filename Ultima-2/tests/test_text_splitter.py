@@ -0,0 +1,80 @@
+from typing import List
+
+import pytest
+
+from ultima.fakes import RegexTokenizer
+from ultima.text_splitter import TokenOffsetTextSplitter, token_offsets
+
+TEXT = (
+    "Biktarvy is a complete HIV-1 regimen. It is taken once a day.\n\n"
+    "Odefsey is another regimen, for adults and adolescents.\n"
+    "Descovy is used for PrEP. Prices changed in Q1 2023 for all of them."
+)
+
+
+class ByteTokenizer:
+    # like tiktoken: tokens of up to 3 utf-8 bytes, which can split characters
+    def __init__(self):
+        self.pieces: List[bytes] = []
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        data = text.encode("utf-8")
+        tokens = []
+        for i in range(0, len(data), 3):
+            self.pieces.append(data[i : i + 3])
+            tokens.append(len(self.pieces) - 1)
+        return tokens
+
+    def decode_single_token_bytes(self, token: int) -> bytes:
+        return self.pieces[token]
+
+
+@pytest.mark.parametrize("tokenizer", [RegexTokenizer(), ByteTokenizer()])
+@pytest.mark.parametrize("text", [TEXT, "naïve café – déjà vu " * 8])
+def test_token_offsets_cover_the_text(tokenizer, text):
+    starts, ends = token_offsets(tokenizer, text)
+    assert all(0 <= s < e <= len(text) for s, e in zip(starts, ends))
+    assert starts == sorted(starts)
+    if isinstance(tokenizer, ByteTokenizer):
+        # byte tokens are contiguous, a split character belongs to both tokens
+        assert starts[0] == 0 and ends[-1] == len(text)
+        assert all(s <= e for s, e in zip(starts[1:], ends))
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(8, 0), (12, 4), (200, 0)])
+def test_chunk_offsets_point_into_the_text(chunk_size, chunk_overlap):
+    splitter = TokenOffsetTextSplitter(
+        RegexTokenizer(), chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    docs = splitter.create_documents([TEXT], [{"source": "a.txt"}])
+    assert docs
+    for doc in docs:
+        start, end = doc.metadata["start_index"], doc.metadata["end_index"]
+        assert TEXT[start:end] == doc.page_content
+        assert doc.page_content == doc.page_content.strip()
+        assert len(RegexTokenizer().encode(doc.page_content)) <= chunk_size
+        assert doc.metadata["source"] == "a.txt"
+    starts = [doc.metadata["start_index"] for doc in docs]
+    assert starts == sorted(starts)
+    # every token of the text is in a chunk
+    covered = set()
+    for doc in docs:
+        covered.update(range(doc.metadata["start_index"], doc.metadata["end_index"]))
+    token_starts, _ = token_offsets(RegexTokenizer(), TEXT)
+    assert set(token_starts) <= covered
+
+
+def test_chunks_end_at_separators_when_close():
+    splitter = TokenOffsetTextSplitter(RegexTokenizer(), chunk_size=18, chunk_overlap=0)
+    # the paragraph and the line break are within the last half of the chunks
+    assert splitter.split_text(TEXT) == [
+        "Biktarvy is a complete HIV-1 regimen. It is taken once a day.",
+        "Odefsey is another regimen, for adults and adolescents.",
+        "Descovy is used for PrEP. Prices changed in Q1 2023 for all of them.",
+    ]
+
+
+def test_overlapping_chunks_share_tokens():
+    splitter = TokenOffsetTextSplitter(RegexTokenizer(), chunk_size=10, chunk_overlap=4)
+    offsets = splitter.split_offsets(TEXT)
+    assert all(b[0] < a[1] for a, b in zip(offsets, offsets[1:]))
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ultima.shared_arrtibs import (
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL,
+)
+from ultima.embedding_cache import hash_text
+from ultima.logging import logger
+
+# options that can change the answer to the same question on the same dataset
+ANSWER_OPTIONS = [
+    "k",
+    "fetch_k",
+    "temperature",
+    "max_tokens",
+    "model_n_ctx",
+    "distance_metric",
+    "maximal_marginal_relevance",
+    "mmr_lambda",
+]
+
+
+def get_answer_cache_key(dataset_path: str, options: dict) -> str:
+    # the dataset path already encodes the data source and chunk settings
+    settings = {name: options[name] for name in ANSWER_OPTIONS if name in options}
+    settings["model"] = str(options["model"])
+    digest = hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    return f"{dataset_path}#{digest[:16]}"
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    # unit length question embedding
+    embedding: np.ndarray
+    # tokens and cost of the chain call that produced the answer
+    usage: Dict[str, float] = field(default_factory=dict)
+    created: float = field(default_factory=time.time)
+    hits: int = 0
+
+
+class AnswerCache:
+    # Process-wide answers of the retrieval chain, shared by all sessions.
+    # A question hits when its embedding is at least `threshold` cosine similar
+    # to a cached question asked against the same key (dataset, model and
+    # retrieval settings). Entries expire after `ttl` seconds and the least
+    # recently used ones are dropped beyond `max_entries`.
+
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl: float = ANSWER_CACHE_TTL,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_saved = 0
+        self.cost_saved = 0.0
+        self._entries: "OrderedDict[Tuple[str, str], CachedAnswer]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float) -> None:
+        expired = [k for k, e in self._entries.items() if now - e.created > self.ttl]
+        for entry_key in expired:
+            del self._entries[entry_key]
+        self.evictions += len(expired)
+
+    def get(
+        self, key: str, question: str, embedding: List[float]
+    ) -> Optional[CachedAnswer]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            self._expire(time.time())
+            # the same question, up to whitespace, never needs the vectors
+            entry_key = (key, hash_text(question))
+            if entry_key not in self._entries:
+                candidates = [k for k in self._entries if k[0] == key]
+                entry_key = None
+                if candidates:
+                    matrix = np.stack([self._entries[k].embedding for k in candidates])
+                    similarities = matrix @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        entry_key = candidates[best]
+            if entry_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_key)
+            entry = self._entries[entry_key]
+            entry.hits += 1
+            self.hits += 1
+            self.tokens_saved += entry.usage.get("total_tokens", 0)
+            self.cost_saved += entry.usage.get("total_cost", 0.0)
+        logger.info(f"Answer cache hit for '{question}' -> '{entry.question}'")
+        return entry
+
+    def put(
+        self,
+        key: str,
+        question: str,
+        embedding: List[float],
+        answer: str,
+        usage: Optional[Dict[str, float]] = None,
+    ) -> None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            entry_key = (key, hash_text(question))
+            self._entries[entry_key] = CachedAnswer(question, answer, vector, usage or {})
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, dataset_path: str) -> None:
+        # drops all answers of a dataset, e.g. after it was re-indexed
+        prefix = f"{dataset_path}#"
+        with self._lock:
+            for entry_key in [k for k in self._entries if k[0].startswith(prefix)]:
+                del self._entries[entry_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "tokens_saved": self.tokens_saved,
+                "cost_saved": self.cost_saved,
+            }
+
+
+answer_cache = AnswerCache()
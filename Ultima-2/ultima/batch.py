@@ -0,0 +1,253 @@
+# Headless batch question answering: builds the chain of a data source once,
+# answers a file of questions concurrently and appends one JSON line per
+# question to the output. Running it again with the same output only answers
+# the questions that have no successful answer there yet.
+#
+#   python -m ultima.batch --data-source <path or url> --questions questions.txt
+#   python -m ultima.batch --data-source . --questions q.jsonl --model stub \
+#       --options options.json --output answers.jsonl --concurrency 8
+#
+# Questions are one per line (.txt) or {"id": ..., "question": ...} objects
+# (.jsonl), optionally with a metadata "filter" like the service. The options
+# file holds any keys of utils.get_options, with the model given by name.
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+from typing import Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from ultima.shared_arrtibs import (
+    BATCH_CONCURRENCY,
+    BATCH_RETRIES,
+    BATCH_RETRY_DELAY,
+    BATCH_RETRY_MAX_DELAY,
+    DEFAULT_DATA_SOURCE,
+)
+from ultima.logging import logger
+from ultima.models import MODELS
+from ultima.retrieval_chain import get_default_options, get_env_credentials
+from ultima.service import QuestionAnsweringService
+
+# errors of the OpenAI client worth another attempt, by class name so that
+# offline runs don't import it
+RETRYABLE_ERRORS = {
+    "RateLimitError",
+    "ServiceUnavailableError",
+    "APIConnectionError",
+    "Timeout",
+    "TryAgain",
+}
+
+
+def load_questions(path: str) -> List[dict]:
+    # [{"id": str, "question": str}], ids default to the line number
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                question = {**record, "id": str(record.get("id", number))}
+            else:
+                question = {"id": str(number), "question": line}
+            questions.append(question)
+    return questions
+
+
+def load_options(path: Optional[str], model: Optional[str]) -> dict:
+    # defaults of the model, overridden by the options file
+    overrides = {}
+    if path is not None:
+        with open(path, encoding="utf-8") as f:
+            overrides = json.load(f)
+    model_name = overrides.pop("model", MODELS.GPT4.name)
+    # follows from the model
+    overrides.pop("mode", None)
+    options = get_default_options(MODELS.by_name(model or model_name))
+    unknown = set(overrides) - set(options)
+    if unknown:
+        raise ValueError(f"Unknown options {sorted(unknown)} in {path}")
+    return {**options, **overrides}
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    # ids answered successfully by earlier runs
+    if not os.path.isfile(path):
+        return set()
+    done = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run
+                continue
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    # the delay the API asks for, exponential backoff with jitter otherwise
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    delay = min(BATCH_RETRY_MAX_DELAY, BATCH_RETRY_DELAY * 2**attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        service: QuestionAnsweringService,
+        data_source: str,
+        options: dict,
+        output: str,
+        concurrency: int = BATCH_CONCURRENCY,
+        retries: int = BATCH_RETRIES,
+    ):
+        self.service = service
+        self.data_source = data_source
+        self.options = options
+        self.output = output
+        self.retries = retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # a rate limit hit by one question holds back all of them
+        self._paused_until = 0.0
+
+    async def wait_for_rate_limit(self) -> None:
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def answer(self, question: dict) -> dict:
+        record = {"id": question["id"], "question": question["question"]}
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                await self.wait_for_rate_limit()
+                start = time.perf_counter()
+                try:
+                    result = await self.service.answer(
+                        question["question"],
+                        [],
+                        self.data_source,
+                        self.options,
+                        question.get("filter"),
+                    )
+                except Exception as e:
+                    retryable = type(e).__name__ in RETRYABLE_ERRORS
+                    if not retryable or attempt == self.retries:
+                        logger.error(f"Failed to answer {question['id']}: {e}")
+                        return {
+                            **record,
+                            "status": "error",
+                            "error": f"{type(e).__name__}: {e}",
+                            "attempts": attempt + 1,
+                        }
+                    delay = get_retry_delay(e, attempt)
+                    if type(e).__name__ == "RateLimitError":
+                        self._paused_until = max(
+                            self._paused_until, time.monotonic() + delay
+                        )
+                    logger.warning(
+                        f"{type(e).__name__} for {question['id']}, "
+                        f"retrying in {delay:.1f}s"
+                    )
+                    await asyncio.sleep(delay)
+                    continue
+                return {
+                    **record,
+                    "status": "ok",
+                    "answer": result["answer"],
+                    "sources": result["sources"],
+                    "seconds": time.perf_counter() - start,
+                    "time_to_first_token": result["time_to_first_token"],
+                    "timings": result["timings"],
+                    "usage": result["usage"],
+                    "attempts": attempt + 1,
+                }
+
+    async def run(self, questions: List[dict]) -> List[dict]:
+        done = load_checkpoint(self.output)
+        pending = [q for q in questions if q["id"] not in done]
+        logger.info(
+            f"Answering {len(pending)} questions, {len(questions) - len(pending)} "
+            f"already answered in {self.output}"
+        )
+        # built once up front instead of by the first questions in parallel
+        await self.service.chains.get(self.data_source, self.options)
+        records = []
+        with open(self.output, "a", encoding="utf-8") as f:
+            for task in asyncio.as_completed([self.answer(q) for q in pending]):
+                record = await task
+                # one flushed line per question is the checkpoint
+                f.write(json.dumps(record, default=str) + "\n")
+                f.flush()
+                records.append(record)
+                logger.info(f"{len(records)}/{len(pending)} answered")
+        return records
+
+
+def summarize(records: List[dict]) -> Dict[str, float]:
+    answered = [r for r in records if r["status"] == "ok"]
+    seconds = sorted(r["seconds"] for r in answered)
+    summary = {
+        "questions": len(records),
+        "answered": len(answered),
+        "failed": len(records) - len(answered),
+        "total_tokens": sum(r["usage"].get("total_tokens", 0) for r in answered),
+        "total_cost": sum(r["usage"].get("total_cost", 0.0) for r in answered),
+    }
+    if seconds:
+        summary["p50_seconds"] = statistics.median(seconds)
+        p95 = min(len(seconds) - 1, int(0.95 * len(seconds)))
+        summary["p95_seconds"] = seconds[p95]
+    return summary
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-source", default=DEFAULT_DATA_SOURCE)
+    parser.add_argument("--questions", required=True)
+    parser.add_argument("--output", default="answers.jsonl")
+    parser.add_argument("--options", default=None)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--retries", type=int, default=BATCH_RETRIES)
+    args = parser.parse_args()
+
+    options = load_options(args.options, args.model)
+    service = QuestionAnsweringService(
+        args.data_source,
+        options,
+        get_env_credentials(),
+        max_concurrency=args.concurrency,
+    )
+    runner = BatchRunner(
+        service,
+        args.data_source,
+        options,
+        args.output,
+        concurrency=args.concurrency,
+        retries=args.retries,
+    )
+    records = asyncio.run(runner.run(load_questions(args.questions)))
+    summary = summarize(records)
+    print(json.dumps(summary))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+from typing import Callable, List, Optional, Tuple, Union
+
+from langchain.base_language import BaseLanguageModel
+from langchain.callbacks.manager import Callbacks
+from langchain.chains import LLMChain
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.schema import SystemMessage
+
+from ultima.shared_arrtibs import CHAT_HISTORY_MAX_TOKENS, CHAT_HISTORY_MIN_TURNS
+from ultima.logging import logger
+
+Turn = Tuple[str, str]
+Summarizer = Callable[[str, List[Turn], Callbacks], str]
+
+
+def approximate_tokens(text: str) -> int:
+    # about 4 characters per token for english text, used without a tokenizer
+    return len(text) // 4 + 1
+
+
+def format_turns(turns: List[Turn]) -> str:
+    return "\n".join(f"Human: {question}\nAI: {answer}" for question, answer in turns)
+
+
+def get_summarizer(llm: BaseLanguageModel) -> Summarizer:
+    # extends the summary by the given turns with langchain's summary prompt
+    chain = LLMChain(llm=llm, prompt=SUMMARY_PROMPT)
+    return lambda summary, turns, callbacks=None: chain.predict(
+        summary=summary, new_lines=format_turns(turns), callbacks=callbacks
+    ).strip()
+
+
+class ChatHistory:
+    # Chat history held within a token budget. The latest turns are kept
+    # verbatim, once they exceed `max_tokens` the oldest ones are folded into a
+    # rolling summary (or dropped without a summarizer). Every turn is counted
+    # once when added, the summary once when it changes.
+
+    def __init__(
+        self,
+        max_tokens: int = CHAT_HISTORY_MAX_TOKENS,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        summarize: Optional[Summarizer] = None,
+        min_turns: int = CHAT_HISTORY_MIN_TURNS,
+    ):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or approximate_tokens
+        self.summarize = summarize
+        self.min_turns = min_turns
+        self.clear()
+
+    def clear(self) -> None:
+        self.turns: List[Turn] = []
+        self.turn_tokens: List[int] = []
+        self.summary = ""
+        self.summary_tokens = 0
+        # tokens of all turns ever added, what the history would cost uncompacted
+        self.raw_tokens = 0
+        self.folded_turns = 0
+
+    def __len__(self) -> int:
+        return self.folded_turns + len(self.turns)
+
+    @property
+    def tokens(self) -> int:
+        return self.summary_tokens + sum(self.turn_tokens)
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.raw_tokens - self.tokens
+
+    def append(self, question: str, answer: str, callbacks: Callbacks = None) -> None:
+        # callbacks are passed to the summarizer, e.g. to track its usage
+        tokens = self.count_tokens(question) + self.count_tokens(answer)
+        self.turns.append((question, answer))
+        self.turn_tokens.append(tokens)
+        self.raw_tokens += tokens
+        self.compact(callbacks)
+
+    def compact(self, callbacks: Callbacks = None) -> None:
+        folded = []
+        while self.tokens > self.max_tokens and len(self.turns) > self.min_turns:
+            folded.append(self.turns.pop(0))
+            self.turn_tokens.pop(0)
+        if not folded:
+            return
+        self.folded_turns += len(folded)
+        if self.summarize is None:
+            self.summary, self.summary_tokens = "", 0
+            logger.info(f"Chat history: dropped {len(folded)} turns")
+            return
+        try:
+            # only the new turns are summarized, on top of the previous summary
+            self.summary = self.summarize(self.summary, folded, callbacks)
+        except Exception as e:
+            logger.error(f"Chat history summary failed, dropping turns: {e}")
+        self.summary_tokens = self.count_tokens(self.summary) if self.summary else 0
+        logger.info(
+            f"Chat history: folded {len(folded)} turns into a summary of "
+            f"{self.summary_tokens} tokens"
+        )
+
+    def for_chain(self) -> List[Union[SystemMessage, Turn]]:
+        # chat_history input of ConversationalRetrievalChain
+        if not self.summary:
+            return list(self.turns)
+        summary = SystemMessage(content=f"Summary of the conversation: {self.summary}")
+        return [summary, *self.turns]
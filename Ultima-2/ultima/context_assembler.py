@@ -0,0 +1,182 @@
+import contextvars
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain.schema import BaseRetriever, Document
+
+from ultima.embedding_cache import hash_text
+from ultima.logging import logger
+from ultima.metrics import span
+
+
+@dataclass
+class AssemblyReport:
+    retrieved_chunks: int
+    passages: int
+    packed_passages: int
+    # tokens of the chunks as retrieved
+    retrieved_tokens: int
+    # tokens removed by merging overlaps and dropping duplicates
+    deduplicated_tokens: int
+    # tokens of passages that didn't fit into the budget
+    dropped_tokens: int
+    context_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.retrieved_tokens - self.context_tokens
+
+
+# report of the last assembly in the current thread or task
+last_assembly: contextvars.ContextVar[Optional[AssemblyReport]] = (
+    contextvars.ContextVar("last_assembly", default=None)
+)
+
+
+@dataclass
+class _Passage:
+    doc: Document
+    # best retrieval rank among the merged chunks, lower is better
+    rank: int
+    chunks: int = 1
+
+
+def _span(doc: Document) -> Optional[Tuple[int, int]]:
+    start = doc.metadata.get("start_index")
+    end = doc.metadata.get("end_index")
+    if start is None:
+        return None
+    return start, end if end is not None else start + len(doc.page_content)
+
+
+def get_document_key(doc: Document) -> Tuple:
+    # the document a chunk was split from: offsets of PDF chunks count from the
+    # start of their page, of CSV chunks from the start of their row
+    metadata = doc.metadata
+    return str(metadata.get("source", "")), metadata.get("page"), metadata.get("row")
+
+
+def _overlap_matches(passage: Document, start: int, end: int, doc: Document) -> bool:
+    # the text both cover must be the same, otherwise they are not slices of
+    # one document
+    passage_start = passage.metadata["start_index"]
+    overlap_end = min(end, passage_start + len(passage.page_content))
+    return (
+        passage.page_content[start - passage_start : overlap_end - passage_start]
+        == doc.page_content[: overlap_end - start]
+    )
+
+
+def merge_chunks(docs: List[Document]) -> List[_Passage]:
+    # Merges chunks of the same loaded document whose character spans overlap
+    # or touch. Chunks are exact slices of their document (start_index/end_index
+    # from ultima.text_splitter), so the overlap is cut off by offset, not by
+    # search. Chunks without offsets are never merged.
+    passages: List[_Passage] = []
+    by_document: Dict[Tuple, List[Tuple[int, int, int, Document]]] = {}
+    for rank, doc in enumerate(docs):
+        span = _span(doc)
+        if span is None:
+            passages.append(_Passage(doc, rank))
+        else:
+            by_document.setdefault(get_document_key(doc), []).append(
+                (*span, rank, doc)
+            )
+    for chunks in by_document.values():
+        chunks.sort(key=lambda chunk: chunk[:2])
+        current = None
+        for start, end, rank, doc in chunks:
+            if (
+                current is not None
+                and start <= current_end
+                and _overlap_matches(current.doc, start, end, doc)
+            ):
+                if end > current_end:
+                    tail = doc.page_content[current_end - start :]
+                    current.doc = Document(
+                        page_content=current.doc.page_content + tail,
+                        metadata={**current.doc.metadata, "end_index": end},
+                    )
+                    current_end = end
+                current.rank = min(current.rank, rank)
+                current.chunks += 1
+                continue
+            current, current_end = _Passage(doc, rank), end
+            passages.append(current)
+    return passages
+
+
+def deduplicate(passages: List[_Passage]) -> List[_Passage]:
+    # identical text, e.g. the same boilerplate in several files, is kept once
+    unique: Dict[str, _Passage] = {}
+    for passage in sorted(passages, key=lambda p: p.rank):
+        unique.setdefault(hash_text(passage.doc.page_content), passage)
+    return list(unique.values())
+
+
+def assemble_context(
+    docs: List[Document],
+    max_tokens: int,
+    count_tokens: Callable[[str], int],
+) -> Tuple[List[Document], AssemblyReport]:
+    # merge -> deduplicate -> greedily pack the best ranked passages
+    retrieved_tokens = sum(count_tokens(doc.page_content) for doc in docs)
+    passages = deduplicate(merge_chunks(docs))
+    packed, context_tokens, dropped_tokens = [], 0, 0
+    for passage in passages:
+        tokens = count_tokens(passage.doc.page_content)
+        if context_tokens + tokens > max_tokens:
+            # smaller passages further down may still fit
+            dropped_tokens += tokens
+            continue
+        metadata = {**passage.doc.metadata, "merged_chunks": passage.chunks}
+        packed.append(
+            Document(page_content=passage.doc.page_content, metadata=metadata)
+        )
+        context_tokens += tokens
+    report = AssemblyReport(
+        retrieved_chunks=len(docs),
+        passages=len(passages),
+        packed_passages=len(packed),
+        retrieved_tokens=retrieved_tokens,
+        deduplicated_tokens=retrieved_tokens - context_tokens - dropped_tokens,
+        dropped_tokens=dropped_tokens,
+        context_tokens=context_tokens,
+    )
+    return packed, report
+
+
+class ContextAssemblerRetriever(BaseRetriever):
+    # Sits between the vector store retriever and the stuff prompt, so that
+    # overlapping neighbours and duplicates don't eat into the token budget
+    # and truncation drops the least relevant passages instead of whole tails.
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        max_tokens: int,
+        count_tokens: Callable[[str], int],
+    ):
+        self.retriever = retriever
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+
+    def _assemble(self, docs: List[Document]) -> List[Document]:
+        with span("retrieval.assembly"):
+            packed, report = assemble_context(
+                docs, self.max_tokens, self.count_tokens
+            )
+        last_assembly.set(report)
+        logger.info(
+            f"Context: {report.retrieved_chunks} chunks -> {report.packed_passages} "
+            f"passages, {report.context_tokens}/{report.retrieved_tokens} tokens "
+            f"({report.deduplicated_tokens} deduplicated, {report.dropped_tokens} "
+            f"over budget)"
+        )
+        return packed
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self._assemble(self.retriever.get_relevant_documents(query))
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return self._assemble(await self.retriever.aget_relevant_documents(query))
@@ -0,0 +1,245 @@
+import os
+import shutil
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from langchain.vectorstores.base import VectorStore
+
+from ultima.shared_arrtibs import DATA_PATH, DATASET_DISK_QUOTA
+from ultima.answer_cache import answer_cache
+from ultima.lexical_index import LexicalIndex, get_lexical_index_path
+from ultima.local_vector_store import NumpyVectorStore
+from ultima.logging import logger
+from ultima.manifest import get_manifest_path
+
+
+def get_path_bytes(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def get_dataset_files(dataset_path: str) -> List[Path]:
+    # everything a local dataset keeps under DATA_PATH
+    return [
+        Path(dataset_path),
+        Path(get_lexical_index_path(dataset_path)),
+        get_manifest_path(dataset_path),
+    ]
+
+
+def get_dataset_bytes(dataset_path: str) -> int:
+    files = get_dataset_files(dataset_path)
+    return sum(get_path_bytes(path) for path in files if path.exists())
+
+
+def touch(dataset_path: str) -> None:
+    # the modification time of the dataset directory is its last access on
+    # disk, so the LRU order survives restarts
+    if os.path.isdir(dataset_path):
+        os.utime(dataset_path)
+
+
+@dataclass
+class PooledDataset:
+    # open stores by variant, sessions that embed queries differently, e.g.
+    # with other API keys, don't share a store
+    stores: Dict[str, VectorStore] = field(default_factory=dict)
+    # loaded once for all variants, None for hub datasets without one
+    lexical_index: Optional[LexicalIndex] = None
+    lexical_loaded: bool = False
+    refs: int = 0
+    last_access: float = 0.0
+
+
+class DatasetLease:
+    # A reference to a dataset, held by a session or a pooled chain. It is
+    # released explicitly or when the lease is garbage collected, e.g. with the
+    # state of an ended streamlit session.
+
+    def __init__(self, pool: "DatasetPool", dataset_path: str):
+        self.dataset_path = dataset_path
+        # runs at most once
+        self.release = weakref.finalize(self, pool.release, dataset_path)
+
+
+class DatasetPool:
+    # One open store and lexical index per dataset, shared by all sessions and
+    # chains. Leases count the references to every dataset. Local datasets
+    # beyond the disk quota are deleted least recently used first, datasets in
+    # use are never deleted.
+
+    def __init__(
+        self, quota: Optional[int] = DATASET_DISK_QUOTA, root: Path = DATA_PATH
+    ):
+        self.quota = quota
+        self.root = Path(root)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._datasets: Dict[str, PooledDataset] = {}
+        self._lock = threading.Lock()
+        # one store is opened at a time per dataset, other datasets don't wait
+        self._open_locks: Dict[str, threading.Lock] = {}
+
+    def _entry(self, dataset_path: str) -> PooledDataset:
+        return self._datasets.setdefault(dataset_path, PooledDataset())
+
+    def get(
+        self,
+        dataset_path: str,
+        open_store: Callable[[], VectorStore],
+        variant: str = "",
+    ) -> VectorStore:
+        # the shared read-only store of a dataset, opened on first use
+        with self._lock:
+            open_lock = self._open_locks.setdefault(dataset_path, threading.Lock())
+        with open_lock:
+            with self._lock:
+                entry = self._entry(dataset_path)
+                entry.last_access = time.time()
+                store = entry.stores.get(variant)
+                if store is not None:
+                    self.hits += 1
+                    return store
+                self.misses += 1
+            store = open_store()
+            with self._lock:
+                self._entry(dataset_path).stores[variant] = store
+        touch(dataset_path)
+        return store
+
+    def get_lexical_index(
+        self,
+        dataset_path: str,
+        open_index: Callable[[], Optional[LexicalIndex]],
+    ) -> Optional[LexicalIndex]:
+        # the shared lexical index of a dataset, loaded on first use
+        with self._lock:
+            open_lock = self._open_locks.setdefault(dataset_path, threading.Lock())
+        with open_lock:
+            with self._lock:
+                entry = self._entry(dataset_path)
+                if entry.lexical_loaded:
+                    return entry.lexical_index
+            lexical_index = open_index()
+            with self._lock:
+                entry = self._entry(dataset_path)
+                entry.lexical_index = lexical_index
+                entry.lexical_loaded = True
+        return lexical_index
+
+    def put(
+        self,
+        dataset_path: str,
+        store: VectorStore,
+        variant: str = "",
+        lexical_index: Optional[LexicalIndex] = None,
+    ) -> None:
+        # a store that was just (re)built replaces the shared ones, chains that
+        # use a previous one keep it until they are rebuilt
+        with self._lock:
+            entry = self._entry(dataset_path)
+            entry.stores = {variant: store}
+            entry.lexical_index = lexical_index
+            entry.lexical_loaded = lexical_index is not None
+            entry.last_access = time.time()
+        touch(dataset_path)
+        # not leased yet, but about to be
+        self.enforce_quota(keep=dataset_path)
+
+    def acquire(self, dataset_path: str) -> DatasetLease:
+        with self._lock:
+            self._entry(dataset_path).refs += 1
+        return DatasetLease(self, dataset_path)
+
+    def release(self, dataset_path: str) -> None:
+        with self._lock:
+            entry = self._datasets.get(dataset_path)
+            if entry is None:
+                return
+            entry.refs = max(0, entry.refs - 1)
+            entry.last_access = time.time()
+        touch(dataset_path)
+        self.enforce_quota()
+
+    def list_local_datasets(self) -> Dict[str, float]:
+        # dataset path -> last access of every local dataset on disk
+        if not self.root.is_dir():
+            return {}
+        datasets = {
+            str(path): path.stat().st_mtime
+            for path in self.root.iterdir()
+            if path.is_dir() and NumpyVectorStore.exists(str(path))
+        }
+        with self._lock:
+            for dataset_path, entry in self._datasets.items():
+                if dataset_path in datasets:
+                    datasets[dataset_path] = max(
+                        datasets[dataset_path], entry.last_access
+                    )
+        return datasets
+
+    def bytes_stored(self) -> int:
+        return sum(get_dataset_bytes(p) for p in self.list_local_datasets())
+
+    def evict(self, dataset_path: str) -> int:
+        # deletes a local dataset with its index and manifest, returns the freed bytes
+        freed = get_dataset_bytes(dataset_path)
+        for path in get_dataset_files(dataset_path):
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            elif path.exists():
+                path.unlink(missing_ok=True)
+        with self._lock:
+            self._datasets.pop(dataset_path, None)
+            self.evictions += 1
+        answer_cache.invalidate(dataset_path)
+        logger.info(f"Evicted dataset '{dataset_path}' ({freed / 1024**2:.1f} MB)")
+        return freed
+
+    def enforce_quota(self, keep: Optional[str] = None) -> None:
+        if self.quota is None:
+            return
+        datasets = self.list_local_datasets()
+        datasets.pop(keep, None)
+        total = self.bytes_stored()
+        for dataset_path in sorted(datasets, key=datasets.get):
+            if total <= self.quota:
+                break
+            with self._lock:
+                entry = self._datasets.get(dataset_path)
+                if entry is not None and entry.refs:
+                    continue
+            total -= self.evict(dataset_path)
+        if total > self.quota:
+            logger.warning(
+                f"Datasets in use take {total / 1024**2:.1f} MB, more than the "
+                f"quota of {self.quota / 1024**2:.1f} MB"
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "open": sum(len(e.stores) for e in self._datasets.values()),
+                "referenced": sum(bool(e.refs) for e in self._datasets.values()),
+            }
+        stats["bytes_stored"] = self.bytes_stored()
+        stats["quota"] = self.quota
+        return stats
+
+
+dataset_pool = DatasetPool()
@@ -0,0 +1,134 @@
+import re
+import zlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from ultima.shared_arrtibs import (
+    DEDUP_BANDS,
+    DEDUP_PERMUTATIONS,
+    DEDUP_SHINGLE_SIZE,
+    DEDUP_THRESHOLD,
+)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# prime of the universal hash functions (a * x + b) % p, their products fit
+# into 64 bits with 32 bit shingle hashes
+PRIME = (1 << 31) - 1
+
+
+def get_shingles(text: str, size: int = DEDUP_SHINGLE_SIZE) -> List[str]:
+    # overlapping word n-grams, case and whitespace don't matter
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    if len(tokens) <= size:
+        return [" ".join(tokens)]
+    return [" ".join(tokens[i : i + size]) for i in range(len(tokens) - size + 1)]
+
+
+class MinHasher:
+    # MinHash signatures, the fraction of equal values of two signatures
+    # estimates the Jaccard similarity of the shingle sets of their texts
+
+    def __init__(self, permutations: int = DEDUP_PERMUTATIONS, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, permutations, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, permutations, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) % PRIME for s in set(get_shingles(text))),
+            dtype=np.uint64,
+        )
+        values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % PRIME
+        return values.min(axis=1).astype(np.uint32)
+
+
+def estimate_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+class LSHIndex:
+    # Banded locality sensitive hashing: signatures equal in all rows of any
+    # band are candidates, pairs below the threshold rarely are.
+
+    def __init__(self, bands: int = DEDUP_BANDS):
+        self.bands = bands
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+    def _keys(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in np.array_split(signature, self.bands)]
+
+    def add(self, key: int, signature: np.ndarray) -> None:
+        for buckets, band in zip(self._buckets, self._keys(signature)):
+            buckets.setdefault(band, []).append(key)
+
+    def query(self, signature: np.ndarray) -> List[int]:
+        candidates = set()
+        for buckets, band in zip(self._buckets, self._keys(signature)):
+            candidates.update(buckets.get(band, ()))
+        return sorted(candidates)
+
+
+@dataclass
+class DedupReport:
+    chunks: int = 0
+    duplicates: int = 0
+    # characters of the dropped chunks, which are neither embedded nor stored
+    duplicate_chars: int = 0
+
+    def add(self, other: "DedupReport") -> None:
+        self.chunks += other.chunks
+        self.duplicates += other.duplicates
+        self.duplicate_chars += other.duplicate_chars
+
+
+def get_provenance(metadata: dict) -> dict:
+    return {"source": metadata.get("source"), "page": metadata.get("page")}
+
+
+def merge_provenance(kept: Document, duplicate: Document) -> None:
+    # the kept chunk records how many chunks it stands for, and the source and
+    # page of every one of them that differs from its own
+    metadata = kept.metadata
+    metadata["duplicates"] = metadata.get("duplicates", 0) + 1
+    provenance = get_provenance(duplicate.metadata)
+    if provenance == get_provenance(metadata):
+        return
+    merged = metadata.setdefault("duplicate_provenance", [])
+    if provenance not in merged:
+        merged.append(provenance)
+
+
+def deduplicate_chunks(
+    chunks: List[Document],
+    threshold: float = DEDUP_THRESHOLD,
+    hasher: Optional[MinHasher] = None,
+) -> Tuple[List[Document], DedupReport]:
+    # Keeps the first of every group of near-duplicate chunks, in order. The
+    # candidates of the LSH index are confirmed by their estimated similarity.
+    hasher = hasher or MinHasher()
+    index = LSHIndex()
+    kept: List[Document] = []
+    signatures: List[np.ndarray] = []
+    report = DedupReport(chunks=len(chunks))
+    for chunk in chunks:
+        signature = hasher.signature(chunk.page_content)
+        match = next(
+            (
+                i
+                for i in index.query(signature)
+                if estimate_similarity(signature, signatures[i]) >= threshold
+            ),
+            None,
+        )
+        if match is not None:
+            merge_provenance(kept[match], chunk)
+            report.duplicates += 1
+            report.duplicate_chars += len(chunk.page_content)
+            continue
+        index.add(len(kept), signature)
+        kept.append(chunk)
+        signatures.append(signature)
+    return kept, report
@@ -0,0 +1,169 @@
+import asyncio
+import contextvars
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores.base import VectorStore
+
+from ultima.local_vector_store import NumpyVectorStore
+from ultima.logging import logger
+from ultima.metrics import span
+from ultima.mmr import batch_maximal_marginal_relevance
+from ultima.partitions import Partitions
+
+
+class DeepLakeIndex:
+    # Row access to the dataset of a langchain DeepLake store. langchain applies
+    # filters with a python function on every sample of the dataset, this keeps
+    # the rows of every file like NumpyVectorStore does and only reads the
+    # embedding tensor at the rows of the filtered files.
+    # The metadata is read once, and again when the dataset changed size.
+
+    def __init__(self, vector_store: VectorStore):
+        self.ds = vector_store.ds
+        self._partitions: Optional[Partitions] = None
+        self._rows: Dict[str, int] = {}
+        self._size = -1
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ds)
+
+    def _refresh(self) -> None:
+        with self._lock:
+            if self._partitions is not None and self._size == len(self.ds):
+                return
+            self._size = len(self.ds)
+            metadatas, ids = [], []
+            if self._size:
+                metadatas = self.ds.metadata.data()["value"]
+                ids = self.ds.ids.data()["value"]
+            self._partitions = Partitions(metadatas)
+            self._rows = {id_: row for row, id_ in enumerate(ids)}
+            logger.info(f"Indexed {len(self._partitions)} files of {self._size} rows")
+
+    @property
+    def partitions(self) -> Partitions:
+        self._refresh()
+        return self._partitions
+
+    def get_rows(self, ids: List[str]) -> List[Optional[int]]:
+        self._refresh()
+        return [self._rows.get(id_) for id_ in ids]
+
+    def search(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        distance_metric: str = "cos",
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[int, float]]:
+        # (row, distance or similarity) of the k nearest rows, by the metrics
+        # of DeepLake's own search
+        from langchain.vectorstores.deeplake import vector_search
+
+        rows = self.partitions.rows(filter)
+        if not len(self) or (rows is not None and not len(rows)):
+            return []
+        if rows is None:
+            embeddings = self.ds.embedding.numpy(fetch_chunks=True)
+        else:
+            embeddings = self.ds.embedding[rows.tolist()].numpy(fetch_chunks=True)
+        indices, scores = vector_search(
+            np.asarray(embedding, dtype=np.float32),
+            embeddings,
+            distance_metric=distance_metric.lower(),
+            k=k,
+        )
+        if rows is not None:
+            indices = rows[indices].tolist()
+        return list(zip(indices, scores))
+
+    def get_documents(self, rows: List[int]) -> List[Document]:
+        if not rows:
+            return []
+        texts = self.ds.text[list(rows)].data()["value"]
+        metadatas = self.partitions.metadatas
+        return [
+            Document(page_content=text, metadata=metadatas[row])
+            for row, text in zip(rows, texts)
+        ]
+
+    def get_embeddings(self, rows: List[int]) -> np.ndarray:
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32)
+        return self.ds.embedding[list(rows)].numpy(fetch_chunks=True)
+
+
+_indexes: "weakref.WeakKeyDictionary[VectorStore, DeepLakeIndex]" = (
+    weakref.WeakKeyDictionary()
+)
+_indexes_lock = threading.Lock()
+
+
+def get_row_index(
+    vector_store: VectorStore,
+) -> Union[NumpyVectorStore, DeepLakeIndex]:
+    # the local store is its own row index, DeepLake stores share one per store
+    if isinstance(vector_store, NumpyVectorStore):
+        return vector_store
+    with _indexes_lock:
+        index = _indexes.get(vector_store)
+        if index is None:
+            index = _indexes[vector_store] = DeepLakeIndex(vector_store)
+        return index
+
+
+class DeepLakeRetriever(BaseRetriever):
+    # Searches a DeepLake store through its row index, filters included, and
+    # selects k of the fetch_k nearest chunks with the batched MMR engine
+    # instead of DeepLake's per-step loop.
+
+    def __init__(
+        self, vector_store: VectorStore, embeddings: Embeddings, search_kwargs: dict
+    ):
+        self.vector_store = vector_store
+        # embeds the query, candidates are compared by their stored vectors
+        self.embeddings = embeddings
+        self.search_kwargs = search_kwargs
+
+    def with_search_kwargs(self, search_kwargs: dict) -> "DeepLakeRetriever":
+        return DeepLakeRetriever(self.vector_store, self.embeddings, search_kwargs)
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        k = self.search_kwargs["k"]
+        mmr = self.search_kwargs["maximal_marginal_relevance"]
+        index = get_row_index(self.vector_store)
+        with span("retrieval.vector"):
+            query_embedding = self.embeddings.embed_query(query)
+            results = index.search(
+                query_embedding,
+                k=max(self.search_kwargs["fetch_k"], k) if mmr else k,
+                distance_metric=self.search_kwargs["distance_metric"],
+                filter=self.search_kwargs.get("filter"),
+            )
+            rows = [row for row, _ in results]
+            candidates = index.get_documents(rows)
+        if len(candidates) <= k:
+            return candidates
+        with span("retrieval.mmr"):
+            selected = batch_maximal_marginal_relevance(
+                np.asarray(query_embedding, dtype=np.float32).reshape(1, -1),
+                [index.get_embeddings(rows)],
+                lambda_mult=self.search_kwargs["lambda_mult"],
+                k=k,
+            )[0]
+        return [candidates[i] for i in selected]
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        # the worker thread records its spans into the trace of this task
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, context.run, self.get_relevant_documents, query
+        )
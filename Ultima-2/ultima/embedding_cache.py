@@ -0,0 +1,184 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from langchain.embeddings.base import Embeddings
+
+from ultima.shared_arrtibs import EMBEDDING_CACHE_MAX_BYTES, EMBEDDING_CACHE_PATH
+from ultima.logging import logger
+
+
+def normalize_text(text: str) -> str:
+    # whitespace and unicode variations must not produce new cache entries
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    # Persistent (model, text hash) -> vector store with LRU eviction.
+    # One sqlite file is shared by all datasets and chunk settings.
+
+    def __init__(
+        self,
+        path: Path = EMBEDDING_CACHE_PATH,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+    ):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.path.parent, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_access)"
+        )
+        self._connection.commit()
+        self.size_bytes = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, model: str, text_hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique_hashes = list(dict.fromkeys(text_hashes))
+        with self._lock:
+            # stay well below sqlite's bound parameter limit
+            for i in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[i : i + 500]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = array("f", blob).tolist()
+            now = time.time()
+            self._connection.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                [(now, model, h) for h in found],
+            )
+            self._connection.commit()
+            hits = sum(h in found for h in text_hashes)
+            self.hits += hits
+            self.misses += len(text_hashes) - hits
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        now = time.time()
+        rows = [(model, h, array("f", v).tobytes(), now) for h, v in vectors.items()]
+        with self._lock:
+            for _, text_hash, blob, _ in rows:
+                previous = self._connection.execute(
+                    "SELECT LENGTH(vector) FROM embeddings WHERE model = ? AND text_hash = ?",
+                    (model, text_hash),
+                ).fetchone()
+                self.size_bytes += len(blob) - (previous[0] if previous else 0)
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self) -> None:
+        # drop least recently used vectors until the size cap is met again
+        while self.size_bytes > self.max_bytes:
+            rows = self._connection.execute(
+                "SELECT model, text_hash, LENGTH(vector) FROM embeddings "
+                "ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self.size_bytes = 0
+                break
+            for model, text_hash, size in rows:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE model = ? AND text_hash = ?",
+                    (model, text_hash),
+                )
+                self.size_bytes -= size
+                self.evictions += 1
+                if self.size_bytes <= self.max_bytes:
+                    break
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    # one cache per process, shared by every session
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps any langchain embeddings so previously seen chunks are never re-embedded
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model: str,
+        cache: Optional[EmbeddingCache] = None,
+    ):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache or get_embedding_cache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        found = self.cache.get_many(self.model, text_hashes)
+        missing = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in found and text_hash not in missing:
+                missing[text_hash] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model, new)
+            found.update(new)
+        logger.info(f"Embedding cache: embedded {len(missing)} of {len(texts)} chunks")
+        return [found[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        # queries use a different instruction than documents, never mix them
+        model = f"{self.model}#query"
+        text_hash = hash_text(text)
+        found = self.cache.get_many(model, [text_hash])
+        if text_hash not in found:
+            found[text_hash] = self.embeddings.embed_query(text)
+            self.cache.put_many(model, found)
+        return found[text_hash]
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+from ultima.shared_arrtibs import (
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_MAX_BATCH_SIZE,
+    EMBEDDING_WORKERS,
+)
+from ultima.chat_history import approximate_tokens
+from ultima.logging import logger
+
+
+def set_torch_threads(workers: int) -> None:
+    # every worker runs its batch with its share of the cores, torch would
+    # otherwise start one thread per core in each of them
+    if "torch" not in sys.modules:
+        return
+    import torch
+
+    threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    if torch.get_num_threads() != threads:
+        torch.set_num_threads(threads)
+        logger.info(f"Embedding with {workers} workers x {threads} torch threads")
+
+
+class BatchedEmbeddings(Embeddings):
+    # Embeds documents with a local model in batches of similar length, so
+    # little compute goes to padding, on a pool of worker threads. A batch
+    # holds as many texts as fit into `max_batch_tokens` padded tokens. Models
+    # with a sentence-transformers client are called directly, with the
+    # instruction of instructor models, so they don't split batches again.
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        workers: int = EMBEDDING_WORKERS,
+        max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+    ):
+        self.embeddings = embeddings
+        self.workers = workers
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        set_torch_threads(workers)
+
+    @property
+    def instruction(self) -> str:
+        return getattr(self.embeddings, "embed_instruction", "") or ""
+
+    def get_batches(self, texts: List[str]) -> List[List[int]]:
+        # indices of texts, longest first, the first text of a batch is its longest
+        extra = approximate_tokens(self.instruction) if self.instruction else 0
+        tokens = [approximate_tokens(text) + extra for text in texts]
+        batches: List[List[int]] = []
+        for i in sorted(range(len(texts)), key=lambda i: -tokens[i]):
+            batch = batches[-1] if batches else None
+            if (
+                batch is None
+                or len(batch) >= self.max_batch_size
+                or (len(batch) + 1) * tokens[batch[0]] > self.max_batch_tokens
+            ):
+                batches.append([i])
+            else:
+                batch.append(i)
+        return batches
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        client = getattr(self.embeddings, "client", None)
+        if not hasattr(client, "encode"):
+            return self.embeddings.embed_documents(texts)
+        inputs = [[self.instruction, t] for t in texts] if self.instruction else texts
+        kwargs = getattr(self.embeddings, "encode_kwargs", None) or {}
+        return client.encode(inputs, **{**kwargs, "batch_size": len(texts)}).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        start = time.perf_counter()
+        batches = self.get_batches(texts)
+        vectors: List[List[float]] = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(batches))) as pool:
+            results = pool.map(lambda b: self._encode([texts[i] for i in b]), batches)
+            for batch, batch_vectors in zip(batches, results):
+                for i, vector in zip(batch, batch_vectors):
+                    vectors[i] = vector
+        seconds = time.perf_counter() - start
+        logger.info(
+            f"Embedded {len(texts)} chunks in {len(batches)} batches in "
+            f"{seconds:.2f}s ({len(texts) / max(seconds, 1e-9):.1f} chunks/s)"
+        )
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+# Deterministic stand-ins for the model backends, used by the OFFLINE mode to
+# run the service, batch jobs and benchmarks without network or model weights.
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+CONTEXT_PATTERN = re.compile(r"make up an answer\.\n\n(.*?)\n\nQuestion:", re.S)
+QUESTION_PATTERN = re.compile(r"(?:Question|Follow Up Input): (.*?)\n", re.S)
+# the summary prompt contains an example, only the last summary counts
+SUMMARY_PATTERN = re.compile(
+    r".*Current summary:\n(.*)\n\nNew lines of conversation:\n(.*)\n\nNew summary:",
+    re.S,
+)
+
+
+def _bucket(token: str, size: int) -> int:
+    digest = hashlib.blake2b(token.lower().encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % size
+
+
+class HashingEmbeddings(Embeddings):
+    # Bag of words feature hashing: texts sharing words get similar vectors,
+    # which is enough for retrieval to behave sensibly in tests.
+
+    def __init__(self, size: int = 256):
+        self.size = size
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in TOKEN_PATTERN.findall(text):
+            vector[_bucket(token, self.size)] += 1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class RegexTokenizer:
+    # Words and punctuation as tokens, with the interface of a huggingface fast
+    # tokenizer as far as ultima.text_splitter uses it.
+    is_fast = True
+
+    def __call__(self, text: str, **kwargs: Any) -> Dict[str, List]:
+        matches = list(TOKEN_PATTERN.finditer(text))
+        return {
+            "input_ids": [_bucket(m.group(), 2**31) for m in matches],
+            "offset_mapping": [m.span() for m in matches],
+        }
+
+    def encode(self, text: str, **kwargs: Any) -> List[int]:
+        return self(text)["input_ids"]
+
+
+class StubLLM(LLM):
+    # Answers with the question and the start of the retrieved context, passes
+    # the question through when asked to condense a follow-up question and
+    # appends the questions to the summary when asked to summarize.
+    # Every word is reported as a streamed token, optionally `delay` seconds
+    # apart to simulate generation latency.
+
+    delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def get_num_tokens(self, text: str) -> int:
+        # the default would load the GPT-2 tokenizer from huggingface
+        return len(TOKEN_PATTERN.findall(text))
+
+    def _answer(self, prompt: str) -> str:
+        summary = SUMMARY_PATTERN.search(prompt)
+        if summary:
+            questions = re.findall(r"^Human: (.*)$", summary.group(2), re.M)
+            return f"{summary.group(1)} The human asked: {'; '.join(questions)}.".strip()
+        questions = QUESTION_PATTERN.findall(prompt + "\n")
+        question = questions[-1].strip() if questions else prompt.strip()
+        if "Standalone question:" in prompt:
+            return question
+        context = CONTEXT_PATTERN.search(prompt)
+        context = " ".join(context.group(1).split()[:24]) if context else ""
+        return f"Stub answer to '{question}' from: {context}"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        answer = self._answer(prompt)
+        for token in re.split(r"(?<= )", answer):
+            if self.delay:
+                time.sleep(self.delay)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return answer
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        answer = self._answer(prompt)
+        for token in re.split(r"(?<= )", answer):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+        return answer
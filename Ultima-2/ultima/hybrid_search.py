@@ -0,0 +1,136 @@
+import asyncio
+import contextvars
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores.base import VectorStore
+
+from ultima.shared_arrtibs import RRF_K
+from ultima.deeplake_index import get_row_index
+from ultima.embedding_cache import hash_text
+from ultima.lexical_index import LexicalIndex
+from ultima.logging import logger
+from ultima.metrics import span
+from ultima.mmr import maximal_marginal_relevance
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[str]], k: int = RRF_K
+) -> List[Tuple[str, float]]:
+    # sum of 1 / (k + rank) over all rankings, best first
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class HybridRetriever(BaseRetriever):
+    # Fuses the fetch_k best chunks of the vector store and of the BM25 index
+    # with reciprocal rank fusion, then selects k of them by MMR with the fused
+    # score as relevance. Exact terms like product names and codes are found
+    # even when their embeddings are not close to the question.
+
+    def __init__(
+        self,
+        vector_store: VectorStore,
+        lexical_index: LexicalIndex,
+        embeddings: Embeddings,
+        search_kwargs: dict,
+    ):
+        self.vector_store = vector_store
+        self.lexical_index = lexical_index
+        # embeds the query, candidates are compared by their stored vectors
+        self.embeddings = embeddings
+        self.search_kwargs = search_kwargs
+
+    def with_search_kwargs(self, search_kwargs: dict) -> "HybridRetriever":
+        return HybridRetriever(
+            self.vector_store, self.lexical_index, self.embeddings, search_kwargs
+        )
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        k = self.search_kwargs["k"]
+        fetch_k = max(self.search_kwargs["fetch_k"], k)
+        # both searches are restricted to the chunks of the filtered files
+        filter = self.search_kwargs.get("filter")
+        with span("retrieval.vector"):
+            query_embedding = self.embeddings.embed_query(query)
+            index = get_row_index(self.vector_store)
+            results = index.search(
+                query_embedding,
+                k=fetch_k,
+                distance_metric=self.search_kwargs["distance_metric"],
+                filter=filter,
+            )
+            vector_rows = [row for row, _ in results]
+            vector_docs = index.get_documents(vector_rows)
+        with span("retrieval.keyword"):
+            matches = [i for i, _ in self.lexical_index.search(query, fetch_k, filter)]
+            lexical_docs = self.lexical_index.get_documents(matches)
+            # chunks have the same ids in the index and in the store
+            lexical_rows = index.get_rows([self.lexical_index.ids[i] for i in matches])
+        docs: Dict[str, Document] = {}
+        # row in the store of every candidate, None if the store lacks it
+        rows: Dict[str, Optional[int]] = {}
+        rankings = []
+        for results, result_rows in (
+            (vector_docs, vector_rows),
+            (lexical_docs, lexical_rows),
+        ):
+            ranking = []
+            for doc, row in zip(results, result_rows):
+                key = hash_text(doc.page_content)
+                docs.setdefault(key, doc)
+                if rows.get(key) is None:
+                    rows[key] = row
+                ranking.append(key)
+            rankings.append(ranking)
+        fused = reciprocal_rank_fusion(rankings)[:fetch_k]
+        logger.info(
+            f"Hybrid search: {len(vector_docs)} vector and {len(lexical_docs)} "
+            f"keyword results, {len(docs) - len(vector_docs)} only found by keywords"
+        )
+        candidates = [docs[key] for key, _ in fused]
+        if not self.search_kwargs["maximal_marginal_relevance"]:
+            return candidates[:k]
+        scores = np.array([score for _, score in fused], dtype=np.float32)
+        with span("retrieval.mmr"):
+            candidate_rows = [rows[key] for key, _ in fused]
+            selected = maximal_marginal_relevance(
+                np.asarray(query_embedding, dtype=np.float32),
+                self._get_embeddings(index, candidate_rows, candidates),
+                lambda_mult=self.search_kwargs["lambda_mult"],
+                k=k,
+                # on the scale of cosine similarities for the diversity trade-off
+                relevance_scores=scores / scores.max() if len(scores) else scores,
+            )
+        return [candidates[i] for i in selected]
+
+    def _get_embeddings(
+        self, index: Any, rows: List[Optional[int]], candidates: List[Document]
+    ) -> np.ndarray:
+        # stored vectors of the candidates, chunks the store lacks, e.g. when
+        # the lexical index is out of sync with it, are embedded again
+        found = [i for i, row in enumerate(rows) if row is not None]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        stored = index.get_embeddings([rows[i] for i in found])
+        if not missing:
+            return stored
+        texts = [candidates[i].page_content for i in missing]
+        embedded = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        vectors = np.empty((len(rows), embedded.shape[1]), dtype=np.float32)
+        if found:
+            vectors[found] = stored
+        vectors[missing] = embedded
+        return vectors
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        # the worker thread records its spans into the trace of this task
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, context.run, self.get_relevant_documents, query
+        )
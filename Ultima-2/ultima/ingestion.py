@@ -0,0 +1,283 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+
+from ultima.shared_arrtibs import ENABLE_DEDUP, INGEST_BATCH_SIZE, INGEST_MEMORY_LIMIT
+from ultima.dedup import DedupReport, MinHasher, deduplicate_chunks
+from ultima.lexical_index import LexicalIndex
+from ultima.load_data import (
+    LoadFailure,
+    Source,
+    get_text_splitter,
+    iter_load_files,
+    iter_load_uploads,
+)
+from ultima.local_vector_store import NumpyVectorStore
+from ultima.logging import logger
+from ultima.metrics import span, timed
+from ultima.partitions import get_file
+
+
+@dataclass
+class IngestProgress:
+    stage: str
+    files_done: int
+    files_total: int
+    chunks_done: int
+
+    @property
+    def fraction(self) -> float:
+        return self.files_done / self.files_total if self.files_total else 1.0
+
+
+ProgressCallback = Callable[[IngestProgress], None]
+
+
+@dataclass
+class IngestReport:
+    # chunk ids per file name, in upsert order
+    ids: Dict[str, List[str]] = field(default_factory=dict)
+    failures: List[LoadFailure] = field(default_factory=list)
+    chunks: int = 0
+    seconds: float = 0.0
+    # seconds spent embedding and storing the chunks
+    embed_seconds: float = 0.0
+    dedup: DedupReport = field(default_factory=DedupReport)
+    # estimated index bytes of the dropped duplicates, text and vectors
+    index_bytes_saved: int = 0
+
+    @property
+    def embed_seconds_saved(self) -> float:
+        # at the measured time per stored chunk
+        if not self.chunks:
+            return 0.0
+        return self.embed_seconds / self.chunks * self.dedup.duplicates
+
+
+class BoundedBuffer:
+    # FIFO between the loading thread and the embedding loop. Producers block
+    # while the buffered text exceeds max_bytes, which is what keeps memory flat
+    # when loading is faster than embedding.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.closed = False
+        self._items = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item, size: int) -> bool:
+        with self._condition:
+            # an oversized item is still accepted once the buffer is empty
+            self._condition.wait_for(
+                lambda: self.closed
+                or not self._items
+                or self.size + size <= self.max_bytes
+            )
+            if self.closed:
+                return False
+            self._items.append((item, size))
+            self.size += size
+            self._condition.notify_all()
+            return True
+
+    def get(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._items)
+            item, size = self._items.popleft()
+            self.size -= size
+            self._condition.notify_all()
+            return item
+
+    def close(self) -> None:
+        # unblocks and stops the producer when the consumer gives up early
+        with self._condition:
+            self.closed = True
+            self._items.clear()
+            self._condition.notify_all()
+
+
+_DONE = object()
+
+
+def _produce(items: Iterable, buffer: BoundedBuffer) -> None:
+    try:
+        for item in items:
+            _, docs, _ = item
+            if not buffer.put(item, sum(len(doc.page_content) for doc in docs)):
+                return
+        buffer.put(_DONE, 0)
+    except BaseException as e:
+        buffer.put(e, 0)
+
+
+def iter_buffered(
+    items: Iterable[Tuple[str, List[Document], Optional[LoadFailure]]],
+    memory_limit: int = INGEST_MEMORY_LIMIT,
+) -> Iterator[Tuple[str, List[Document], Optional[LoadFailure]]]:
+    # loads ahead on a background thread, bounded by memory_limit bytes of text
+    buffer = BoundedBuffer(memory_limit)
+    producer = threading.Thread(target=_produce, args=(items, buffer), daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        buffer.close()
+
+
+@timed("ingest")
+def ingest(
+    vector_store: VectorStore,
+    sources: Iterable[Tuple[str, List[Document], Optional[LoadFailure]]],
+    total: int,
+    options: dict,
+    chunk_id: Optional[Callable[[str, int], str]] = None,
+    progress: Optional[ProgressCallback] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+    memory_limit: int = INGEST_MEMORY_LIMIT,
+    lexical_index: Optional[LexicalIndex] = None,
+) -> IngestReport:
+    # Streams (name, documents, failure) items through split -> embed -> upsert.
+    # Only the current batch of chunks and memory_limit bytes of loaded text are
+    # held in memory at any time, independent of the size of the data source.
+    start = time.perf_counter()
+    report = IngestReport()
+    text_splitter = get_text_splitter(options)
+    batch: List[Document] = []
+    batch_ids: List[str] = []
+    files_done = 0
+    hasher = MinHasher() if ENABLE_DEDUP else None
+
+    def notify(stage: str) -> None:
+        if progress is not None:
+            progress(IngestProgress(stage, files_done, total, report.chunks))
+
+    def flush() -> None:
+        if not batch:
+            return
+        notify("embedding")
+        embed_start = time.perf_counter()
+        with span("ingest.embed_and_store"):
+            added = vector_store.add_documents(
+                batch, ids=batch_ids if chunk_id else None
+            )
+        report.embed_seconds += time.perf_counter() - embed_start
+        if lexical_index is not None:
+            texts = [doc.page_content for doc in batch]
+            lexical_index.add(added, texts, [doc.metadata for doc in batch])
+        report.chunks += len(batch)
+        batch.clear()
+        batch_ids.clear()
+
+    notify("loading")
+    for name, docs, failure in iter_buffered(sources, memory_limit):
+        files_done += 1
+        if failure is not None:
+            logger.error(f"failed to load {failure.path}: {failure.error}")
+            report.failures.append(failure)
+            notify("loading")
+            continue
+        ids = report.ids.setdefault(name, [])
+        chunks = text_splitter.split_documents(docs)
+        if hasher is not None:
+            # within a file only, so that rebuilding or deleting one file never
+            # takes chunks standing for other files with it
+            with span("ingest.dedup"):
+                chunks, dedup = deduplicate_chunks(chunks, hasher=hasher)
+            report.dedup.add(dedup)
+        for chunk in chunks:
+            # the partition of the chunk, documents without a name, e.g. web
+            # pages, are partitioned by their source
+            chunk.metadata["file"] = name or get_file(chunk.metadata)
+            if chunk_id:
+                # stable ids let later rebuilds delete exactly the chunks of a file
+                batch_ids.append(chunk_id(name, len(ids)))
+                ids.append(batch_ids[-1])
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                flush()
+        notify("loading")
+    flush()
+    report.seconds = time.perf_counter() - start
+    notify("done")
+    logger.info(
+        f"Ingested {report.chunks} chunks from {files_done - len(report.failures)}/"
+        f"{total} files in {report.seconds:.1f}s"
+    )
+    if report.dedup.duplicates:
+        log_dedup(report, vector_store)
+    return report
+
+
+def log_dedup(report: IngestReport, vector_store: VectorStore) -> None:
+    # vector bytes are known for local stores only
+    row_bytes = 0.0
+    if isinstance(vector_store, NumpyVectorStore) and len(vector_store):
+        row_bytes = vector_store.index_bytes() / len(vector_store)
+    dedup = report.dedup
+    report.index_bytes_saved = int(dedup.duplicates * row_bytes) + dedup.duplicate_chars
+    logger.info(
+        f"Dropped {dedup.duplicates}/{dedup.chunks} near-duplicate chunks "
+        f"({dedup.duplicates / dedup.chunks:.0%}), saving ~"
+        f"{report.embed_seconds_saved:.1f}s of embedding and ~"
+        f"{report.index_bytes_saved / 1024**2:.2f} MB of index"
+    )
+
+
+def ingest_files(
+    vector_store: VectorStore,
+    files: Dict[str, Source],
+    options: dict,
+    chunk_id: Optional[Callable[[str, int], str]] = None,
+    progress: Optional[ProgressCallback] = None,
+    lexical_index: Optional[LexicalIndex] = None,
+) -> IngestReport:
+    # files maps names to paths, documents are loaded in parallel and in order,
+    # or to uploads which are loaded from memory in this process
+    paths = list(files.values())
+    if all(isinstance(path, str) for path in paths):
+        loaded = iter_load_files(paths)
+    else:
+        loaded = iter_load_uploads(paths)
+    # both yield in input order
+    sources = (
+        (name, docs, failure) for name, (_, docs, failure) in zip(files, loaded)
+    )
+    return ingest(
+        vector_store,
+        sources,
+        len(files),
+        options,
+        chunk_id,
+        progress,
+        lexical_index=lexical_index,
+    )
+
+
+def ingest_documents(
+    vector_store: VectorStore,
+    docs: List[Document],
+    options: dict,
+    progress: Optional[ProgressCallback] = None,
+    lexical_index: Optional[LexicalIndex] = None,
+) -> IngestReport:
+    # for sources that can't be streamed per file, e.g. web pages
+    return ingest(
+        vector_store,
+        [("", docs, None)],
+        1,
+        options,
+        progress=progress,
+        lexical_index=lexical_index,
+    )
@@ -1,11 +1,13 @@
+import hashlib
 import io
 import os
 import re
 import shutil
+import weakref
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List
 
-from ultima.shared_arrtibs import DATA_PATH
+from ultima.shared_arrtibs import UPLOAD_COPY_BLOCK_SIZE
 from ultima.logging import logger
 
 
@@ -25,43 +27,36 @@ def concatenate_file_names(strings: List[str], n_max: int = 30) -> str:
     return clean_string_for_storing(result)
 
 
-def get_data_source_and_save_path(
-    files: List[io.BytesIO],
-) -> Tuple[str, Path]:
-    if len(files) > 1:
-        path = DATA_PATH / concatenate_file_names([f.name for f in files])
-        data_source = path
-    else:
-        path = DATA_PATH
-        data_source = path / files[0].name
-    if not os.path.exists(path):
-        os.makedirs(path)
-    return str(data_source), path
+# content hash per upload by id, computed once when the upload arrives and
+# dropped with it; streamlit's UploadedFile defines __eq__ without __hash__
+_upload_hashes: Dict[int, str] = {}
 
 
-def save_file(file: io.BytesIO, path: Path):
-    file_path = str(path / file.name)
-    file.seek(0)
-    file_bytes = file.read()
-    file = open(file_path, "wb")
-    file.write(file_bytes)
-    file.close()
-    logger.info(f"Saved: {file_path}")
+def hash_upload(file: io.BytesIO) -> str:
+    # sha256 of the buffer contents, without copying them
+    key = id(file)
+    if key not in _upload_hashes:
+        with file.getbuffer() as view:
+            _upload_hashes[key] = hashlib.sha256(view).hexdigest()
+        weakref.finalize(file, _upload_hashes.pop, key, None)
+    return _upload_hashes[key]
 
 
-def save_files(files: List[io.BytesIO]) -> str:
-    data_source, save_path = get_data_source_and_save_path(files)
-    for file in files:
-        save_file(file, save_path)
-    return data_source
+def get_upload_data_source(files: List[io.BytesIO]) -> str:
+    # Named by file names and contents, identical uploads of any session map
+    # to the same dataset and are not loaded again.
+    digest = hashlib.sha256()
+    for file in sorted(files, key=lambda f: f.name):
+        digest.update(f"{file.name}\0{hash_upload(file)}\0".encode("utf-8"))
+    names = concatenate_file_names([f.name for f in files])
+    return f"upload://{names}-{digest.hexdigest()[:16]}"
 
 
-def delete_files(files: List[io.BytesIO]) -> None:
-    data_source, _ = get_data_source_and_save_path(files)
-    if os.path.isdir(data_source):
-        shutil.rmtree(data_source)
-    elif os.path.isfile(data_source):
-        os.remove(data_source)
-    else:
-        return
-    logger.info(f"Removed: {data_source}")
+def copy_upload(file: io.BytesIO, path: Path) -> str:
+    # streams the upload to path in blocks instead of one read of the whole file
+    file_path = str(path / os.path.basename(file.name))
+    file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(file, f, UPLOAD_COPY_BLOCK_SIZE)
+    logger.info(f"Copied upload to: {file_path}")
+    return file_path
@@ -0,0 +1,292 @@
+import bisect
+import json
+import os
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from ultima.shared_arrtibs import BM25_B, BM25_K1, LEXICAL_INDEX_PATH
+from ultima.input_output import clean_string_for_storing
+from ultima.logging import logger
+from ultima.partitions import Partitions
+
+POSTINGS_FILE = "postings.npz"
+CHUNKS_FILE = "chunks.json"
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# query terms missing from the vocabulary match the terms they are a prefix of,
+# e.g. "bik" -> "biktarvy"
+MIN_PREFIX_LENGTH = 3
+MAX_PREFIX_EXPANSIONS = 32
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def get_lexical_index_path(dataset_path: str) -> Path:
+    return LEXICAL_INDEX_PATH / clean_string_for_storing(dataset_path)
+
+
+class LexicalIndex:
+    # BM25 inverted index over the chunks of a dataset, kept next to its vector
+    # store. Postings are stored column-wise: the chunks containing term t are
+    # doc_ids[offsets[t]:offsets[t + 1]] with their term frequencies, as flat
+    # uint32/uint16 arrays. Added chunks are buffered and deleted ones marked,
+    # both are merged into the arrays on the next search or persist.
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path) if path else None
+        self.terms: List[str] = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.empty(0, dtype=np.uint32)
+        self.frequencies = np.empty(0, dtype=np.uint16)
+        self.lengths = np.empty(0, dtype=np.uint32)
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self._term_ids: Dict[str, int] = {}
+        # term counts of the chunks added since the last merge
+        self._pending: List[Counter] = []
+        self._deleted: Set[int] = set()
+        # rows of every file, rebuilt after merges
+        self._partitions: Optional[Partitions] = None
+        self._mean_length: Optional[float] = None
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        path = Path(path)
+        return (path / POSTINGS_FILE).is_file() and (path / CHUNKS_FILE).is_file()
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        if not cls.exists(path):
+            return None
+        index = cls(path)
+        with np.load(index.path / POSTINGS_FILE) as postings:
+            index.offsets = postings["offsets"]
+            index.doc_ids = postings["doc_ids"]
+            index.frequencies = postings["frequencies"]
+            index.lengths = postings["lengths"]
+        with open(index.path / CHUNKS_FILE, encoding="utf-8") as f:
+            sidecar = json.load(f)
+        index.terms = sidecar["terms"]
+        index.ids = sidecar["ids"]
+        index.texts = sidecar["texts"]
+        index.metadatas = sidecar["metadatas"]
+        if (
+            len(index.terms) + 1 != len(index.offsets)
+            or len(index.ids) != len(index.lengths)
+        ):
+            # interrupted between writing the two files
+            logger.error(f"Lexical index {path} is inconsistent, ignoring it")
+            return None
+        index._term_ids = {term: i for i, term in enumerate(index.terms)}
+        logger.info(f"Loaded lexical index of {len(index)} chunks from {path}")
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self._deleted)
+
+    def add(
+        self, ids: List[str], texts: List[str], metadatas: Optional[List[dict]] = None
+    ) -> None:
+        self._pending.extend(Counter(tokenize(text)) for text in texts)
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas or [{} for _ in texts])
+
+    def delete(self, ids: List[str]) -> None:
+        drop = set(ids)
+        self._deleted.update(i for i, id_ in enumerate(self.ids) if id_ in drop)
+
+    def _merge(self) -> None:
+        # rebuilds the postings as (term, chunk, frequency) triples, sorted by term
+        if not self._pending and not self._deleted:
+            return
+        merged = len(self.lengths)
+        added = {term for counts in self._pending for term in counts}
+        terms = sorted(set(self.terms) | added)
+        term_ids = {term: i for i, term in enumerate(terms)}
+        remap = np.array([term_ids[t] for t in self.terms], dtype=np.int64)
+        old_terms = remap[np.repeat(np.arange(len(self.terms)), np.diff(self.offsets))]
+        pending_terms, pending_docs, pending_frequencies = [], [], []
+        for doc, counts in enumerate(self._pending, start=merged):
+            for term, count in counts.items():
+                pending_terms.append(term_ids[term])
+                pending_docs.append(doc)
+                pending_frequencies.append(min(count, np.iinfo(np.uint16).max))
+        all_terms = np.concatenate([old_terms, np.array(pending_terms, dtype=np.int64)])
+        docs = np.concatenate([self.doc_ids, np.array(pending_docs, dtype=np.uint32)])
+        frequencies = np.concatenate(
+            [self.frequencies, np.array(pending_frequencies, dtype=np.uint16)]
+        )
+        lengths = np.concatenate(
+            [
+                self.lengths,
+                np.array([sum(c.values()) for c in self._pending], dtype=np.uint32),
+            ]
+        )
+
+        keep = np.ones(len(lengths), dtype=bool)
+        keep[list(self._deleted)] = False
+        if self._deleted:
+            postings = keep[docs]
+            all_terms, docs, frequencies = (
+                all_terms[postings],
+                docs[postings],
+                frequencies[postings],
+            )
+            # close the gaps left by deleted chunks
+            docs = (np.cumsum(keep) - 1)[docs].astype(np.uint32)
+            lengths = lengths[keep]
+            self.ids = [i for i, k in zip(self.ids, keep) if k]
+            self.texts = [t for t, k in zip(self.texts, keep) if k]
+            self.metadatas = [m for m, k in zip(self.metadatas, keep) if k]
+        # terms no chunk contains anymore are dropped from the vocabulary
+        used, all_terms = np.unique(all_terms, return_inverse=True)
+        order = np.lexsort((docs, all_terms))
+        self.terms = [terms[t] for t in used]
+        self._term_ids = {term: i for i, term in enumerate(self.terms)}
+        self.offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(all_terms, minlength=len(used)))]
+        ).astype(np.int64)
+        self.doc_ids = docs[order]
+        self.frequencies = frequencies[order]
+        self.lengths = lengths
+        self._pending = []
+        self._deleted = set()
+        self._partitions = None
+        self._mean_length = None
+
+    def persist(self, path: Optional[str] = None) -> None:
+        self._merge()
+        self.path = Path(path) if path else self.path
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.path / f"{POSTINGS_FILE}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                offsets=self.offsets,
+                doc_ids=self.doc_ids,
+                frequencies=self.frequencies,
+                lengths=self.lengths,
+            )
+        os.replace(tmp_path, self.path / POSTINGS_FILE)
+        tmp_path = self.path / f"{CHUNKS_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "terms": self.terms,
+                    "ids": self.ids,
+                    "texts": self.texts,
+                    "metadatas": self.metadatas,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path / CHUNKS_FILE)
+        logger.info(
+            f"Persisted lexical index of {len(self)} chunks and {len(self.terms)} "
+            f"terms to {self.path}"
+        )
+
+    def _query_terms(self, query: str) -> Dict[int, float]:
+        # term id -> weight, prefix expansions share the weight of their term
+        weights: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            if term in self._term_ids:
+                matches = [self._term_ids[term]]
+            elif len(term) >= MIN_PREFIX_LENGTH:
+                start = bisect.bisect_left(self.terms, term)
+                end = bisect.bisect_left(self.terms, term + "\uffff")
+                matches = list(range(start, min(end, start + MAX_PREFIX_EXPANSIONS)))
+            else:
+                matches = []
+            for term_id in matches:
+                weights[term_id] = max(weights.get(term_id, 0.0), 1.0 / len(matches))
+        return weights
+
+    @property
+    def partitions(self) -> Partitions:
+        self._merge()
+        if self._partitions is None:
+            self._partitions = Partitions(self.metadatas)
+        return self._partitions
+
+    def _average_length(self) -> float:
+        if self._mean_length is None:
+            self._mean_length = max(float(self.lengths.mean()), 1.0)
+        return self._mean_length
+
+    def _postings(
+        self, term_id: int, rows: Optional[np.ndarray]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (postings, chunks, score positions) of a term, only the postings of rows
+        # if given. Both the postings of a term and rows are sorted by chunk, the
+        # shorter side is looked up in the longer one.
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        docs = self.doc_ids[start:end]
+        if rows is None:
+            return np.arange(start, end), docs, docs
+        if not len(docs):
+            return np.empty(0, np.int64), docs, np.empty(0, np.int64)
+        if len(rows) <= len(docs):
+            found = np.minimum(np.searchsorted(docs, rows), len(docs) - 1)
+            positions = np.flatnonzero(docs[found] == rows)
+            postings = found[positions]
+        else:
+            found = np.minimum(np.searchsorted(rows, docs), len(rows) - 1)
+            postings = np.flatnonzero(rows[found] == docs)
+            positions = found[postings]
+        return start + postings, docs[postings], positions
+
+    def search(
+        self, query: str, k: int, filter: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[int, float]]:
+        # (chunk index, BM25 score) of the k best chunks with a positive score,
+        # among the chunks matching filter if given. A filtered search only
+        # scores the postings of the filtered rows.
+        self._merge()
+        n = len(self.lengths)
+        if not n or k <= 0:
+            return []
+        rows = self.partitions.rows(filter)
+        if rows is not None and not len(rows):
+            return []
+        scores = np.zeros(n if rows is None else len(rows), dtype=np.float32)
+        average_length = self._average_length()
+        for term_id, weight in self._query_terms(query).items():
+            postings, docs, positions = self._postings(term_id, rows)
+            if not len(postings):
+                continue
+            frequencies = self.frequencies[postings].astype(np.float32)
+            lengths = self.lengths[docs].astype(np.float32)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+            # document frequency over the whole index, like unfiltered searches
+            df = self.offsets[term_id + 1] - self.offsets[term_id]
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            # chunks are unique within a term's postings
+            scores[positions] += (
+                weight * idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+            )
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        chunks = candidates if rows is None else rows[candidates]
+        return [(int(i), float(scores[c])) for i, c in zip(chunks, candidates)]
+
+    def get_documents(self, indices: List[int]) -> List[Document]:
+        return [
+            Document(page_content=self.texts[i], metadata=self.metadatas[i])
+            for i in indices
+        ]
+
+    def get_relevant_documents(
+        self, query: str, k: int, filter: Optional[Dict[str, Any]] = None
+    ) -> List[Document]:
+        return self.get_documents([i for i, _ in self.search(query, k, filter)])
@@ -1,7 +1,19 @@
+import csv
+import io
+import multiprocessing
 import os
 import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 
 from langchain.document_loaders import (
     CSVLoader,
@@ -14,12 +26,21 @@ from langchain.document_loaders import (
 )
 from langchain.document_loaders.base import BaseLoader
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter, NLTKTextSplitter,  CharacterTextSplitter
+from langchain.text_splitter import RecursiveCharacterTextSplitter, NLTKTextSplitter,  CharacterTextSplitter, TextSplitter
 from tqdm import tqdm
 
-from ultima.shared_arrtibs import DATA_PATH, PROJECT_URL
+from ultima.shared_arrtibs import (
+    DATA_PATH,
+    LOADER_TIMEOUT,
+    LOADER_WORKERS,
+    PROJECT_URL,
+    TEXT_SPLITTER,
+)
+from ultima.input_output import copy_upload
 from ultima.logging import logger
-from ultima.models import get_tokenizer
+from ultima.metrics import timed
+from ultima.models import Enum, get_tokenizer
+from ultima.text_splitter import TokenOffsetTextSplitter
 
 FILE_LOADER_MAPPING = {
     ".csv": (CSVLoader, {"encoding": "utf-8"}),
@@ -31,6 +52,9 @@ WEB_LOADER_MAPPING = {
     ".pdf": (OnlinePDFLoader, {}),
 }
 
+# a local file path or an uploaded file that only exists in memory
+Source = Union[str, io.BytesIO]
+
 def load_document(
     file_path: str,
     mapping: dict = FILE_LOADER_MAPPING,
@@ -45,22 +69,309 @@ def load_document(
     return loader.load()
 
 
-def load_directory(path: str, silent_errors=True) -> List[Document]:
-    all_files = list(Path(path).rglob("**/[!.]*"))
-    results = []
-    with tqdm(total=len(all_files), desc="Loading documents", ncols=80) as pbar:
+def load_text_buffer(file: io.BytesIO) -> List[Document]:
+    # decodes straight from the buffer, like TextLoader
+    with file.getbuffer() as view:
+        text = str(view, "utf8")
+    return [Document(page_content=text, metadata={"source": file.name})]
+
+
+def load_csv_buffer(file: io.BytesIO) -> List[Document]:
+    # one document per row, like CSVLoader
+    file.seek(0)
+    reader = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    try:
+        return [
+            Document(
+                page_content="\n".join(
+                    f"{k.strip()}: {v.strip()}" for k, v in row.items()
+                ),
+                metadata={"source": file.name, "row": i},
+            )
+            for i, row in enumerate(csv.DictReader(reader))
+        ]
+    finally:
+        # closing the wrapper would close the upload as well
+        reader.detach()
+
+
+def load_pdf_buffer(file: io.BytesIO) -> List[Document]:
+    # the text of the whole file, like PDFMinerLoader
+    from pdfminer.high_level import extract_text
+
+    file.seek(0)
+    return [Document(page_content=extract_text(file), metadata={"source": file.name})]
+
+
+def split_pages(docs: List[Document]) -> List[Document]:
+    # one document per page of a PDF, numbered from 1, pdfminer ends every page
+    # with a form feed
+    pages = []
+    for doc in docs:
+        for number, text in enumerate(doc.page_content.split("\f"), start=1):
+            if text.strip():
+                metadata = {**doc.metadata, "page": number}
+                pages.append(Document(page_content=text, metadata=metadata))
+    return pages
+
+
+BUFFER_LOADER_MAPPING = {
+    ".csv": load_csv_buffer,
+    ".pdf": load_pdf_buffer,
+    ".txt": load_text_buffer,
+}
+
+
+def load_upload(file: io.BytesIO) -> List[Document]:
+    # Loads from memory where possible, other formats are streamed to a
+    # temporary file for their loader which is removed right after.
+    ext = "." + file.name.rsplit(".", 1)[-1]
+    if ext in BUFFER_LOADER_MAPPING:
+        return BUFFER_LOADER_MAPPING[ext](file)
+    with tempfile.TemporaryDirectory(prefix="ultima-upload-") as tmp:
+        docs = load_document(copy_upload(file, Path(tmp)))
+    for doc in docs:
+        doc.metadata["source"] = file.name
+    return docs
+
+
+def get_source_path(source: Source) -> str:
+    return source if isinstance(source, str) else source.name
+
+
+class LoadTimeoutError(TimeoutError):
+    pass
+
+
+class LoadError(Exception):
+    pass
+
+
+@dataclass
+class LoadFailure:
+    path: str
+    error: str
+    seconds: float
+
+
+@dataclass
+class LoadReport:
+    documents: List[Document] = field(default_factory=list)
+    failures: List[LoadFailure] = field(default_factory=list)
+    files: int = 0
+    seconds: float = 0.0
+
+
+def _raise_timeout(signum, frame):
+    raise LoadTimeoutError()
+
+
+def _load_in_thread(
+    load: Callable[[], List[Document]], timeout: float
+) -> List[Document]:
+    # other threads can't be interrupted, a load that misses the deadline is
+    # left to finish in its daemon thread and its result is dropped
+    result = {}
+
+    def run() -> None:
+        try:
+            result["docs"] = load()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, name="ultima-load", daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise LoadTimeoutError(f"loading took longer than {timeout}s")
+    if "error" in result:
+        raise result["error"]
+    return result["docs"]
+
+
+def load_with_timeout(
+    load: Callable[[], List[Document]], timeout: Optional[float]
+) -> List[Document]:
+    # SIGALRM also interrupts loaders stuck inside a parser, but it is unix only
+    # and can only be installed from the main thread of a process
+    if not timeout:
+        return load()
+    use_alarm = (
+        hasattr(signal, "SIGALRM")
+        and threading.current_thread() is threading.main_thread()
+    )
+    if not use_alarm:
+        return _load_in_thread(load, timeout)
+    previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return load()
+    except LoadTimeoutError:
+        raise LoadTimeoutError(f"loading took longer than {timeout}s")
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def load_document_with_timeout(file_path: str, timeout: Optional[float]) -> List[Document]:
+    return load_with_timeout(lambda: load_document(file_path), timeout)
+
+
+def _load_file(
+    source: Source, timeout: Optional[float]
+) -> Tuple[List[Document], Optional[LoadFailure]]:
+    # never raises so that one broken file can't take down the whole batch
+    start = time.perf_counter()
+    file_path = get_source_path(source)
+    try:
+        if isinstance(source, str):
+            docs = load_document_with_timeout(source, timeout)
+        else:
+            docs = load_with_timeout(lambda: load_upload(source), timeout)
+        # chunks are mapped back to their file through the source metadata
+        for doc in docs:
+            doc.metadata.setdefault("source", file_path)
+        if file_path.lower().endswith(".pdf"):
+            docs = split_pages(docs)
+        return docs, None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        return [], LoadFailure(file_path, error, time.perf_counter() - start)
+
+
+def list_files(path: str) -> List[str]:
+    # sorted so that chunk order and thus dataset content is deterministic
+    return sorted(str(f) for f in Path(path).rglob("**/[!.]*") if f.is_file())
+
+
+def list_source_files(data_source: str) -> Optional[Dict[str, str]]:
+    # name -> path of every local file behind a data source, None for web sources
+    if os.path.isdir(data_source):
+        return {os.path.relpath(f, data_source): f for f in list_files(data_source)}
+    if os.path.isfile(data_source):
+        return {os.path.basename(data_source): data_source}
+    return None
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    # spawn instead of fork, forking a multi-threaded streamlit server is unsafe
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _succeeded(future: Future) -> bool:
+    return future.done() and not future.cancelled() and future.exception() is None
+
+
+def load_isolated(
+    file: str, timeout: Optional[float], load_file: Callable = _load_file
+) -> Tuple[List[Document], Optional[LoadFailure]]:
+    # in a process of its own, a crash fails this file only
+    start = time.perf_counter()
+    with _get_executor(1) as executor:
+        try:
+            return executor.submit(load_file, file, timeout).result()
+        except BrokenProcessPool as e:
+            error = f"worker crashed: {e}"
+            return [], LoadFailure(file, error, time.perf_counter() - start)
+
+
+def iter_load_files(
+    all_files: List[str],
+    workers: int = LOADER_WORKERS,
+    timeout: Optional[float] = LOADER_TIMEOUT,
+    load_file: Callable = _load_file,
+) -> Iterator[Tuple[str, List[Document], Optional[LoadFailure]]]:
+    # Yields (file, documents, failure) in input order. At most two files per
+    # worker are in flight, so a slow consumer holds back loading. A worker
+    # crash breaks the whole pool: the pool is replaced and the files that were
+    # not finished are loaded one process each, so only the crashing file fails.
+    if workers <= 1 or len(all_files) <= 1:
         for file in all_files:
+            yield (file, *load_file(file, timeout))
+        return
+    workers = min(workers, len(all_files))
+    executor = _get_executor(workers)
+    queued = iter(all_files)
+    # (file, future), no future for files to load isolated
+    in_flight: Deque[Tuple[str, Optional[Future]]] = deque()
+
+    def submit(file: str) -> None:
+        try:
+            in_flight.append((file, executor.submit(load_file, file, timeout)))
+        except BrokenProcessPool:
+            in_flight.append((file, None))
+
+    try:
+        for file in islice(queued, 2 * workers):
+            submit(file)
+        while in_flight:
+            file, future = in_flight.popleft()
             try:
-                results.extend(load_document(str(file)))
-            except Exception as e:
-                if silent_errors:
-                    logger.error(f"failed to load {file}")
+                if future is None:
+                    docs, failure = load_isolated(file, timeout, load_file)
                 else:
-                    raise e
+                    docs, failure = future.result()
+            except BrokenProcessPool:
+                logger.warning(f"A loader process crashed, retrying {file} alone")
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = _get_executor(workers)
+                pending = list(in_flight)
+                in_flight.clear()
+                for pending_file, pending_future in pending:
+                    if pending_future is not None and _succeeded(pending_future):
+                        in_flight.append((pending_file, pending_future))
+                    else:
+                        in_flight.append((pending_file, None))
+                docs, failure = load_isolated(file, timeout, load_file)
+            next_file = next(queued, None)
+            if next_file is not None:
+                submit(next_file)
+            yield file, docs, failure
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_load_uploads(
+    files: List[io.BytesIO], timeout: Optional[float] = LOADER_TIMEOUT
+) -> Iterator[Tuple[io.BytesIO, List[Document], Optional[LoadFailure]]]:
+    # in this process, sending the buffers to workers would copy them
+    for file in files:
+        yield (file, *_load_file(file, timeout))
+
+
+def load_files(
+    all_files: List[str],
+    silent_errors=True,
+    workers: int = LOADER_WORKERS,
+    timeout: Optional[float] = LOADER_TIMEOUT,
+) -> LoadReport:
+    report = LoadReport(files=len(all_files))
+    start = time.perf_counter()
+    with tqdm(total=len(all_files), desc="Loading documents", ncols=80) as pbar:
+        for _, docs, failure in iter_load_files(all_files, workers, timeout):
+            report.documents.extend(docs)
             pbar.update()
-    return results
+            if failure is None:
+                continue
+            if not silent_errors:
+                raise LoadError(f"failed to load {failure.path}: {failure.error}")
+            logger.error(f"failed to load {failure.path}: {failure.error}")
+            report.failures.append(failure)
+    report.seconds = time.perf_counter() - start
+    logger.info(
+        f"Loaded {report.files - len(report.failures)}/{report.files} files "
+        f"in {report.seconds:.1f}s"
+    )
+    return report
+
 
+def load_directory(path: str, silent_errors=True, **kwargs) -> LoadReport:
+    return load_files(list_files(path), silent_errors, **kwargs)
 
+
+@timed("load_data")
 def load_data_source(data_source: str) -> List[Document]:
     is_web = data_source.startswith("http")
     is_dir = os.path.isdir(data_source)
@@ -68,7 +379,7 @@ def load_data_source(data_source: str) -> List[Document]:
     docs = None
     try:
         if is_dir:
-            docs = load_directory(data_source)
+            docs = load_directory(data_source).documents
         elif is_file:
             docs = load_document(data_source)
         elif is_web:
@@ -81,21 +392,49 @@ def load_data_source(data_source: str) -> List[Document]:
         raise e
 
 
-def split_docs(docs: List[Document], options: dict) -> List[Document]:
+class SPLITTERS(Enum):
+    # tokenizes every document once instead of once per candidate piece
+    TOKEN = "token"
+    # the langchain splitters compared in the sample PDFs, measuring chunks in
+    # tokens of the embedding model as well
+    RECURSIVE = "recursive"
+    NLTK = "nltk"
+    CHARACTER = "character"
+
+
+def get_text_splitter(options: dict) -> TextSplitter:
     tokenizer = get_tokenizer(options)
+    splitter = options.get("text_splitter", TEXT_SPLITTER)
+    kwargs = {
+        "chunk_size": options["chunk_size"],
+        "chunk_overlap": options["chunk_overlap"],
+    }
+    if splitter == SPLITTERS.TOKEN:
+        return TokenOffsetTextSplitter(tokenizer, **kwargs)
 
     def length_function(text: str) -> int:
         return len(tokenizer.encode(text))
 
-    text_splitter = RecursiveCharacterTextSplitter(
-    #text_splitter = NLTKTextSplitter(
-    #text_splitter =  CharacterTextSplitter( 
-        chunk_size=options["chunk_size"],
-        chunk_overlap=options["chunk_overlap"],
-        length_function=length_function,
-    )
+    match splitter:
+        case SPLITTERS.RECURSIVE:
+            return RecursiveCharacterTextSplitter(
+                length_function=length_function, **kwargs
+            )
+        case SPLITTERS.NLTK:
+            return NLTKTextSplitter(length_function=length_function, **kwargs)
+        case SPLITTERS.CHARACTER:
+            return CharacterTextSplitter(length_function=length_function, **kwargs)
+        case _default:
+            msg = f"Text splitter {splitter} not supported!"
+            logger.error(msg)
+            raise ValueError(msg)
 
+
+@timed("split_docs")
+def split_docs(
+    docs: List[Document], options: dict, text_splitter: Optional[TextSplitter] = None
+) -> List[Document]:
+    text_splitter = text_splitter or get_text_splitter(options)
     splitted_docs = text_splitter.split_documents(docs)
     logger.info(f"Loaded: {len(splitted_docs)} document chucks")
     return splitted_docs
-
@@ -0,0 +1,452 @@
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+
+from ultima.shared_arrtibs import RESCORE_FACTOR, VECTOR_STORAGE
+from ultima.logging import logger
+from ultima.mmr import batch_maximal_marginal_relevance as batch_mmr
+from ultima.partitions import Partitions
+
+EMBEDDINGS_FILE = "embeddings.npy"
+NORMS_FILE = "norms.npy"
+METADATA_FILE = "metadata.json"
+CODES_FILE = "codes.npy"
+SCALES_FILE = "scales.npy"
+
+STORAGE_TYPES = ("float32", "float16", "int8")
+# metrics computed from dot products, the only ones searched approximately
+DOT_METRICS = ("cos", "dot", "l2")
+
+# metrics that need the full difference matrix are computed in row blocks
+BLOCK_SIZE = 65536
+
+
+def quantize(
+    vectors: np.ndarray, storage: str
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    # compact codes of the vectors and, for int8, the scale of every row
+    if storage == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.empty(0)
+    scales = np.where(scales == 0, 1, scales).astype(np.float32)
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def _from_dot(
+    dots: np.ndarray, norms: np.ndarray, query: np.ndarray, metric: str
+) -> np.ndarray:
+    if metric == "cos":
+        return dots / (norms * np.linalg.norm(query) + 1e-10)
+    if metric == "dot":
+        return dots
+    # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2 without materializing x - q
+    return -np.sqrt(np.maximum(norms**2 - 2 * dots + query @ query, 0))
+
+
+class NumpyVectorStore(VectorStore):
+    # In-process vector store for LOCAL mode. All embeddings live in one contiguous
+    # float32 matrix which is persisted as .npy and memory-mapped on load, texts and
+    # metadata are kept in a json sidecar next to it.
+    # With a float16 or int8 `storage` searches scan a compact copy held in memory
+    # and rescore the best candidates with their rows of the float32 matrix, so
+    # only those pages of it are read.
+    # Searches with a metadata filter only score the rows of the matching files.
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        path: Optional[str] = None,
+        matrix: Optional[np.ndarray] = None,
+        norms: Optional[np.ndarray] = None,
+        ids: Optional[List[str]] = None,
+        texts: Optional[List[str]] = None,
+        metadatas: Optional[List[dict]] = None,
+        storage: str = VECTOR_STORAGE,
+        codes: Optional[np.ndarray] = None,
+        scales: Optional[np.ndarray] = None,
+    ):
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Vector storage '{storage}' not supported!")
+        self.embedding_function = embedding_function
+        self.storage = storage
+        self._codes = codes
+        self._scales = scales
+        self.path = Path(path) if path else None
+        self._matrix = matrix
+        self._norms = norms
+        self._pending: List[np.ndarray] = []
+        self.ids = ids or []
+        self.texts = texts or []
+        self.metadatas = metadatas or []
+        self._partitions: Optional[Partitions] = None
+        self._rows: Optional[Dict[str, int]] = None
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        path = Path(path)
+        return (path / EMBEDDINGS_FILE).is_file() and (path / METADATA_FILE).is_file()
+
+    @classmethod
+    def load(
+        cls, path: str, embedding_function: Embeddings, storage: str = VECTOR_STORAGE
+    ) -> "NumpyVectorStore":
+        path = Path(path)
+        matrix = np.load(path / EMBEDDINGS_FILE, mmap_mode="r")
+        norms = np.load(path / NORMS_FILE, mmap_mode="r")
+        with open(path / METADATA_FILE, encoding="utf-8") as f:
+            sidecar = json.load(f)
+        codes, scales = None, None
+        if storage != "float32":
+            if sidecar.get("storage") == storage and (path / CODES_FILE).is_file():
+                # the compact copy is what searches scan, keep it in memory
+                codes = np.load(path / CODES_FILE)
+                if storage == "int8":
+                    scales = np.load(path / SCALES_FILE)
+            else:
+                codes, scales = quantize(np.asarray(matrix), storage)
+        logger.info(f"Loaded {len(sidecar['ids'])} {storage} vectors from {path}")
+        return cls(
+            embedding_function,
+            path=path,
+            matrix=matrix,
+            norms=norms,
+            ids=sidecar["ids"],
+            texts=sidecar["texts"],
+            metadatas=sidecar["metadatas"],
+            storage=storage,
+            codes=codes,
+            scales=scales,
+        )
+
+    def _consolidate(self) -> None:
+        # merge appended batches into one contiguous matrix
+        if not self._pending:
+            return
+        if self.storage != "float32":
+            codes, scales = quantize(np.concatenate(self._pending), self.storage)
+            if self._codes is not None:
+                codes = np.concatenate([self._codes, codes])
+                if scales is not None:
+                    scales = np.concatenate([self._scales, scales])
+            self._codes, self._scales = codes, scales
+        blocks = self._pending
+        if self._matrix is not None:
+            blocks = [np.asarray(self._matrix)] + blocks
+        self._matrix = np.ascontiguousarray(np.concatenate(blocks))
+        self._norms = np.linalg.norm(self._matrix, axis=1).astype(np.float32)
+        self._pending = []
+
+    @property
+    def matrix(self) -> np.ndarray:
+        self._consolidate()
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._matrix
+
+    @property
+    def norms(self) -> np.ndarray:
+        self._consolidate()
+        if self._norms is None:
+            return np.empty(0, dtype=np.float32)
+        return self._norms
+
+    @property
+    def codes(self) -> Optional[np.ndarray]:
+        self._consolidate()
+        return self._codes
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def partitions(self) -> Partitions:
+        # rebuilt after adds and deletes
+        if self._partitions is None:
+            self._partitions = Partitions(self.metadatas)
+        return self._partitions
+
+    def index_bytes(self) -> int:
+        # memory scanned by searches
+        if self.storage == "float32":
+            return self.matrix.nbytes + self.norms.nbytes
+        scales = self._scales.nbytes if self._scales is not None else 0
+        return self.codes.nbytes + scales + self.norms.nbytes
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: Any,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+        self._pending.append(embeddings)
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas or [{} for _ in texts])
+        self._partitions = None
+        self._rows = None
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        embeddings = self.embedding_function.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas, ids)
+
+    def delete(self, ids: List[str]) -> bool:
+        drop = set(ids)
+        keep = np.array([i not in drop for i in self.ids], dtype=bool)
+        if keep.all():
+            return False
+        self._matrix = np.ascontiguousarray(self.matrix[keep])
+        self._norms = np.ascontiguousarray(self.norms[keep])
+        if self._codes is not None:
+            self._codes = self._codes[keep]
+            if self._scales is not None:
+                self._scales = self._scales[keep]
+        self.ids = [i for i, k in zip(self.ids, keep) if k]
+        self.texts = [t for t, k in zip(self.texts, keep) if k]
+        self.metadatas = [m for m, k in zip(self.metadatas, keep) if k]
+        self._partitions = None
+        self._rows = None
+        return True
+
+    def persist(self, path: Optional[str] = None) -> None:
+        self.path = Path(path) if path else self.path
+        os.makedirs(self.path, exist_ok=True)
+        # write next to the target and swap so readers never see partial files
+        arrays = [(EMBEDDINGS_FILE, self.matrix), (NORMS_FILE, self.norms)]
+        if self.storage != "float32":
+            arrays.append((CODES_FILE, self.codes))
+            if self._scales is not None:
+                arrays.append((SCALES_FILE, self._scales))
+        for name, array in arrays:
+            tmp_path = self.path / f"{name}.tmp"
+            with open(tmp_path, "wb") as f:
+                dtype = array.dtype if name == CODES_FILE else np.float32
+                np.save(f, np.asarray(array, dtype=dtype))
+            os.replace(tmp_path, self.path / name)
+        tmp_path = self.path / f"{METADATA_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "ids": self.ids,
+                    "texts": self.texts,
+                    "metadatas": self.metadatas,
+                    "storage": self.storage,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path / METADATA_FILE)
+        if self.storage != "float32":
+            # only rescored rows are read from now on
+            self._matrix = np.load(self.path / EMBEDDINGS_FILE, mmap_mode="r")
+        logger.info(f"Persisted {len(self)} {self.storage} vectors to {self.path}")
+
+    def _scores(
+        self,
+        query: np.ndarray,
+        distance_metric: str,
+        rows: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        # higher is always better, distances are negated
+        matrix, norms = self.matrix, self.norms
+        if rows is not None:
+            matrix, norms = np.asarray(matrix[rows]), norms[rows]
+        metric = distance_metric.lower()
+        if metric in DOT_METRICS:
+            return _from_dot(matrix @ query, norms, query, metric)
+        if metric in ("l1", "max"):
+            scores = np.empty(len(matrix), dtype=np.float32)
+            for start in range(0, len(matrix), BLOCK_SIZE):
+                diff = np.abs(matrix[start : start + BLOCK_SIZE] - query)
+                block = diff.sum(axis=1) if metric == "l1" else diff.max(axis=1)
+                scores[start : start + BLOCK_SIZE] = -block
+            return scores
+        raise ValueError(f"Distance metric '{distance_metric}' not supported!")
+
+    def _approximate_scores(
+        self, query: np.ndarray, metric: str, rows: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        codes, scales, norms = self.codes, self._scales, self.norms
+        if rows is not None:
+            codes, norms = codes[rows], norms[rows]
+            scales = scales[rows] if scales is not None else None
+        dots = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), BLOCK_SIZE):
+            block = codes[start : start + BLOCK_SIZE].astype(np.float32)
+            if scales is not None:
+                block *= scales[start : start + BLOCK_SIZE, None]
+            dots[start : start + BLOCK_SIZE] = block @ query
+        return _from_dot(dots, norms, query, metric)
+
+    def _search_scores(
+        self,
+        query: np.ndarray,
+        distance_metric: str,
+        k: int,
+        rows: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        # exact scores of all rows or of `rows` only, with compact storage only
+        # of the best candidates of an approximate pass and -inf for all others
+        metric = distance_metric.lower()
+        if self.storage == "float32" or metric not in DOT_METRICS:
+            return self._scores(query, distance_metric, rows)
+        approximate = self._approximate_scores(query, metric, rows)
+        # sorted rows read the memory-mapped matrix front to back
+        top = np.sort(self._top_k(approximate, k * RESCORE_FACTOR))
+        scores = np.full(len(approximate), -np.inf, dtype=np.float32)
+        scores[top] = self._scores(query, metric, top if rows is None else rows[top])
+        return scores
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def _search_batch(
+        self,
+        embeddings: List[List[float]],
+        k: int = 4,
+        distance_metric: str = "cos",
+        maximal_marginal_relevance: bool = False,
+        use_maximal_marginal_relevance: bool = False,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> List[List[Tuple[int, float]]]:
+        # scores and candidates are positions in `rows` when filtered
+        rows = self.partitions.rows(filter)
+        if not len(self) or (rows is not None and not len(rows)):
+            return [[] for _ in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32)
+        scores = [
+            self._search_scores(query, distance_metric, max(k, fetch_k), rows)
+            for query in queries
+        ]
+        if maximal_marginal_relevance or use_maximal_marginal_relevance:
+            candidates = [self._top_k(s, max(k, fetch_k)) for s in scores]
+            # one MMR pass for the whole batch of queries
+            selected = batch_mmr(
+                queries,
+                [
+                    np.asarray(self.matrix[c if rows is None else rows[c]])
+                    for c in candidates
+                ],
+                lambda_mult=lambda_mult,
+                k=k,
+            )
+            indices = [c[s] for c, s in zip(candidates, selected)]
+        else:
+            indices = [self._top_k(s, k) for s in scores]
+        return [
+            [(int(i if rows is None else rows[i]), float(s[i])) for i in idx]
+            for idx, s in zip(indices, scores)
+        ]
+
+    def _search(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[int, float]]:
+        return self._search_batch([embedding], k, **kwargs)[0]
+
+    def _to_document(self, index: int) -> Document:
+        return Document(page_content=self.texts[index], metadata=self.metadatas[index])
+
+    def search(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[int, float]]:
+        # (row, score) of the k best rows, the interface of deeplake_index
+        return self._search(embedding, k, **kwargs)
+
+    def get_documents(self, rows: List[int]) -> List[Document]:
+        return [self._to_document(row) for row in rows]
+
+    def get_embeddings(self, rows: List[int]) -> np.ndarray:
+        return np.asarray(self.matrix[rows], dtype=np.float32)
+
+    def get_rows(self, ids: List[str]) -> List[Optional[int]]:
+        # rebuilt after adds and deletes
+        if self._rows is None:
+            self._rows = {id_: row for row, id_ in enumerate(self.ids)}
+        return [self._rows.get(id_) for id_ in ids]
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [self._to_document(i) for i, _ in self._search(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embedding_function.embed_query(query)
+        return [
+            (self._to_document(i), score)
+            for i, score in self._search(embedding, k, **kwargs)
+        ]
+
+    def batch_similarity_search(
+        self, queries: List[str], k: int = 4, **kwargs: Any
+    ) -> List[List[Document]]:
+        embeddings = [self.embedding_function.embed_query(query) for query in queries]
+        return [
+            [self._to_document(i) for i, _ in results]
+            for results in self._search_batch(embeddings, k, **kwargs)
+        ]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return self.similarity_search(
+            query,
+            k,
+            fetch_k=fetch_k,
+            lambda_mult=lambda_mult,
+            use_maximal_marginal_relevance=True,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        path: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        vector_store = cls(embedding, path=path)
+        vector_store.add_texts(texts, metadatas, ids)
+        if path:
+            vector_store.persist()
+        return vector_store
+
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from ultima.shared_arrtibs import MANIFEST_PATH, TEXT_SPLITTER
+from ultima.input_output import clean_string_for_storing
+from ultima.logging import logger
+
+HASH_BLOCK_SIZE = 1024 * 1024
+# a manifest is only worth copying if most of its files are reused
+MIN_BASE_OVERLAP = 0.5
+
+
+def hash_file(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_manifest_path(dataset_path: str) -> Path:
+    return MANIFEST_PATH / f"{clean_string_for_storing(dataset_path)}.json"
+
+
+@dataclass
+class Manifest:
+    # Maps each source file of a dataset to its content hash and chunk ids,
+    # so rebuilds only have to touch files that changed.
+    dataset_path: str
+    embedding: str
+    chunk_size: int
+    chunk_overlap: int
+    # relative file path -> {"hash": str, "ids": List[str]}
+    files: Dict[str, dict] = field(default_factory=dict)
+    text_splitter: str = TEXT_SPLITTER
+
+    @classmethod
+    def for_options(cls, dataset_path: str, options: dict) -> "Manifest":
+        return cls(
+            dataset_path=dataset_path,
+            embedding=options["model"].embedding,
+            chunk_size=options["chunk_size"],
+            chunk_overlap=options["chunk_overlap"],
+            text_splitter=options.get("text_splitter", TEXT_SPLITTER),
+        )
+
+    @classmethod
+    def load(cls, dataset_path: str) -> Optional["Manifest"]:
+        path = get_manifest_path(dataset_path)
+        if not path.is_file():
+            return None
+        with open(path, encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def save(self) -> None:
+        path = get_manifest_path(self.dataset_path)
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp_path, path)
+
+    def delete(self) -> None:
+        get_manifest_path(self.dataset_path).unlink(missing_ok=True)
+
+    def matches(self, other: "Manifest") -> bool:
+        # datasets can only share chunks if they were split and embedded alike
+        return (
+            self.embedding == other.embedding
+            and self.chunk_size == other.chunk_size
+            and self.chunk_overlap == other.chunk_overlap
+            and self.text_splitter == other.text_splitter
+            and os.path.dirname(self.dataset_path) == os.path.dirname(other.dataset_path)
+        )
+
+    def diff(self, hashes: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        # returns files to (re)index and chunk ids to delete
+        changed = [
+            name
+            for name, file_hash in hashes.items()
+            if self.files.get(name, {}).get("hash") != file_hash
+        ]
+        stale_ids = [
+            chunk_id
+            for name, entry in self.files.items()
+            if name not in hashes or hashes[name] != entry["hash"]
+            for chunk_id in entry["ids"]
+        ]
+        return changed, stale_ids
+
+    def update(self, hashes: Dict[str, str], ids: Dict[str, List[str]]) -> None:
+        previous = self.files
+        self.files = {}
+        for name, file_hash in hashes.items():
+            file_ids = ids[name] if name in ids else previous.get(name, {}).get("ids", [])
+            self.files[name] = {"hash": file_hash, "ids": file_ids}
+
+    def copy_to(self, dataset_path: str) -> "Manifest":
+        manifest = Manifest(**asdict(self))
+        manifest.dataset_path = dataset_path
+        return manifest
+
+
+def find_base_manifest(manifest: Manifest, hashes: Dict[str, str]) -> Optional[Manifest]:
+    # Find an existing dataset sharing most files with the new one, e.g. the same
+    # upload with one more file, so it can be copied and updated incrementally
+    if not MANIFEST_PATH.is_dir():
+        return None
+    wanted = set(hashes.values())
+    best, best_overlap = None, 0
+    for path in MANIFEST_PATH.glob("*.json"):
+        try:
+            with open(path, encoding="utf-8") as f:
+                candidate = Manifest(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            continue
+        if candidate.dataset_path == manifest.dataset_path or not candidate.matches(manifest):
+            continue
+        existing = {entry["hash"] for entry in candidate.files.values()}
+        overlap = len(existing & wanted)
+        if existing and overlap / len(existing) >= MIN_BASE_OVERLAP and overlap > best_overlap:
+            best, best_overlap = candidate, overlap
+    if best is not None:
+        logger.info(
+            f"Reusing {best_overlap} files of dataset '{best.dataset_path}' for "
+            f"'{manifest.dataset_path}'"
+        )
+    return best
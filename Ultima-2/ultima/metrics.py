@@ -0,0 +1,247 @@
+import bisect
+import contextvars
+import functools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from ultima.shared_arrtibs import METRICS_BUCKETS, METRICS_PATH
+from ultima.logging import logger
+from ultima.streaming import _chain_name
+
+PROMETHEUS_NAME = "ultima_stage_seconds"
+
+
+class Histogram:
+    # Prometheus style histogram: observations per bucket upper bound, the
+    # last bucket is +Inf. Quantiles are interpolated within their bucket.
+
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[int]:
+        total, counts = 0, []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, seen = 0.0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                if math.isinf(bound):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+
+class MetricsRegistry:
+    # Duration histograms per pipeline stage, shared by all sessions and requests.
+
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.setdefault(stage, Histogram(self.buckets))
+            histogram.observe(seconds)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.histograms = {}
+
+    def to_json(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                stage: {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "mean": h.sum / h.count,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "buckets": {
+                        "+Inf" if math.isinf(b) else str(b): c
+                        for b, c in zip(h.buckets, h.cumulative())
+                    },
+                }
+                for stage, h in sorted(self.histograms.items())
+            }
+
+    def to_prometheus(self) -> str:
+        lines = [
+            f"# HELP {PROMETHEUS_NAME} Duration of pipeline stages in seconds.",
+            f"# TYPE {PROMETHEUS_NAME} histogram",
+        ]
+        with self._lock:
+            for stage, h in sorted(self.histograms.items()):
+                for bound, count in zip(h.buckets, h.cumulative()):
+                    le = "+Inf" if math.isinf(bound) else repr(bound)
+                    labels = f'stage="{stage}",le="{le}"'
+                    lines.append(f"{PROMETHEUS_NAME}_bucket{{{labels}}} {count}")
+                lines.append(f'{PROMETHEUS_NAME}_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{PROMETHEUS_NAME}_count{{stage="{stage}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: Path = METRICS_PATH) -> None:
+        # JSON for dashboards and a .prom file for node_exporter's textfile collector
+        os.makedirs(path, exist_ok=True)
+        for name, text in [
+            ("metrics.json", json.dumps(self.to_json())),
+            ("ultima.prom", self.to_prometheus()),
+        ]:
+            tmp_path = path / f"{name}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path / name)
+
+
+metrics = MetricsRegistry()
+
+
+@dataclass
+class Trace:
+    # the stages of one request or build, in the order they finished
+    spans: List[Tuple[str, float]] = field(default_factory=list)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.spans.append((stage, seconds))
+
+    def breakdown(self) -> Dict[str, float]:
+        # seconds per stage, stages that ran several times are summed
+        totals: Dict[str, float] = {}
+        for stage, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+
+# trace of the request handled in the current thread or task
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+def record(stage: str, seconds: float, trace: Optional[Trace] = None) -> None:
+    metrics.observe(stage, seconds)
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage: str) -> Callable[[Callable], Callable]:
+    # decorator, every call of the function is a span
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def tracing() -> Iterator[Trace]:
+    trace = Trace()
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        logger.info(
+            "Timings: "
+            + ", ".join(f"{s} {t:.3f}s" for s, t in trace.breakdown().items())
+        )
+
+
+class StageTimingHandler(BaseCallbackHandler):
+    # Times the stages of a ConversationalRetrievalChain call from its chain
+    # callbacks: condensing the question, retrieval (from the end of the
+    # condense step, or the chain start, to the start of the documents chain)
+    # and answering. Works the same for every retriever and vector store.
+
+    def __init__(self, trace: Optional[Trace] = None):
+        self.trace = trace
+        self._starts: Dict[UUID, Tuple[str, Optional[UUID], float]] = {}
+        self._retrieval_start: Optional[float] = None
+
+    def _record(self, stage: str, seconds: float) -> None:
+        record(stage, seconds, self.trace)
+
+    def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        now = time.perf_counter()
+        name = _chain_name(serialized)
+        self._starts[run_id] = (name, parent_run_id, now)
+        if parent_run_id is None:
+            self._retrieval_start = now
+        elif name.endswith("DocumentsChain") and self._retrieval_start is not None:
+            self._record("retrieval", now - self._retrieval_start)
+            self._retrieval_start = None
+
+    def on_chain_end(
+        self,
+        outputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        if run_id not in self._starts:
+            return
+        name, parent, start = self._starts.pop(run_id)
+        now = time.perf_counter()
+        if parent is None:
+            self._record("chain", now - start)
+        elif name.endswith("DocumentsChain"):
+            self._record("answer", now - start)
+        elif name == "LLMChain" and self._retrieval_start is not None:
+            # the question generator, the only LLMChain before retrieval
+            self._record("condense_question", now - start)
+            self._retrieval_start = now
+
+    def on_chain_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._starts.pop(run_id, None)
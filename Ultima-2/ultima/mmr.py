@@ -0,0 +1,94 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(
+    query_embedding: np.ndarray,
+    embedding_list: Sequence,
+    lambda_mult: float = 0.5,
+    k: int = 4,
+    relevance_scores: Optional[Sequence[float]] = None,
+) -> List[int]:
+    # Drop-in replacement for langchain.vectorstores.utils.maximal_marginal_relevance.
+    # The candidate similarity matrix is computed once and the redundancy term is
+    # kept up to date with an incremental running max instead of being recomputed
+    # against every selected document on each step.
+    return batch_maximal_marginal_relevance(
+        np.asarray(query_embedding, dtype=np.float32).reshape(1, -1),
+        [embedding_list],
+        lambda_mult=lambda_mult,
+        k=k,
+        relevance_scores=None if relevance_scores is None else [relevance_scores],
+    )[0]
+
+
+def batch_maximal_marginal_relevance(
+    query_embeddings: np.ndarray,
+    candidate_embeddings: Sequence[Sequence],
+    lambda_mult: float = 0.5,
+    k: int = 4,
+    relevance_scores: Optional[Sequence[Sequence[float]]] = None,
+) -> List[List[int]]:
+    # Runs MMR for several queries at once, each with its own candidate list.
+    # Candidate lists of different length are padded and masked. Relevance is
+    # the similarity to the query unless `relevance_scores` are given, e.g. the
+    # fused scores of a hybrid search.
+    batch_size = len(candidate_embeddings)
+    sizes = [len(candidates) for candidates in candidate_embeddings]
+    n = max(sizes, default=0)
+    if batch_size == 0 or n == 0 or k <= 0:
+        return [[] for _ in range(batch_size)]
+
+    queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+    dim = queries.shape[-1]
+    candidates = np.zeros((batch_size, n, dim), dtype=np.float32)
+    valid = np.zeros((batch_size, n), dtype=bool)
+    for b, embeddings in enumerate(candidate_embeddings):
+        if sizes[b]:
+            candidates[b, : sizes[b]] = np.asarray(embeddings, dtype=np.float32)
+            valid[b, : sizes[b]] = True
+    candidates = _normalize(candidates)
+
+    # padded rows are zero vectors and get masked out when scoring
+    if relevance_scores is None:
+        relevance = np.einsum("bnd,bd->bn", candidates, queries)
+    else:
+        relevance = np.zeros((batch_size, n), dtype=np.float32)
+        for b, scores in enumerate(relevance_scores):
+            relevance[b, : sizes[b]] = scores
+
+    # selecting every candidate only reorders them, relevance order is the answer
+    if k >= n and all(size == n for size in sizes):
+        order = np.argsort(-relevance, axis=1, kind="stable")
+        return order.tolist()
+
+    similarity = np.einsum("bnd,bmd->bnm", candidates, candidates)
+    rows = np.arange(batch_size)
+    selected = np.zeros((batch_size, n), dtype=bool)
+    max_similarity = np.full((batch_size, n), -np.inf, dtype=np.float32)
+    results = [[] for _ in range(batch_size)]
+
+    for step in range(min(k, n)):
+        if step == 0:
+            scores = relevance.copy()
+        else:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected | ~valid] = -np.inf
+        best = np.argmax(scores, axis=1)
+        active = np.isfinite(scores[rows, best])
+        for b in np.flatnonzero(active):
+            results[b].append(int(best[b]))
+        selected[rows[active], best[active]] = True
+        max_similarity[active] = np.maximum(
+            max_similarity[active], similarity[rows[active], best[active]]
+        )
+        if not active.any():
+            break
+    return results
+
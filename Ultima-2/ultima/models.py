@@ -1,21 +1,20 @@
+from __future__ import annotations
+
+import importlib
+import threading
+import time
 from dataclasses import dataclass
-from typing import Any, List
-
-import streamlit as st
-import tiktoken
-import torch
-from langchain.embeddings import HuggingFaceEmbeddings, HuggingFaceInstructEmbeddings
-from InstructorEmbedding import INSTRUCTOR
-from langchain.base_language import BaseLanguageModel
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.embeddings.openai import Embeddings, OpenAIEmbeddings
-from langchain.llms import GPT4All
-from transformers import AutoTokenizer
-
-from ultima.shared_arrtibs import GPT4ALL_BINARY, MODEL_PATH
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, List, Optional
+
+from ultima.shared_arrtibs import EMBEDDING_WORKERS, GPT4ALL_BINARY, MODEL_PATH
 from ultima.logging import logger
+from ultima.registry import registry
+
+# Backends (torch, transformers, openai, ...) are imported inside the branches
+# that need them, so startup and API mode only pay for what is actually used
+if TYPE_CHECKING:
+    from langchain.base_language import BaseLanguageModel
+    from langchain.embeddings.base import Embeddings
 
 
 class Enum:
@@ -37,12 +36,15 @@ class Model:
 class MODES(Enum):
     OPENAI = "API"
     LOCAL = "Local"
+    # deterministic fakes from ultima.fakes, no network and no model weights
+    OFFLINE = "Offline"
 
 
 class EMBEDDINGS(Enum):
     INSTRUCTOR_XL = "hkunlp/instructor-xl"
     ADA002 = "text-embedding-ada-002"
     HUGGINGFACE = "sentence-transformers/all-MiniLM-L6-v2"
+    FAKE = "hashing"
     
 
 
@@ -63,81 +65,237 @@ class MODELS(Enum):
         embedding=EMBEDDINGS.HUGGINGFACE,
         path=str(MODEL_PATH / GPT4ALL_BINARY),
     )
+    STUB = Model(name="stub", mode=MODES.OFFLINE, embedding=EMBEDDINGS.FAKE)
 
     @classmethod
     def for_mode(cls, mode) -> List[Model]:
         return [m for m in cls.all() if isinstance(m, Model) and m.mode == mode]
 
+    @classmethod
+    def by_name(cls, name: str) -> Model:
+        for model in cls.all():
+            if isinstance(model, Model) and model.name == name:
+                return model
+        raise ValueError(f"Model {name} not supported!")
+
+
+# one lock per shared local model, kept when the model itself is evicted
+_model_locks: Dict[Hashable, threading.Lock] = {}
+_model_locks_lock = threading.Lock()
+
+
+def get_model_lock(key: Hashable) -> threading.Lock:
+    with _model_locks_lock:
+        return _model_locks.setdefault(key, threading.Lock())
+
 
 def get_model(options: dict, credentials: dict) -> BaseLanguageModel:
     match options["model"].name:
         case MODELS.GPT35TURBO.name:
+            from langchain.chat_models import ChatOpenAI
+
             model = ChatOpenAI(
                 model_name=options["model"].name,
                 temperature=options["temperature"],
                 openai_api_key=credentials["openai_api_key"],
+                streaming=True,
             )
         case MODELS.GPT4.name:
-                model = ChatOpenAI(
-                    model_name=st.session_state["model"].name,
-                    temperature=st.session_state["temperature"],
-                    openai_api_key=st.session_state["openai_api_key"],
-                )    
+            from langchain.chat_models import ChatOpenAI
+
+            model = ChatOpenAI(
+                model_name=options["model"].name,
+                temperature=options["temperature"],
+                openai_api_key=credentials["openai_api_key"],
+                streaming=True,
+            )
         case MODELS.GPT4ALL.name:
-            model = GPT4All(
-                model=options["model"].path,
-                n_ctx=options["model_n_ctx"],
-                backend="gptj",
-                temp=options["temperature"],
-                verbose=True,
-                callbacks=[StreamingStdOutCallbackHandler()],
+            from langchain.llms import GPT4All
+
+            from ultima.serialized_llm import SerializedLLM
+
+            # local weights are loaded once per process and shared by all sessions,
+            # the temperature of every session is passed with its calls
+            key = ("model", options["model"].path, options["model_n_ctx"])
+            shared = registry.get(
+                key,
+                lambda: GPT4All(
+                    model=options["model"].path,
+                    n_ctx=options["model_n_ctx"],
+                    backend="gptj",
+                    verbose=True,
+                    # tokens go to the callbacks of each call, see ultima.streaming
+                    streaming=True,
+                ),
+            )
+            model = SerializedLLM(
+                llm=shared,
+                lock=get_model_lock(key),
+                params={"temp": options["temperature"]},
             )
+        case MODELS.STUB.name:
+            from ultima.fakes import StubLLM
+
+            model = StubLLM()
 
         case _default:
             msg = f"Model {options['model'].name} not supported!"
             logger.error(msg)
-            st.error(msg)
-            exit
+            # shown to the user by the caller, e.g. update_chain
+            raise ValueError(msg)
     return model
 
 
 def get_embeddings(options: dict, credentials: dict) -> Embeddings:
     match options["model"].embedding:
         case EMBEDDINGS.ADA002:
+            from langchain.embeddings.openai import OpenAIEmbeddings
+
             embeddings = OpenAIEmbeddings(
                 model=EMBEDDINGS.ADA002,
                 disallowed_special=(),
                 openai_api_key=credentials["openai_api_key"],
             )
         case EMBEDDINGS.HUGGINGFACE:
-            embeddings = HuggingFaceEmbeddings(
-                model_name=EMBEDDINGS.HUGGINGFACE, cache_folder=str(MODEL_PATH)
+            from langchain.embeddings import HuggingFaceEmbeddings
+
+            from ultima.embedding_executor import BatchedEmbeddings
+
+            embeddings = BatchedEmbeddings(
+                registry.get(
+                    ("embeddings", EMBEDDINGS.HUGGINGFACE, "auto"),
+                    lambda: HuggingFaceEmbeddings(
+                        model_name=EMBEDDINGS.HUGGINGFACE, cache_folder=str(MODEL_PATH)
+                    ),
+                )
             )
         case EMBEDDINGS.INSTRUCTOR_XL:
+            import torch
+            from langchain.embeddings import HuggingFaceInstructEmbeddings
+
+            from ultima.embedding_executor import BatchedEmbeddings
+
             device = "cuda" if torch.cuda.is_available() else "cpu"
-            embeddings = HuggingFaceInstructEmbeddings(
-                model_name=EMBEDDINGS.INSTRUCTOR_XL, model_kwargs={"device": device}
-                )
+            embeddings = BatchedEmbeddings(
+                registry.get(
+                    ("embeddings", EMBEDDINGS.INSTRUCTOR_XL, device),
+                    lambda: HuggingFaceInstructEmbeddings(
+                        model_name=EMBEDDINGS.INSTRUCTOR_XL,
+                        model_kwargs={"device": device},
+                    ),
+                ),
+                # a GPU runs one batch at a time
+                workers=EMBEDDING_WORKERS if device == "cpu" else 1,
+            )
+        case EMBEDDINGS.FAKE:
+            from ultima.embedding_executor import BatchedEmbeddings
+            from ultima.fakes import HashingEmbeddings
+
+            embeddings = BatchedEmbeddings(HashingEmbeddings())
         case _default:
             msg = f"Embeddings {options['model'].embedding} not supported!"
             logger.error(msg)
-            st.error(msg)
-            exit
+            # shown to the user by the caller, e.g. update_chain
+            raise ValueError(msg)
     return embeddings
 
 
-def get_tokenizer(options: dict) -> Embeddings:
+def get_token_counter(options: dict) -> Optional[Callable[[str], int]]:
+    # counts the tokens of the chat model, needed to price streamed responses
+    if options["model"].mode != MODES.OPENAI:
+        return None
+    import tiktoken
+
+    encoding = registry.get(
+        ("tokenizer", options["model"].name),
+        lambda: tiktoken.encoding_for_model(options["model"].name),
+    )
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def get_tokenizer(options: dict) -> Any:
     match options["model"].embedding:
         case EMBEDDINGS.ADA002:
-            tokenizer = tiktoken.encoding_for_model(EMBEDDINGS.ADA002)
+            import tiktoken
+
+            tokenizer = registry.get(
+                ("tokenizer", EMBEDDINGS.ADA002),
+                lambda: tiktoken.encoding_for_model(EMBEDDINGS.ADA002),
+            )
         case EMBEDDINGS.HUGGINGFACE:
-            tokenizer = AutoTokenizer.from_pretrained(EMBEDDINGS.HUGGINGFACE)
+            from transformers import AutoTokenizer
+
+            tokenizer = registry.get(
+                ("tokenizer", EMBEDDINGS.HUGGINGFACE),
+                lambda: AutoTokenizer.from_pretrained(EMBEDDINGS.HUGGINGFACE),
+            )
         case EMBEDDINGS.INSTRUCTOR_XL:
-            tokenizer = AutoTokenizer.from_pretrained(EMBEDDINGS.INSTRUCTOR_XL)
+            from transformers import AutoTokenizer
+
+            tokenizer = registry.get(
+                ("tokenizer", EMBEDDINGS.INSTRUCTOR_XL),
+                lambda: AutoTokenizer.from_pretrained(EMBEDDINGS.INSTRUCTOR_XL),
+            )
+        case EMBEDDINGS.FAKE:
+            from ultima.fakes import RegexTokenizer
+
+            tokenizer = RegexTokenizer()
 
         case _default:
             msg = f"Tokenizer {options['model'].embedding} not supported!"
             logger.error(msg)
-            st.error(msg)
-            exit
+            # shown to the user by the caller, e.g. update_chain
+            raise ValueError(msg)
     return tokenizer
+
+
+# modules each backend needs on first use, imported ahead of time by warm_up
+BACKEND_MODULES = {
+    MODELS.GPT35TURBO.name: ["openai", "langchain.chat_models"],
+    MODELS.GPT4.name: ["openai", "langchain.chat_models"],
+    MODELS.GPT4ALL.name: ["pygpt4all", "langchain.llms"],
+    EMBEDDINGS.ADA002: ["openai", "tiktoken", "langchain.embeddings.openai"],
+    EMBEDDINGS.HUGGINGFACE: ["torch", "transformers", "sentence_transformers"],
+    EMBEDDINGS.INSTRUCTOR_XL: ["torch", "transformers", "InstructorEmbedding"],
+}
+MODE_MODULES = {
+    MODES.OPENAI: ["deeplake"],
+    MODES.LOCAL: [],
+    MODES.OFFLINE: [],
+}
+
+_warmed_up = set()
+_warm_up_lock = threading.Lock()
+
+
+def import_backend_modules(model: Model) -> Dict[str, float]:
+    # returns seconds spent per module, modules already imported cost ~0
+    timings = {}
+    modules = (
+        MODE_MODULES.get(model.mode, [])
+        + BACKEND_MODULES.get(model.name, [])
+        + BACKEND_MODULES.get(model.embedding, [])
+    )
+    for module in dict.fromkeys(modules):
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.error(f"Warm-up could not import {module}: {e}")
+        timings[module] = time.perf_counter() - start
+    return timings
+
+
+def warm_up(model: Model) -> None:
+    # imports the backends of a model on a daemon thread, once per process,
+    # while the first page renders
+    with _warm_up_lock:
+        if model.name in _warmed_up:
+            return
+        _warmed_up.add(model.name)
+
+    def run() -> None:
+        timings = import_backend_modules(model)
+        logger.info(f"Warm-up for {model} done: {timings}")
+
+    threading.Thread(target=run, name=f"warm-up-{model}", daemon=True).start()
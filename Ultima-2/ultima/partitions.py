@@ -0,0 +1,198 @@
+import contextvars
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.schema import BaseRetriever, Document
+
+from ultima.logging import logger
+from ultima.metrics import span
+
+# metadata filter of the request handled in the current thread or task, e.g.
+# {"file": "Gild-Q1-Prices.csv"} or {"file": [...], "page": 2}
+metadata_filter: contextvars.ContextVar[Optional[Dict[str, Any]]] = (
+    contextvars.ContextVar("metadata_filter", default=None)
+)
+
+# separators file names and questions write differently, "Q1-Prices" vs "q1 prices"
+NAME_SEPARATORS = r"[\s_\-.]*"
+NAME_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+EXTENSION_PATTERN = re.compile(r"\.[a-z0-9]{1,4}$")
+
+
+def get_file(metadata: dict) -> str:
+    # the file of a chunk, datasets indexed before chunks had "file" use the
+    # name of their source
+    return metadata.get("file") or os.path.basename(metadata.get("source", ""))
+
+
+def _matches(value: Any, expected: Any) -> bool:
+    if isinstance(expected, (list, tuple, set)):
+        return value in expected
+    return value == expected
+
+
+def _as_list(value: Any) -> list:
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+def matches_file(metadata: dict, files: List[str]) -> bool:
+    # chunks indexed before chunks had "file" match the files their source path
+    # ends with, "docs/sub/a.txt" is the chunk of "sub/a.txt" and of "a.txt"
+    if "file" in metadata:
+        return metadata["file"] in files
+    source = metadata.get("source", "").replace("\\", "/")
+    return any(source == file or source.endswith("/" + file) for file in files)
+
+
+def matches_filter(metadata: dict, filter: Dict[str, Any]) -> bool:
+    return all(
+        matches_file(metadata, _as_list(expected))
+        if key == "file"
+        else _matches(metadata.get(key), expected)
+        for key, expected in filter.items()
+    )
+
+
+class Partitions:
+    # The rows of every file in a store or index. Searches with a filter on
+    # "file" only touch the rows of the matching files, other keys are checked
+    # on the metadata of those rows.
+
+    def __init__(self, metadatas: List[dict]):
+        self.metadatas = metadatas
+        rows: Dict[str, List[int]] = {}
+        for row, metadata in enumerate(metadatas):
+            rows.setdefault(get_file(metadata), []).append(row)
+        self.files = {
+            file: np.array(file_rows, dtype=np.int64)
+            for file, file_rows in rows.items()
+        }
+        # rows without "file", partitioned by the base name of their source
+        self.legacy_rows = [i for i, m in enumerate(metadatas) if "file" not in m]
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def _file_rows(self, files: List[str]) -> np.ndarray:
+        parts = [self.files[f] for f in files if f in self.files]
+        missing = [f for f in files if f not in self.files]
+        if missing and self.legacy_rows:
+            # relative paths of files in directories, e.g. "sub/a.txt"
+            parts.append(
+                np.array(
+                    [
+                        row
+                        for row in self.legacy_rows
+                        if matches_file(self.metadatas[row], missing)
+                    ],
+                    dtype=np.int64,
+                )
+            )
+        return np.unique(np.concatenate(parts)) if parts else np.empty(0, np.int64)
+
+    def rows(self, filter: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        # sorted rows matching all keys of filter, None without a filter
+        if not filter:
+            return None
+        filter = dict(filter)
+        if "file" in filter:
+            rows = self._file_rows(_as_list(filter.pop("file")))
+        else:
+            rows = np.arange(len(self.metadatas), dtype=np.int64)
+        if filter:
+            keep = [matches_filter(self.metadatas[row], filter) for row in rows]
+            rows = rows[np.array(keep, dtype=bool)] if len(rows) else rows
+        return rows
+
+
+def get_name_pattern(file: str) -> Optional[re.Pattern]:
+    # the file name in any case and with any separators, also without its
+    # extensions as long as more than one word is left, "q1 prices" but not
+    # "data" for data.csv
+    stem = os.path.basename(file).lower()
+    names = [NAME_TOKEN_PATTERN.findall(stem)]
+    while EXTENSION_PATTERN.search(stem):
+        stem = EXTENSION_PATTERN.sub("", stem)
+        tokens = NAME_TOKEN_PATTERN.findall(stem)
+        if len(tokens) > 1:
+            names.append(tokens)
+    names = [tokens for tokens in names if len("".join(tokens)) >= 3]
+    if not names:
+        return None
+    alternatives = [NAME_SEPARATORS.join(map(re.escape, t)) for t in names]
+    return re.compile(r"\b(?:" + "|".join(alternatives) + r")\b")
+
+
+def detect_files(question: str, files: List[str]) -> List[str]:
+    # files named in the question, a name contained in a longer one that is
+    # named as well doesn't count, e.g. "prices" in "q1 prices"
+    text = question.lower()
+    spans = {}
+    for file in files:
+        pattern = get_name_pattern(file)
+        match = pattern.search(text) if pattern else None
+        if match:
+            spans[file] = match.span()
+    return [
+        file
+        for file, (start, end) in spans.items()
+        if not any(
+            s <= start and end <= e and (s, e) != (start, end)
+            for s, e in spans.values()
+        )
+    ]
+
+
+def get_request_files(query: str, files: List[str]) -> Optional[List[str]]:
+    # the files a question is restricted to by the metadata filter of its
+    # request or by naming them, None if it isn't
+    filter = metadata_filter.get()
+    if filter is not None:
+        if "file" not in filter:
+            return None
+        files = filter["file"]
+        return list(files) if isinstance(files, (list, tuple, set)) else [files]
+    return detect_files(query, files) or None
+
+
+def with_search_kwargs(retriever: BaseRetriever, **kwargs: Any) -> BaseRetriever:
+    # a copy of a retriever configured by search_kwargs, with kwargs added
+    search_kwargs = {**retriever.search_kwargs, **kwargs}
+    if hasattr(retriever, "with_search_kwargs"):
+        return retriever.with_search_kwargs(search_kwargs)
+    return retriever.copy(update={"search_kwargs": search_kwargs})
+
+
+class PartitionRetriever(BaseRetriever):
+    # Searches only the partitions of the files named in the question, or of
+    # the metadata filter of the request. Questions naming no file search all.
+
+    def __init__(self, retriever: BaseRetriever, files: List[str]):
+        # a retriever with search_kwargs, the filter is passed on through them
+        self.retriever = retriever
+        self.files = files
+
+    def get_filter(self, query: str) -> Optional[Dict[str, Any]]:
+        filter = metadata_filter.get()
+        if filter is None:
+            with span("retrieval.partitions"):
+                files = detect_files(query, self.files)
+            if files:
+                filter = {"file": files[0] if len(files) == 1 else files}
+        if filter is not None:
+            logger.info(f"Searching partitions {filter}")
+        return filter
+
+    def _retriever(self, query: str) -> BaseRetriever:
+        filter = self.get_filter(query)
+        if filter is None:
+            return self.retriever
+        return with_search_kwargs(self.retriever, filter=filter)
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return self._retriever(query).get_relevant_documents(query)
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return await self._retriever(query).aget_relevant_documents(query)
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from ultima.shared_arrtibs import MODEL_REGISTRY_MAX_BYTES
+from ultima.logging import logger
+
+
+def estimate_size(obj: Any) -> int:
+    # bytes held by a loaded backend, torch weights or a model file on disk
+    for candidate in (obj, getattr(obj, "client", None)):
+        parameters = getattr(candidate, "parameters", None)
+        if callable(parameters):
+            try:
+                return sum(p.numel() * p.element_size() for p in parameters())
+            except Exception:
+                pass
+    path = getattr(obj, "model", None)
+    if isinstance(path, str) and os.path.isfile(path):
+        return os.path.getsize(path)
+    return 0
+
+
+@dataclass
+class RegistryEntry:
+    value: Any
+    size_bytes: int
+    load_seconds: float
+    last_used: float
+    hits: int = 0
+
+
+class ModelRegistry:
+    # Process-wide store of heavyweight backends (local LLMs, embedding models,
+    # tokenizers). Module state survives streamlit reruns, so every session gets
+    # the same instance. Each key is loaded at most once at a time and least
+    # recently used entries are dropped once the RAM budget is exceeded.
+
+    def __init__(self, max_bytes: int = MODEL_REGISTRY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, RegistryEntry]" = OrderedDict()
+        self._loading: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def _lookup(self, key: Hashable) -> Optional[RegistryEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        entry.hits += 1
+        entry.last_used = time.time()
+        self.hits += 1
+        return entry
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry.value
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        # concurrent sessions asking for the same backend wait for one load
+        with key_lock:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry.value
+            start = time.perf_counter()
+            value = loader()
+            load_seconds = time.perf_counter() - start
+            size_bytes = estimate_size(value)
+            with self._lock:
+                self._entries[key] = RegistryEntry(
+                    value, size_bytes, load_seconds, time.time()
+                )
+                self.loads += 1
+                self._loading.pop(key, None)
+                self._evict(keep=key)
+        logger.info(
+            f"Registry loaded {key} in {load_seconds:.1f}s "
+            f"({size_bytes / 1024**2:.0f} MB)"
+        )
+        return value
+
+    def _evict(self, keep: Hashable) -> None:
+        for key in list(self._entries):
+            if self.size_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del self._entries[key]
+            self.evictions += 1
+            logger.info(f"Registry evicted {key}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "entries": {
+                    str(key): {
+                        "size_bytes": entry.size_bytes,
+                        "load_seconds": entry.load_seconds,
+                        "hits": entry.hits,
+                        "last_used": entry.last_used,
+                    }
+                    for key, entry in self._entries.items()
+                },
+            }
+
+
+registry = ModelRegistry()
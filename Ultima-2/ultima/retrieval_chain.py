@@ -1,30 +1,142 @@
+import io
+import os
+from typing import List, Optional
+
 from langchain.chains import ConversationalRetrievalChain
 
-from ultima.vector_store import get_vector_store
+from ultima.shared_arrtibs import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    DISTANCE_METRIC,
+    ENABLE_CONTEXT_ASSEMBLY,
+    ENABLE_HYBRID_SEARCH,
+    ENABLE_PARTITIONS,
+    ENABLE_TABLE_ENGINE,
+    FETCH_K,
+    MAX_TOKENS,
+    MAXIMAL_MARGINAL_RELEVANCE,
+    MMR_LAMBDA,
+    MODEL_N_CTX,
+    TEMPERATURE,
+    TEXT_SPLITTER,
+    K,
+)
+from ultima.chat_history import approximate_tokens
+from ultima.context_assembler import ContextAssemblerRetriever
+from ultima.deeplake_index import DeepLakeRetriever
+from ultima.hybrid_search import HybridRetriever
+from ultima.ingestion import ProgressCallback
+from ultima.load_data import get_source_path, list_source_files
+from ultima.local_vector_store import NumpyVectorStore
+from ultima.partitions import PartitionRetriever
+from ultima.tables import TableRetriever, TableStore
+from ultima.vector_store import (
+    get_dataset_path,
+    get_embedding_function,
+    get_vector_store,
+    open_shared_lexical_index,
+)
 from ultima.logging import logger
-from ultima.models import get_model
+from ultima.metrics import timed
+from ultima.models import Model, get_model, get_token_counter
+
+
+def get_default_options(model: Model) -> dict:
+    # chain options outside of streamlit, same keys as utils.get_options
+    return {
+        "mode": model.mode,
+        "model": model,
+        "k": K,
+        "fetch_k": FETCH_K,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "text_splitter": TEXT_SPLITTER,
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+        "model_n_ctx": MODEL_N_CTX,
+        "distance_metric": DISTANCE_METRIC,
+        "maximal_marginal_relevance": MAXIMAL_MARGINAL_RELEVANCE,
+        "mmr_lambda": MMR_LAMBDA,
+    }
 
 
+def get_env_credentials() -> dict:
+    return {
+        "openai_api_key": os.environ.get("OPENAI_API_KEY"),
+        "activeloop_token": os.environ.get("ACTIVELOOP_TOKEN"),
+        "activeloop_org_name": os.environ.get("ACTIVELOOP_ORG_NAME"),
+    }
+
+
+@timed("build_chain")
 def get_chain(
-    data_source: str, options: dict, credentials: dict
+    data_source: str,
+    options: dict,
+    credentials: dict,
+    progress: Optional[ProgressCallback] = None,
+    uploads: Optional[List[io.BytesIO]] = None,
+    return_source_documents: bool = False,
 ) -> ConversationalRetrievalChain:
     # create the langchain 
-    vector_store = get_vector_store(data_source, options, credentials)
-    retriever = vector_store.as_retriever()
+    vector_store = get_vector_store(
+        data_source, options, credentials, progress, uploads
+    )
     # "fetch_k" and "k" define how many documents are pulled from the hub
     search_kwargs = {
         "maximal_marginal_relevance": options["maximal_marginal_relevance"],
+        # DeepLake only reads the "use_" spelling of the flag
+        "use_maximal_marginal_relevance": options["maximal_marginal_relevance"],
+        "lambda_mult": options["mmr_lambda"],
         "distance_metric": options["distance_metric"],
         "fetch_k": options["fetch_k"],
         "k": options["k"],
     }
-    retriever.search_kwargs.update(search_kwargs)
+    lexical_index = None
+    if ENABLE_HYBRID_SEARCH:
+        dataset_path = get_dataset_path(data_source, options, credentials)
+        lexical_index = open_shared_lexical_index(dataset_path, vector_store)
+    if lexical_index is not None and len(lexical_index):
+        retriever = HybridRetriever(
+            vector_store,
+            lexical_index,
+            get_embedding_function(vector_store),
+            search_kwargs,
+        )
+    elif not isinstance(vector_store, NumpyVectorStore):
+        # filters and MMR of DeepLake scan every sample in python
+        retriever = DeepLakeRetriever(
+            vector_store, get_embedding_function(vector_store), search_kwargs
+        )
+    else:
+        retriever = vector_store.as_retriever()
+        retriever.search_kwargs.update(search_kwargs)
+    if uploads is not None:
+        files = {upload.name: upload for upload in uploads}
+    else:
+        files = list_source_files(data_source) or {}
+    if ENABLE_PARTITIONS and len(files) > 1:
+        retriever = PartitionRetriever(retriever, list(files))
+    if ENABLE_CONTEXT_ASSEMBLY:
+        retriever = ContextAssemblerRetriever(
+            retriever,
+            max_tokens=options["max_tokens"],
+            count_tokens=get_token_counter(options) or approximate_tokens,
+        )
+    if ENABLE_TABLE_ENGINE:
+        # the rows stay embedded as the fallback for all other questions
+        csv_files = [
+            f for f in files.values() if get_source_path(f).lower().endswith(".csv")
+        ]
+        store = TableStore.from_files(csv_files)
+        if store.tables:
+            retriever = TableRetriever(retriever, store, list(files))
     model = get_model(options, credentials)
     chain = ConversationalRetrievalChain.from_llm(
         model,
         retriever=retriever,
         chain_type="stuff",
         verbose=True,
+        return_source_documents=return_source_documents,
         # limit the maximum number of used tokens
         max_tokens_limit=options["max_tokens"],
     )
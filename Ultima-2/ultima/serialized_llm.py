@@ -0,0 +1,38 @@
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+
+class SerializedLLM(LLM):
+    # Runs one generation at a time on a local model shared by all sessions
+    # and chains, its llama/gpt4all backend is not re-entrant.
+
+    llm: Any
+    # from models.get_model_lock, one per shared model
+    lock: Any
+    # generation parameters of this caller, e.g. its temperature
+    params: Dict[str, Any] = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return self.llm._llm_type
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {**self.llm._identifying_params, **self.params}
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.llm.get_num_tokens(text)
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> str:
+        # tokens still stream to the callbacks of this call
+        with self.lock:
+            return self.llm._call(
+                prompt, stop=stop, run_manager=run_manager, **self.params
+            )
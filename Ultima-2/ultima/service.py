@@ -0,0 +1,357 @@
+# Headless question answering over HTTP, next to the streamlit app.
+#
+#   python -m ultima.service --data-source <path or url> --model gpt-4
+#   python -m ultima.service --data-source . --model stub   # offline fakes
+#   python -m ultima.service --data-source a --allow-data-source b  # a or b
+#
+#   POST /ask   {"question": "...", "chat_history": [["q", "a"], ...],
+#                "data_source": "...", "options": {"k": 8, ...},
+#                "filter": {"file": "Gild-Q1-Prices.csv"}}
+#   GET  /stats
+#   GET  /metrics  Prometheus text, ?format=json for JSON
+#   GET  /health
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+from langchain.callbacks import get_openai_callback
+from langchain.chains import ConversationalRetrievalChain
+
+from ultima.shared_arrtibs import (
+    DEFAULT_DATA_SOURCE,
+    ENABLE_SINGLE_FLIGHT,
+    SERVICE_HOST,
+    SERVICE_MAX_CHAINS,
+    SERVICE_MAX_CONCURRENCY,
+    SERVICE_MAX_CONNECTIONS,
+    SERVICE_PORT,
+)
+from ultima.context_assembler import last_assembly
+from ultima.dataset_pool import DatasetLease, dataset_pool
+from ultima.logging import logger
+from ultima.metrics import StageTimingHandler, Trace, metrics, tracing
+from ultima.models import MODELS, MODES, get_token_counter
+from ultima.partitions import metadata_filter
+from ultima.retrieval_chain import get_chain, get_default_options, get_env_credentials
+from ultima.vector_store import get_dataset_path
+from ultima.single_flight import get_flight_key, single_flight
+from ultima.streaming import StreamingResponseHandler
+
+# options a request may override, everything else is fixed by the service
+REQUEST_OPTIONS = [
+    "k",
+    "fetch_k",
+    "temperature",
+    "max_tokens",
+    "distance_metric",
+    "maximal_marginal_relevance",
+    "mmr_lambda",
+]
+
+
+def get_chain_key(data_source: str, options: dict) -> Hashable:
+    digest = hashlib.sha256(
+        json.dumps(options, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    return data_source, digest
+
+
+class ChainPool:
+    # One chain per (data source, options), built once in a worker thread and
+    # shared by all requests. Requests for a chain that is still being built
+    # wait for that build. The least recently used chains beyond `max_chains`
+    # are dropped, models and embeddings stay in the registry.
+
+    def __init__(self, credentials: dict, max_chains: int = SERVICE_MAX_CHAINS):
+        self.credentials = credentials
+        self.max_chains = max_chains
+        self.builds = 0
+        self._chains: "OrderedDict[Hashable, ConversationalRetrievalChain]" = (
+            OrderedDict()
+        )
+        self._building: Dict[Hashable, asyncio.Lock] = {}
+        # local models are not thread safe, their chains run one call at a time
+        self._call_locks: Dict[Hashable, asyncio.Lock] = {}
+        # the datasets of pooled chains stay on disk
+        self._leases: Dict[Hashable, DatasetLease] = {}
+
+    def __len__(self) -> int:
+        return len(self._chains)
+
+    async def get(
+        self, data_source: str, options: dict
+    ) -> Tuple[Hashable, ConversationalRetrievalChain]:
+        key = get_chain_key(data_source, options)
+        if key in self._chains:
+            self._chains.move_to_end(key)
+            return key, self._chains[key]
+        lock = self._building.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self._chains:
+                loop = asyncio.get_running_loop()
+                chain = await loop.run_in_executor(
+                    None,
+                    lambda: get_chain(
+                        data_source,
+                        options,
+                        self.credentials,
+                        return_source_documents=True,
+                    ),
+                )
+                self._chains[key] = chain
+                self._leases[key] = dataset_pool.acquire(
+                    get_dataset_path(data_source, options, self.credentials)
+                )
+                self.builds += 1
+                while len(self._chains) > self.max_chains:
+                    dropped, _ = self._chains.popitem(last=False)
+                    self._call_locks.pop(dropped, None)
+                    self._leases.pop(dropped).release()
+            self._building.pop(key, None)
+        return key, self._chains[key]
+
+    def call_lock(self, key: Hashable) -> asyncio.Lock:
+        return self._call_locks.setdefault(key, asyncio.Lock())
+
+
+class QuestionAnsweringService:
+    def __init__(
+        self,
+        data_source: str,
+        options: dict,
+        credentials: dict,
+        max_concurrency: int = SERVICE_MAX_CONCURRENCY,
+        max_connections: int = SERVICE_MAX_CONNECTIONS,
+        allowed_data_sources: Optional[List[str]] = None,
+    ):
+        self.data_source = data_source
+        # data sources requests may ask for, the configured one by default;
+        # any other would let clients index local paths or fetch urls
+        self.allowed_data_sources = {data_source, *(allowed_data_sources or [])}
+        self.options = options
+        self.max_connections = max_connections
+        self.chains = ChainPool(credentials)
+        self.requests = 0
+        self.in_flight = 0
+        self.failures = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def get_request_data_source(self, data_source: Optional[str]) -> str:
+        if not data_source:
+            return self.data_source
+        if data_source not in self.allowed_data_sources:
+            raise PermissionError(f"Data source '{data_source}' is not allowed")
+        return data_source
+
+    def get_request_options(self, overrides: dict) -> dict:
+        unknown = set(overrides) - set(REQUEST_OPTIONS)
+        if unknown:
+            raise ValueError(f"Options {sorted(unknown)} can't be set per request")
+        return {**self.options, **overrides}
+
+    async def answer(
+        self,
+        question: str,
+        chat_history: list,
+        data_source: str,
+        options: dict,
+        filter: Optional[dict] = None,
+    ) -> dict:
+        # restricts retrieval to the matching chunks, questions without a filter
+        # search the files they name; the chain runs in a copy of this context
+        metadata_filter.set(filter)
+        if not ENABLE_SINGLE_FLIGHT:
+            return await self._traced_answer(
+                question, chat_history, data_source, options
+            )
+        key = get_flight_key(
+            (get_chain_key(data_source, options), filter), question, chat_history
+        )
+        result, shared = await single_flight.ado(
+            key,
+            lambda: self._traced_answer(question, chat_history, data_source, options),
+        )
+        if shared:
+            single_flight.record_saved(result["usage"])
+        return {**result, "coalesced": shared}
+
+    async def _traced_answer(
+        self, question: str, chat_history: list, data_source: str, options: dict
+    ) -> dict:
+        with tracing() as trace:
+            result = await self._answer(
+                question, chat_history, data_source, options, trace
+            )
+        result["timings"] = trace.breakdown()
+        return result
+
+    async def _answer(
+        self,
+        question: str,
+        chat_history: list,
+        data_source: str,
+        options: dict,
+        trace: Trace,
+    ) -> dict:
+        key, chain = await self.chains.get(data_source, options)
+        stream = StreamingResponseHandler(count_tokens=get_token_counter(options))
+        # the trace is passed explicitly, local chains run in a copied context
+        callbacks = [stream, StageTimingHandler(trace)]
+        inputs = {
+            "question": question,
+            "chat_history": [tuple(turn) for turn in chat_history],
+        }
+        with get_openai_callback() as cb:
+            if options["mode"] == MODES.LOCAL:
+                # the worker thread runs in a copy of this context, so that the
+                # openai callback and the context report reach it and come back
+                context = contextvars.copy_context()
+                async with self.chains.call_lock(key):
+                    loop = asyncio.get_running_loop()
+                    response = await loop.run_in_executor(
+                        None, context.run, lambda: chain(inputs, callbacks=callbacks)
+                    )
+                assembly = context.get(last_assembly)
+            else:
+                response = await chain.acall(inputs, callbacks=callbacks)
+                assembly = last_assembly.get()
+        usage = {
+            "total_tokens": cb.total_tokens,
+            "prompt_tokens": cb.prompt_tokens,
+            "completion_tokens": cb.completion_tokens,
+            "total_cost": cb.total_cost,
+        }
+        if not usage["total_tokens"] and stream.count_tokens is not None:
+            usage = stream.usage(options["model"].name)
+        stats = stream.stats()
+        return {
+            "answer": response["answer"],
+            "chat_history": [*chat_history, [question, response["answer"]]],
+            "usage": usage,
+            "time_to_first_token": stats.time_to_first_token if stats else None,
+            "context_tokens_saved": assembly.tokens_saved if assembly else None,
+            "sources": [
+                {"content": doc.page_content, "metadata": doc.metadata}
+                for doc in response.get("source_documents", [])
+            ],
+        }
+
+    async def handle_ask(self, request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+            question = body["question"]
+            chat_history = body.get("chat_history", [])
+            data_source = self.get_request_data_source(body.get("data_source"))
+            options = self.get_request_options(body.get("options") or {})
+            filter = body.get("filter")
+            if filter is not None and not isinstance(filter, dict):
+                raise ValueError("'filter' must be an object of metadata values")
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return web.json_response(
+                {"error": "expected a JSON object with a 'question'"}, status=400
+            )
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        except PermissionError as e:
+            return web.json_response({"error": str(e)}, status=403)
+        self.requests += 1
+        start = time.perf_counter()
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                # every request task sends its OpenAI calls through the shared pool
+                import openai
+
+                openai.aiosession.set(self._session)
+                result = await self.answer(
+                    question, chat_history, data_source, options, filter
+                )
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Failed to answer '{question}': {e}")
+                return web.json_response({"error": str(e)}, status=500)
+            finally:
+                self.in_flight -= 1
+        result["seconds"] = time.perf_counter() - start
+        logger.info(f"Answered '{question}' in {result['seconds']:.2f}s")
+        return web.json_response(result)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "failures": self.failures,
+                "chains": len(self.chains),
+                "chain_builds": self.chains.builds,
+                "datasets": dataset_pool.stats(),
+                "coalescing": single_flight.stats(),
+            }
+        )
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        if request.query.get("format") == "json":
+            return web.json_response(metrics.to_json())
+        return web.Response(
+            text=metrics.to_prometheus(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def on_startup(self, app: web.Application) -> None:
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def on_cleanup(self, app: web.Application) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/ask", self.handle_ask),
+                web.get("/stats", self.handle_stats),
+                web.get("/metrics", self.handle_metrics),
+                web.get("/health", self.handle_health),
+            ]
+        )
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-source", default=DEFAULT_DATA_SOURCE)
+    parser.add_argument("--model", default=MODELS.GPT4.name)
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--max-concurrency", type=int, default=SERVICE_MAX_CONCURRENCY)
+    # further data sources requests may name, besides --data-source
+    parser.add_argument("--allow-data-source", action="append", default=[])
+    args = parser.parse_args()
+
+    service = QuestionAnsweringService(
+        args.data_source,
+        get_default_options(MODELS.by_name(args.model)),
+        get_env_credentials(),
+        max_concurrency=args.max_concurrency,
+        allowed_data_sources=args.allow_data_source,
+    )
+    web.run_app(service.create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 PAGE_ICON = "🌱"
@@ -8,20 +9,107 @@ K = 26
 FETCH_K = 26
 CHUNK_SIZE = 1536
 CHUNK_OVERLAP = 128
+# "token", "recursive", "nltk" or "character", see ultima.load_data.SPLITTERS
+TEXT_SPLITTER = "token"
 TEMPERATURE = 0.25
 MAX_TOKENS = 8192
 MODEL_N_CTX = 1000
 DISTANCE_METRIC = "cos"
 MAXIMAL_MARGINAL_RELEVANCE = True
+# answer aggregation and lookup questions over CSV files by computation
+ENABLE_TABLE_ENGINE = True
+# fuse BM25 keyword search with vector search before MMR
+ENABLE_HYBRID_SEARCH = True
+BM25_K1 = 1.2
+BM25_B = 0.75
+# rank offset of reciprocal rank fusion, higher flattens the rank differences
+RRF_K = 60
+# merge overlapping chunks and pack the context into max_tokens
+ENABLE_CONTEXT_ASSEMBLY = True
+# search only the files named in a question or in the filter of a request
+ENABLE_PARTITIONS = True
+# identical questions asked at the same time share one chain call
+ENABLE_SINGLE_FLIGHT = True
+# questions answered at the same time by python -m ultima.batch
+BATCH_CONCURRENCY = 4
+# attempts after a rate limit or connection error, the delay doubles each time
+BATCH_RETRIES = 5
+BATCH_RETRY_DELAY = 1.0
+BATCH_RETRY_MAX_DELAY = 60.0
+# 1 ranks by relevance only, 0 by diversity only
+MMR_LAMBDA = 0.5
+LOADER_WORKERS = os.cpu_count() or 1
+# seconds a single file may take to load before it is reported as failed
+LOADER_TIMEOUT = 300
+# bytes per read when copying uploads that can't be loaded from memory to disk
+UPLOAD_COPY_BLOCK_SIZE = 1024 * 1024
+# tokens of chat history passed to the chain, older turns are summarized
+CHAT_HISTORY_MAX_TOKENS = 1024
+# latest turns that are always kept verbatim
+CHAT_HISTORY_MIN_TURNS = 1
+# chunks embedded and written to the vector store per call
+INGEST_BATCH_SIZE = 256
+# bytes of loaded but not yet embedded text held in memory during ingestion
+INGEST_MEMORY_LIMIT = 256 * 1024**2
+# drop chunks that are near duplicates of an earlier chunk of the same file,
+# e.g. headers, disclaimers and tables repeated on every page of a PDF
+ENABLE_DEDUP = True
+# estimated Jaccard similarity of the word shingles of two chunks
+DEDUP_THRESHOLD = 0.75
+DEDUP_SHINGLE_SIZE = 3
+# MinHash values per chunk, split into LSH bands of equal size
+DEDUP_PERMUTATIONS = 128
+DEDUP_BANDS = 32
+# threads embedding batches with local models, each gets its share of the cores
+EMBEDDING_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+# padded tokens per batch of local embeddings, long chunks get smaller batches
+EMBEDDING_BATCH_TOKENS = 8192
+EMBEDDING_MAX_BATCH_SIZE = 64
+# "float32", "float16" or "int8" vectors searched by local datasets, compact
+# types rescore their best candidates with the float32 vectors kept on disk
+VECTOR_STORAGE = "float32"
+# candidates per result rescored exactly with compact vector storage
+RESCORE_FACTOR = 4
 
 ENABLE_ADVANCED_OPTIONS = False
 ENABLE_LOCAL_MODE = False
+# import model backends on a background thread right after startup
+WARM_UP_BACKENDS = True
 
 MODEL_PATH = Path.cwd() / "models"
+# RAM budget for models, embeddings and tokenizers shared by all sessions
+MODEL_REGISTRY_MAX_BYTES = 16 * 1024**3
 GPT4ALL_BINARY = "ggml-gpt4all-j-v1.3-groovy.bin"
 EMB_INSTRUCTOR_XL = "hkunlp/instructor-xl"
 
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8080
+# /ask requests answered at the same time, the rest wait for a slot
+SERVICE_MAX_CONCURRENCY = 16
+# pooled connections to the LLM endpoint shared by all requests
+SERVICE_MAX_CONNECTIONS = 64
+# chains kept built, one per data source and options
+SERVICE_MAX_CHAINS = 8
+
 DATA_PATH = Path.cwd() / "data"
+EMBEDDING_CACHE_PATH = DATA_PATH / "embedding_cache.sqlite"
+EMBEDDING_CACHE_MAX_BYTES = 2 * 1024**3
+MANIFEST_PATH = DATA_PATH / "manifests"
+LEXICAL_INDEX_PATH = DATA_PATH / "lexical"
+# stage duration histograms as metrics.json and ultima.prom, after every answer
+METRICS_PATH = DATA_PATH / "metrics"
+# bytes of local datasets kept under DATA_PATH, the least recently used ones
+# that no chain uses are deleted beyond it, None keeps all of them
+DATASET_DISK_QUOTA = 20 * 1024**3
+ENABLE_METRICS_EXPORT = True
+# upper bounds in seconds of the stage duration histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ENABLE_ANSWER_CACHE = True
+# cosine similarity above which two questions share an answer
+ANSWER_CACHE_THRESHOLD = 0.97
+# seconds until a cached answer is recomputed
+ANSWER_CACHE_TTL = 24 * 60 * 60
+ANSWER_CACHE_MAX_ENTRIES = 2048
 DEFAULT_DATA_SOURCE = "https://github.com/Ultima-Insights/WaynePracticum"
 MODE_HELP = """
 TBD
@@ -50,3 +138,8 @@ TBD
 UPLOAD_HELP = """
 TBD
 """
+
+LATENCY_HELP = """
+Seconds spent in each stage of the last response. The metrics of all requests
+can be downloaded as JSON or in the Prometheus text format.
+"""
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from ultima.logging import logger
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+def get_flight_key(key: Hashable, question: str, chat_history: List) -> str:
+    # key identifies dataset, model and options, questions only differing in
+    # case and whitespace with the same history get the same answer
+    return hashlib.sha256(
+        json.dumps(
+            [key, normalize_question(question), chat_history], default=str
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        # the leader stopped without a result or an error for its followers,
+        # e.g. its streamlit session was rerun, they run the call themselves
+        self.abandoned = False
+
+
+class AsyncFlight:
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        # followers awaiting the future
+        self.waiters = 0
+
+
+class SingleFlight:
+    # Process-wide coalescing of identical requests: the first caller of a key
+    # runs the function, callers that arrive while it runs wait for it and get
+    # the same result, or the same exception. Streamlit sessions call from
+    # their own threads, the service from tasks of its event loop.
+
+    def __init__(self):
+        self.executions = 0
+        self.coalesced = 0
+        self.tokens_saved = 0
+        self.cost_saved = 0.0
+        self._flights: Dict[str, Flight] = {}
+        self._async_flights: Dict[str, AsyncFlight] = {}
+        # executions continued for the followers of a cancelled leader
+        self._detached: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function: Callable[[], Any]) -> Tuple[Any, bool]:
+        # (result, whether it was shared with another caller's execution)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.info("Waiting for the answer to an identical question")
+            flight.done.wait()
+            if flight.abandoned:
+                with self._lock:
+                    self.coalesced -= 1
+                return self.do(key, function)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = function()
+        except Exception as e:
+            flight.error = e
+            raise
+        except BaseException:
+            # RerunException, StopException or KeyboardInterrupt belong to the
+            # leader's thread only
+            flight.abandoned = True
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self.executions += 1
+            flight.done.set()
+        return flight.result, False
+
+    async def ado(
+        self, key: str, function: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        flight = self._async_flights.get(key)
+        if flight is not None:
+            with self._lock:
+                self.coalesced += 1
+            flight.waiters += 1
+            try:
+                # a cancelled follower must not cancel the leader's execution
+                return await asyncio.shield(flight.future), True
+            finally:
+                flight.waiters -= 1
+        flight = self._async_flights[key] = AsyncFlight(
+            asyncio.get_running_loop().create_future()
+        )
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            if flight.waiters:
+                # e.g. the leader's client disconnected, the followers' didn't
+                logger.info("Leader cancelled, answering its followers again")
+                task = asyncio.create_task(self._run(key, flight, function))
+                self._detached.add(task)
+                task.add_done_callback(self._detached.discard)
+            else:
+                self._finish(key, flight, error=asyncio.CancelledError())
+            raise
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+            raise
+        self._finish(key, flight, result=result)
+        return result, False
+
+    async def _run(
+        self, key: str, flight: AsyncFlight, function: Callable[[], Awaitable[Any]]
+    ) -> None:
+        try:
+            result = await function()
+        except BaseException as e:
+            self._finish(key, flight, error=e)
+        else:
+            self._finish(key, flight, result=result)
+
+    def _finish(
+        self,
+        key: str,
+        flight: AsyncFlight,
+        result: Any = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        if isinstance(error, asyncio.CancelledError):
+            flight.future.cancel()
+        elif error is not None:
+            flight.future.set_exception(error)
+            # marks it as retrieved, also when no follower waits for it
+            flight.future.exception()
+        else:
+            flight.future.set_result(result)
+        del self._async_flights[key]
+        with self._lock:
+            self.executions += 1
+
+    def record_saved(self, usage: dict) -> None:
+        # the usage of an execution a follower didn't have to pay for
+        with self._lock:
+            self.tokens_saved += usage.get("total_tokens", 0)
+            self.cost_saved += usage.get("total_cost", 0.0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._flights) + len(self._async_flights),
+                "tokens_saved": self.tokens_saved,
+                "cost_saved": self.cost_saved,
+            }
+
+
+single_flight = SingleFlight()
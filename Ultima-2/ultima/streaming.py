@@ -0,0 +1,145 @@
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.openai_info import (
+    MODEL_COST_PER_1K_TOKENS,
+    get_openai_token_cost_for_model,
+    standardize_model_name,
+)
+from langchain.schema import LLMResult
+
+# shown behind the partial answer while tokens are still arriving
+CURSOR = "▌"
+
+
+@dataclass
+class StreamStats:
+    # seconds from the question to the first answer token
+    time_to_first_token: float
+    tokens: int
+    # generation speed once the first token arrived
+    tokens_per_second: float
+    seconds: float
+
+
+def _chain_name(serialized: Dict[str, Any]) -> str:
+    return (serialized.get("id") or [serialized.get("name", "")])[-1]
+
+
+class StreamingResponseHandler(BaseCallbackHandler):
+    # Passes the tokens of the answer to `render` as they are generated.
+    # A ConversationalRetrievalChain also calls the LLM to condense follow-up
+    # questions, only LLM calls that run below a combine documents chain are
+    # streamed (or every call when there is no such chain at all).
+    # OpenAI reports no token usage for streamed calls, with `count_tokens` the
+    # usage of all calls is counted here instead.
+
+    def __init__(
+        self,
+        render: Optional[Callable[[str], None]] = None,
+        count_tokens: Optional[Callable[[str], int]] = None,
+    ):
+        self.render = render
+        self.count_tokens = count_tokens
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.text = ""
+        self.tokens = 0
+        self.start = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.end: Optional[float] = None
+        self._chains: Dict[UUID, str] = {}
+        self._parents: Dict[UUID, Optional[UUID]] = {}
+        self._streaming = False
+
+    def _is_answer(self, parent_run_id: Optional[UUID]) -> bool:
+        if not self._chains:
+            return True
+        while parent_run_id is not None:
+            if self._chains.get(parent_run_id, "").endswith("DocumentsChain"):
+                return True
+            parent_run_id = self._parents.get(parent_run_id)
+        return False
+
+    def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        self._chains[run_id] = _chain_name(serialized)
+        self._parents[run_id] = parent_run_id
+
+    def on_llm_start(
+        self,
+        serialized: Dict[str, Any],
+        prompts: List[str],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        if self.count_tokens is not None:
+            self.prompt_tokens += sum(self.count_tokens(p) for p in prompts)
+        self._streaming = self._is_answer(parent_run_id)
+        if self._streaming:
+            # a retried or refined answer starts over
+            self.text = ""
+            self.tokens = 0
+            self.first_token_at = None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        # every streamed chunk is a single token
+        self.completion_tokens += 1
+        if not self._streaming:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.text += token
+        self.tokens += 1
+        if self.render is not None:
+            self.render(self.text + CURSOR)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        if not self._streaming:
+            return
+        self.end = time.perf_counter()
+        self._streaming = False
+        if self.render is not None and self.text:
+            self.render(self.text)
+
+    def usage(self, model_name: str) -> Dict[str, float]:
+        # same properties as langchain's OpenAICallbackHandler
+        model_name = standardize_model_name(model_name)
+        total_cost = 0.0
+        if model_name in MODEL_COST_PER_1K_TOKENS:
+            total_cost = get_openai_token_cost_for_model(
+                model_name, self.prompt_tokens
+            ) + get_openai_token_cost_for_model(
+                model_name, self.completion_tokens, is_completion=True
+            )
+        return {
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_cost": total_cost,
+        }
+
+    def stats(self) -> Optional[StreamStats]:
+        # None if the backend did not stream
+        if self.first_token_at is None:
+            return None
+        end = self.end or time.perf_counter()
+        generating = end - self.first_token_at
+        return StreamStats(
+            time_to_first_token=self.first_token_at - self.start,
+            tokens=self.tokens,
+            tokens_per_second=self.tokens / generating if generating > 0 else 0.0,
+            seconds=end - self.start,
+        )
@@ -0,0 +1,417 @@
+import calendar
+import io
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from langchain.schema import BaseRetriever, Document
+
+from ultima.logging import logger
+from ultima.metrics import span
+from ultima.partitions import detect_files, get_request_files
+
+# headers like "2022/06/10\nTRx": a date and the measure of the column
+DATE_HEADER_PATTERN = re.compile(
+    r"^\s*(\d{4}[/-]\d{1,2}[/-]\d{1,2})\s*(.*?)\s*$", re.S
+)
+WORD_PATTERN = re.compile(r"[a-z][a-z0-9]+")
+AGGREGATIONS = {
+    "sum": ["sum", "total", "cumulative"],
+    "mean": ["average", "avg", "mean"],
+    "max": ["max", "maximum", "highest", "peak"],
+    "min": ["min", "minimum", "lowest"],
+}
+# only ask for a number next to a quantity, "most sold" but not "most important"
+QUANTITY_AGGREGATIONS = {"most": "max", "least": "min"}
+HOW_MUCH_PATTERN = re.compile(r"\bhow (?:much|many)\b")
+QUANTITY_WORDS = [
+    "sold",
+    "prescribed",
+    "prescriptions",
+    "scripts",
+    "units",
+    "volume",
+    "weekly",
+]
+# words asking for money, answered by joining a price table
+PRICE_WORDS = ["price", "prices", "revenue", "sales", "dollar", "dollars", "cost"]
+# words of column headers that name a period rather than a value, e.g. "Q1 price"
+PERIOD_WORD_PATTERN = re.compile(r"^(?:q[1-4]|20\d{2}|\d+)$")
+MONTHS = {m.lower(): i for i, m in enumerate(calendar.month_name) if m}
+MONTHS.update({m.lower(): i for i, m in enumerate(calendar.month_abbr) if m})
+
+
+def _first_word(key: str) -> str:
+    words = WORD_PATTERN.findall(key.lower())
+    return words[0] if words else key.lower()
+
+
+@dataclass
+class Table:
+    # A CSV file as typed columns. The first text column is the key column and
+    # becomes the index, numeric columns stay numeric. Date headers are parsed,
+    # so weekly tables can be sliced by period with a boolean mask.
+    name: str
+    frame: pd.DataFrame
+    key_column: str
+    # parsed date of each column of `frame`, NaT for columns without a date
+    dates: pd.DatetimeIndex
+    # e.g. "TRx", shared by all date columns
+    measure: Optional[str] = None
+    # first word of every key -> key, the index used to find keys in questions
+    aliases: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def is_series(self) -> bool:
+        return bool(self.dates.notna().any())
+
+    def find_key(self, term: str) -> Optional[str]:
+        # exact first word or a prefix of at least 3 letters, e.g. "bik"
+        term = term.lower()
+        if term in self.aliases:
+            return self.aliases[term]
+        if len(term) < 3:
+            return None
+        matches = [k for a, k in self.aliases.items() if a.startswith(term)]
+        return matches[0] if len(matches) == 1 else None
+
+    def describe(self) -> str:
+        if self.is_series:
+            dates = self.dates.dropna()
+            return (
+                f"{self.name}: {self.measure or 'values'} of {len(self.frame)} "
+                f"{self.key_column.lower()} over {len(dates)} dates from "
+                f"{dates.min():%Y-%m-%d} to {dates.max():%Y-%m-%d}"
+            )
+        return (
+            f"{self.name}: {', '.join(self.frame.columns)} of {len(self.frame)} "
+            f"{self.key_column.lower()}"
+        )
+
+
+def load_table(path: Union[str, io.BytesIO]) -> Optional[Table]:
+    # None if the file has no text key column or no numeric columns
+    if isinstance(path, io.BytesIO):
+        # uploads are read from memory
+        path.seek(0)
+    frame = pd.read_csv(path, encoding="utf-8-sig", skipinitialspace=True)
+    frame.columns = [str(c).lstrip("﻿").strip() for c in frame.columns]
+    text_columns = [c for c in frame.columns if frame[c].dtype == object]
+    if not text_columns:
+        return None
+    key_column = text_columns[0]
+    frame[key_column] = frame[key_column].astype(str).str.strip()
+    frame = frame.set_index(key_column)
+    for column in frame.columns:
+        if frame[column].dtype == object:
+            cleaned = frame[column].astype(str).str.replace(r"[,$\s]", "", regex=True)
+            frame[column] = pd.to_numeric(cleaned, errors="coerce")
+    frame = frame.select_dtypes(include="number")
+    if frame.empty:
+        return None
+    dates, measures = [], set()
+    for column in frame.columns:
+        match = DATE_HEADER_PATTERN.match(column)
+        if match:
+            dates.append(pd.to_datetime(match.group(1).replace("-", "/")))
+            measures.add(match.group(2))
+        else:
+            dates.append(pd.NaT)
+    aliases = {}
+    for key in frame.index:
+        aliases.setdefault(_first_word(key), key)
+    return Table(
+        name=os.path.basename(path if isinstance(path, str) else path.name),
+        frame=frame,
+        key_column=key_column,
+        dates=pd.DatetimeIndex(dates),
+        measure=measures.pop() if len(measures) == 1 else None,
+        aliases=aliases,
+    )
+
+
+def parse_period(
+    question: str, dates: pd.DatetimeIndex
+) -> Tuple[np.ndarray, Optional[str]]:
+    # boolean mask over `dates` and a description, all dates if none is named
+    text = question.lower()
+    valid = dates.notna()
+    years = sorted(set(dates[valid].year))
+    year_match = re.search(r"\b(20\d{2})\b", text)
+    year = int(year_match.group(1)) if year_match else None
+
+    explicit = re.findall(r"\b(\d{4}[/-]\d{1,2}[/-]\d{1,2})\b", text)
+    if explicit:
+        bounds = sorted(pd.to_datetime(d.replace("-", "/")) for d in explicit)
+        start, end = bounds[0], bounds[-1]
+        return valid & (dates >= start) & (dates <= end), (
+            f"{start:%Y-%m-%d} to {end:%Y-%m-%d}"
+        )
+
+    last = re.search(r"\blast (\d+) weeks?\b", text)
+    if last:
+        selected = np.zeros(len(dates), dtype=bool)
+        order = np.argsort(dates.values)
+        order = order[valid[order]][-int(last.group(1)) :]
+        selected[order] = True
+        return selected, f"last {last.group(1)} weeks"
+
+    quarter = re.search(r"\bq([1-4])\b(?:\s*(?:of\s*)?'?(\d{2,4})\b)?", text)
+    if quarter:
+        number = int(quarter.group(1))
+        if quarter.group(2):
+            year = int(quarter.group(2)) % 100 + 2000
+        in_quarter = valid & (dates.quarter == number)
+        if year is None:
+            # the latest year that has this quarter
+            candidates = sorted(set(dates[in_quarter].year))
+            year = candidates[-1] if candidates else years[-1]
+        return in_quarter & (dates.year == year), f"Q{number} {year}"
+
+    for word in WORD_PATTERN.findall(text):
+        if word in MONTHS and len(word) >= 3 and word not in ("mar", "may"):
+            month = MONTHS[word]
+            in_month = valid & (dates.month == month)
+            if year is None:
+                candidates = sorted(set(dates[in_month].year))
+                year = candidates[-1] if candidates else years[-1]
+            name = calendar.month_name[month]
+            return in_month & (dates.year == year), f"{name} {year}"
+
+    if year is not None:
+        return valid & (dates.year == year), str(year)
+    return valid, None
+
+
+def parse_aggregation(question: str, quantity: bool = False) -> Optional[str]:
+    # quantity: whether the question names a measure, amount or money
+    words = set(WORD_PATTERN.findall(question.lower()))
+    for aggregation, keywords in AGGREGATIONS.items():
+        if words.intersection(keywords):
+            return aggregation
+    if quantity:
+        for word, aggregation in QUANTITY_AGGREGATIONS.items():
+            if word in words:
+                return aggregation
+        if HOW_MUCH_PATTERN.search(question.lower()):
+            return "sum"
+    return None
+
+
+def _singular(word: str) -> str:
+    return word[:-1] if len(word) > 3 and word.endswith("s") else word
+
+
+def get_value_words(table: Table) -> set:
+    # words of the value columns of a table, without periods
+    return {
+        _singular(w)
+        for c in table.frame.columns
+        for w in WORD_PATTERN.findall(c.lower())
+        if not PERIOD_WORD_PATTERN.match(w)
+    }
+
+
+def _format(value: float) -> str:
+    return f"{value:,.0f}" if float(value).is_integer() else f"{value:,.2f}"
+
+
+class TableStore:
+    # CSV data sources kept in memory as columnar tables. Aggregation and
+    # lookup questions are answered by vectorized computation, the compact
+    # result is all the LLM gets to see.
+
+    def __init__(self, tables: List[Table]):
+        self.tables = tables
+
+    @classmethod
+    def from_files(cls, paths: List[Union[str, io.BytesIO]]) -> "TableStore":
+        tables = []
+        for path in paths:
+            try:
+                table = load_table(path)
+            except Exception as e:
+                name = path if isinstance(path, str) else path.name
+                logger.error(f"Could not load table {name}: {e}")
+                continue
+            if table is not None:
+                tables.append(table)
+                logger.info(f"Loaded table {table.describe()}")
+        return cls(tables)
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+    def find_keys(self, question: str, table: Table) -> List[str]:
+        keys = []
+        for word in WORD_PATTERN.findall(question.lower()):
+            key = table.find_key(word)
+            if key is not None and key not in keys:
+                keys.append(key)
+        return keys
+
+    def join_key(self, key: str, table: Table) -> Optional[str]:
+        # keys of different files rarely match exactly, "bik" vs "BIKTARVY ..."
+        first = _first_word(key)
+        if first in table.aliases:
+            return table.aliases[first]
+        matches = [
+            k
+            for a, k in table.aliases.items()
+            if a.startswith(first) or first.startswith(a)
+        ]
+        return matches[0] if len(matches) == 1 else None
+
+    def _aggregate(
+        self, question: str, table: Table, aggregation: str, keys: List[str]
+    ) -> str:
+        mask, period = parse_period(question, table.dates)
+        if not mask.any():
+            return f"{table.name} has no data for {period}."
+        rows = table.frame.loc[keys] if keys else table.frame
+        values = rows.to_numpy(dtype=float)[:, mask]
+        result = getattr(np, f"nan{aggregation}")(values, axis=1)
+        dates = table.dates[mask]
+        lines = [
+            f"{aggregation.capitalize()} of weekly {table.measure or 'values'} per "
+            f"{table.key_column} from {table.name}, {int(mask.sum())} weeks "
+            f"from {dates.min():%Y-%m-%d} to {dates.max():%Y-%m-%d}"
+            + (f" ({period})" if period else "")
+            + ":"
+        ]
+        prices = self._prices(question, table) if aggregation == "sum" else None
+        total, total_revenue = 0.0, 0.0
+        for key, value in zip(rows.index, result):
+            line = f"- {key}: {_format(value)}"
+            total += value
+            if prices is not None:
+                price_table, price_column, price = prices.get(key, (None, None, None))
+                if price is not None:
+                    revenue = value * price
+                    total_revenue += revenue
+                    line += f" x {price_column} {_format(price)} = ${_format(revenue)}"
+            lines.append(line)
+        if len(rows) > 1 and aggregation == "sum":
+            lines.append(f"Total: {_format(total)}")
+            if prices:
+                lines.append(f"Total revenue: ${_format(total_revenue)}")
+        if prices:
+            matched = len(prices.keys() & set(rows.index))
+            lines.append(
+                "Prices from "
+                + ", ".join(sorted({p[0] for p in prices.values()}))
+                + f", {matched} of {len(rows)} keys matched."
+            )
+        return "\n".join(lines)
+
+    def _prices(
+        self, question: str, series: Table
+    ) -> Optional[Dict[str, Tuple[str, str, float]]]:
+        # series key -> (price table, price column, price) when money is asked for
+        words = set(WORD_PATTERN.findall(question.lower()))
+        if not words.intersection(PRICE_WORDS) and "$" not in question:
+            return None
+        for table in self.tables:
+            if table.is_series or table.frame.shape[1] != 1:
+                continue
+            column = table.frame.columns[0]
+            prices = {}
+            for key, price in table.frame[column].items():
+                joined = self.join_key(key, series)
+                if joined is not None and not np.isnan(price):
+                    prices[joined] = (table.name, column, float(price))
+            if prices:
+                return prices
+        return None
+
+    def _lookup(self, table: Table, keys: List[str]) -> str:
+        rows = table.frame.loc[keys]
+        lines = [f"From {table.name}:"]
+        for key, row in rows.iterrows():
+            values = ", ".join(f"{c}: {_format(v)}" for c, v in row.items())
+            lines.append(f"- {key}: {values}")
+        return "\n".join(lines)
+
+    def answer(
+        self, question: str, names: Optional[List[str]] = None
+    ) -> Optional[str]:
+        # None if the question is not an aggregation or lookup over a table,
+        # only the tables in names are used if given
+        tables = [t for t in self.tables if names is None or t.name in names]
+        words = set(WORD_PATTERN.findall(question.lower()))
+        singular_words = {_singular(w) for w in words}
+        named = set(detect_files(question, [t.name for t in tables]))
+        # lookups in the value tables named by file or by their value column
+        for table in tables:
+            if table.is_series:
+                continue
+            keys = self.find_keys(question, table)
+            value_named = bool(singular_words & get_value_words(table))
+            if keys and (table.name in named or value_named):
+                return self._lookup(table, keys)
+        money = bool(words.intersection(PRICE_WORDS)) or "$" in question
+        for table in tables:
+            if not table.is_series:
+                continue
+            keys = self.find_keys(question, table)
+            measure = bool(table.measure) and table.measure.lower() in words
+            period = parse_period(question, table.dates)[1] is not None
+            quantity = measure or money or bool(words.intersection(QUANTITY_WORDS))
+            aggregation = parse_aggregation(question, quantity)
+            # a number is asked for about something the table has
+            if aggregation and not (quantity or period):
+                aggregation = None
+            # "which product", over all keys
+            key_named = _singular(table.key_column.lower()) in singular_words
+            if (aggregation or measure) and (keys or measure or key_named):
+                return self._aggregate(question, table, aggregation or "sum", keys)
+        return None
+
+
+class TableRetriever(BaseRetriever):
+    # Puts the result of aggregation and lookup questions over CSV tables
+    # first, as a computed document, before the documents of the wrapped
+    # retriever. Questions restricted to files, by the metadata filter or by
+    # naming them, only use the tables of those files.
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        store: TableStore,
+        files: Optional[List[str]] = None,
+    ):
+        self.retriever = retriever
+        self.store = store
+        # all files of the data source, the tables' by default
+        self.files = files or [table.name for table in store.tables]
+
+    def _answer(self, query: str) -> List[Document]:
+        files = get_request_files(query, self.files)
+        names = None if files is None else [os.path.basename(f) for f in files]
+        try:
+            result = self.store.answer(query, names)
+        except Exception as e:
+            logger.error(f"Table computation failed for '{query}': {e}")
+            return []
+        if result is None:
+            return []
+        logger.info(f"Answered '{query}' from tables:\n{result}")
+        sources = ", ".join(
+            table.name
+            for table in self.store.tables
+            if names is None or table.name in names
+        )
+        return [Document(page_content=result, metadata={"source": sources})]
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        with span("retrieval.tables"):
+            docs = self._answer(query)
+        return docs + self.retriever.get_relevant_documents(query)
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        with span("retrieval.tables"):
+            docs = self._answer(query)
+        return docs + await self.retriever.aget_relevant_documents(query)
@@ -0,0 +1,129 @@
+import copy
+from bisect import bisect_right
+from typing import Any, List, Optional, Sequence, Tuple
+
+from langchain.schema import Document
+from langchain.text_splitter import TextSplitter
+
+# separators in order of preference for chunk boundaries
+SEPARATORS = ["\n\n", "\n", ". ", " "]
+
+
+def _char_offsets_from_bytes(
+    text: str, token_lengths: List[int]
+) -> Tuple[List[int], List[int]]:
+    # tiktoken works on utf-8 bytes, map token byte ranges back to characters
+    if text.isascii():
+        char_of_byte = None
+    else:
+        char_of_byte = [i for i, ch in enumerate(text) for _ in ch.encode("utf-8")]
+    starts, ends = [], []
+    position = 0
+    for length in token_lengths:
+        start, end = position, position + length
+        position = end
+        if char_of_byte is None:
+            starts.append(start)
+            ends.append(end)
+        else:
+            starts.append(char_of_byte[min(start, len(char_of_byte) - 1)])
+            ends.append(char_of_byte[min(end, len(char_of_byte)) - 1] + 1)
+    return starts, ends
+
+
+def token_offsets(tokenizer: Any, text: str) -> Tuple[List[int], List[int]]:
+    # character (start, end) of every token, computed with a single encode
+    if getattr(tokenizer, "is_fast", False):
+        # huggingface fast tokenizers report offsets directly
+        encoding = tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+        offsets = [(s, e) for s, e in encoding["offset_mapping"] if e > s]
+        return [s for s, _ in offsets], [e for _, e in offsets]
+    if hasattr(tokenizer, "decode_single_token_bytes"):
+        tokens = tokenizer.encode(text, disallowed_special=())
+        lengths = [len(tokenizer.decode_single_token_bytes(t)) for t in tokens]
+        return _char_offsets_from_bytes(text, lengths)
+    # slow tokenizers without offsets: spread the tokens evenly over the text
+    n = len(tokenizer.encode(text)) or 1
+    bounds = [round(i * len(text) / n) for i in range(n + 1)]
+    return bounds[:-1], bounds[1:]
+
+
+class TokenOffsetTextSplitter(TextSplitter):
+    # Splits on token offsets: each document is encoded once, chunks of chunk_size
+    # tokens (overlapping by chunk_overlap) are cut directly on the offsets and
+    # moved back to the nearest separator boundary when one is close enough.
+    # Unlike RecursiveCharacterTextSplitter with a token length_function no text
+    # is ever re-tokenized. Chunk offsets are stored as start_index/end_index.
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        separators: Optional[Sequence[str]] = None,
+        min_fill: float = 0.5,
+        **kwargs: Any,
+    ):
+        super().__init__(**kwargs)
+        self.tokenizer = tokenizer
+        self.separators = list(separators or SEPARATORS)
+        # chunks are never cut to less than this fraction of chunk_size
+        self.min_fill = min_fill
+
+    def _snap_to_separator(
+        self, text: str, starts: List[int], ends: List[int], start: int, end: int
+    ) -> int:
+        lowest = start + max(1, int(self._chunk_size * self.min_fill))
+        if lowest >= end:
+            return end
+        window_start, window_end = starts[lowest], ends[end - 1]
+        for separator in self.separators:
+            position = text.rfind(separator, window_start, window_end)
+            if position == -1:
+                continue
+            # last token that ends before or with the separator
+            cut = bisect_right(ends, position + len(separator), start + 1, end)
+            if cut > lowest:
+                return cut
+        return end
+
+    def split_offsets(self, text: str) -> List[Tuple[int, int]]:
+        starts, ends = token_offsets(self.tokenizer, text)
+        n = len(starts)
+        chunks = []
+        start = 0
+        while start < n:
+            end = min(start + self._chunk_size, n)
+            if end < n:
+                end = self._snap_to_separator(text, starts, ends, start, end)
+            chunk_start, chunk_end = starts[start], ends[end - 1]
+            chunk = text[chunk_start:chunk_end]
+            stripped = chunk.strip()
+            if stripped:
+                chunk_start += len(chunk) - len(chunk.lstrip())
+                chunks.append((chunk_start, chunk_start + len(stripped)))
+            if end >= n:
+                break
+            start = max(end - self._chunk_overlap, start + 1)
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.split_offsets(text)]
+
+    def create_documents(
+        self, texts: List[str], metadatas: Optional[List[dict]] = None
+    ) -> List[Document]:
+        metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, metadata in zip(texts, metadatas):
+            for start, end in self.split_offsets(text):
+                chunk_metadata = copy.deepcopy(metadata)
+                chunk_metadata["start_index"] = start
+                chunk_metadata["end_index"] = end
+                documents.append(
+                    Document(page_content=text[start:end], metadata=chunk_metadata)
+                )
+        return documents
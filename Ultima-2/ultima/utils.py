@@ -1,7 +1,6 @@
 import os
+from typing import Callable, Optional, Tuple
 
-import deeplake
-import openai
 import streamlit as st
 from dotenv import load_dotenv
 from langchain.callbacks import OpenAICallbackHandler, get_openai_callback
@@ -15,22 +14,44 @@ from ultima.shared_arrtibs import (
     DEFAULT_DATA_SOURCE,
     DISTANCE_METRIC,
     ENABLE_ADVANCED_OPTIONS,
+    ENABLE_ANSWER_CACHE,
     ENABLE_LOCAL_MODE,
+    ENABLE_METRICS_EXPORT,
+    ENABLE_SINGLE_FLIGHT,
     FETCH_K,
     LOCAL_MODE_DISABLED_HELP,
     MAX_TOKENS,
     MAXIMAL_MARGINAL_RELEVANCE,
+    MMR_LAMBDA,
     MODE_HELP,
     MODEL_N_CTX,
     OPENAI_HELP,
     PAGE_ICON,
     PROJECT_URL,
     TEMPERATURE,
+    TEXT_SPLITTER,
+    WARM_UP_BACKENDS,
     K,
 )
-from ultima.input_output import delete_files, save_files
+from ultima.answer_cache import answer_cache, get_answer_cache_key
+from ultima.chat_history import ChatHistory, get_summarizer
+from ultima.context_assembler import last_assembly
+from ultima.dataset_pool import dataset_pool
+from ultima.embedding_cache import CachedEmbeddings
+from ultima.ingestion import IngestProgress
+from ultima.input_output import get_upload_data_source
 from ultima.logging import logger
-from ultima.models import MODELS, MODES
+from ultima.metrics import StageTimingHandler, Trace, metrics, span, tracing
+from ultima.models import (
+    MODELS,
+    MODES,
+    get_embeddings,
+    get_token_counter,
+    warm_up,
+)
+from ultima.single_flight import get_flight_key, single_flight
+from ultima.streaming import StreamingResponseHandler
+from ultima.vector_store import get_dataset_path
 
 # loads environment variables
 load_dotenv()
@@ -41,10 +62,15 @@ def initialize_session_state():
     SESSION_DEFAULTS = {
         "past": [],
         "usage": {},
-        "chat_history": [],
+        "stream_stats": [],
+        "last_trace": None,
+        "chat_history": ChatHistory(),
         "generated": [],
         "auth_ok": False,
         "chain": None,
+        "answer_cache_key": None,
+        "dataset_lease": None,
+        "query_embeddings": None,
         "openai_api_key": None,
         "activeloop_token": None,
         "activeloop_org_name": None,
@@ -57,16 +83,21 @@ def initialize_session_state():
         "fetch_k": FETCH_K,
         "chunk_size": CHUNK_SIZE,
         "chunk_overlap": CHUNK_OVERLAP,
+        "text_splitter": TEXT_SPLITTER,
         "temperature": TEMPERATURE,
         "max_tokens": MAX_TOKENS,
         "model_n_ctx": MODEL_N_CTX,
         "distance_metric": DISTANCE_METRIC,
         "maximal_marginal_relevance": MAXIMAL_MARGINAL_RELEVANCE,
+        "mmr_lambda": MMR_LAMBDA,
     }
 
     for k, v in SESSION_DEFAULTS.items():
         if k not in st.session_state:
             st.session_state[k] = v
+    if WARM_UP_BACKENDS:
+        # import the backends of the selected model while the page renders
+        warm_up(st.session_state["model"])
 
 
 def authentication_form() -> None:
@@ -86,7 +117,7 @@ def authentication_form() -> None:
             authenticate(openai_api_key, activeloop_token, activeloop_org_name)
 
 def app_can_be_started():
-    return st.session_state["auth_ok"] or st.session_state["mode"] == MODES.LOCAL
+    return st.session_state["auth_ok"] or st.session_state["mode"] != MODES.OPENAI
 
 
 def update_model_on_mode_change():
@@ -132,6 +163,10 @@ def authenticate(
         st.session_state["auth_ok"] = False
         st.error("Credentials neither set nor stored", icon=PAGE_ICON)
         return
+    # imported here so that startup doesn't pay for them
+    import deeplake
+    import openai
+
     try:
         # Try to access embeddign and deeplake
         with st.spinner("Authentifying..."):
@@ -154,40 +189,82 @@ def authenticate(
     logger.info("Authentification successful!")
 
 
+def get_options() -> dict:
+    # chain options of the current session
+    return {
+        "mode": st.session_state["mode"],
+        "model": st.session_state["model"],
+        "k": st.session_state["k"],
+        "fetch_k": st.session_state["fetch_k"],
+        "chunk_size": st.session_state["chunk_size"],
+        "chunk_overlap": st.session_state["chunk_overlap"],
+        "text_splitter": st.session_state["text_splitter"],
+        "temperature": st.session_state["temperature"],
+        "max_tokens": st.session_state["max_tokens"],
+        "model_n_ctx": st.session_state["model_n_ctx"],
+        "distance_metric": st.session_state["distance_metric"],
+        "maximal_marginal_relevance": st.session_state["maximal_marginal_relevance"],
+        "mmr_lambda": st.session_state["mmr_lambda"],
+    }
+
+
+def get_credentials() -> dict:
+    return {
+        "openai_api_key": st.session_state["openai_api_key"],
+        "activeloop_token": st.session_state["activeloop_token"],
+        "activeloop_org_name": st.session_state["activeloop_org_name"],
+    }
+
+
 def update_chain() -> None:
     # Build chain with parameters
     # delete chat history 
     try:
-        with st.session_state["info_container"], st.spinner("Building Chain..."):
+        with st.session_state["info_container"], st.spinner(
+            "Building Chain..."
+        ), tracing():
             data_source = st.session_state["data_source"]
+            uploads = None
             if st.session_state["uploaded_files"] == st.session_state["data_source"]:
-                data_source = save_files(st.session_state["uploaded_files"])
+                # indexed from memory, nothing is written to DATA_PATH
+                uploads = st.session_state["uploaded_files"]
+                data_source = get_upload_data_source(uploads)
+            progress_bar = st.progress(0.0)
+
+            def show_progress(progress: IngestProgress) -> None:
+                progress_bar.progress(
+                    progress.fraction,
+                    text=f"{progress.stage.capitalize()}: {progress.files_done}/"
+                    f"{progress.files_total} files, {progress.chunks_done} chunks",
+                )
+
+            options = get_options()
+            credentials = get_credentials()
             st.session_state["chain"] = get_chain(
                 data_source=data_source,
-                options={
-                    "mode": st.session_state["mode"],
-                    "model": st.session_state["model"],
-                    "k": st.session_state["k"],
-                    "fetch_k": st.session_state["fetch_k"],
-                    "chunk_size": st.session_state["chunk_size"],
-                    "chunk_overlap": st.session_state["chunk_overlap"],
-                    "temperature": st.session_state["temperature"],
-                    "max_tokens": st.session_state["max_tokens"],
-                    "model_n_ctx": st.session_state["model_n_ctx"],
-                    "distance_metric": st.session_state["distance_metric"],
-                    "maximal_marginal_relevance": st.session_state[
-                        "maximal_marginal_relevance"
-                    ],
-                },
-                credentials={
-                    "openai_api_key": st.session_state["openai_api_key"],
-                    "activeloop_token": st.session_state["activeloop_token"],
-                    "activeloop_org_name": st.session_state["activeloop_org_name"],
-                },
+                options=options,
+                credentials=credentials,
+                progress=show_progress,
+                uploads=uploads,
+            )
+            progress_bar.empty()
+            dataset_path = get_dataset_path(data_source, options, credentials)
+            # keeps the dataset on disk while this session uses it, the previous
+            # lease is released when it is replaced
+            st.session_state["dataset_lease"] = dataset_pool.acquire(dataset_path)
+            # answers are shared between sessions on the same dataset and settings
+            st.session_state["answer_cache_key"] = get_answer_cache_key(
+                dataset_path, options
+            )
+            st.session_state["query_embeddings"] = CachedEmbeddings(
+                get_embeddings(options, credentials), options["model"].embedding
+            )
+            # older turns are summarized by the model of the chain
+            llm = st.session_state["chain"].question_generator.llm
+            st.session_state["chat_history"] = ChatHistory(
+                count_tokens=get_token_counter(options),
+                summarize=get_summarizer(llm),
             )
-            if st.session_state["uploaded_files"] == st.session_state["data_source"]:
-                delete_files(st.session_state["uploaded_files"])
-            st.session_state["chat_history"] = []
             msg = f"Data source **{st.session_state['data_source']}** is ready to go with model **{st.session_state['model']}**!"
             logger.info(msg)
             st.session_state["info_container"].info(msg, icon=PAGE_ICON)
@@ -197,28 +274,130 @@ def update_chain() -> None:
         st.session_state["info_container"].error(msg, icon=PAGE_ICON)
 
 
-def update_usage(cb: OpenAICallbackHandler) -> None:
+def add_usage(usage: dict) -> None:
+    for prop, value in usage.items():
+        st.session_state["usage"].setdefault(prop, 0)
+        st.session_state["usage"][prop] += value
+
+
+def update_usage(
+    cb: OpenAICallbackHandler, stream: StreamingResponseHandler
+) -> dict:
     # Accumulate API call 
-    logger.info(f"Usage: {cb}")
     callback_properties = [
         "total_tokens",
         "prompt_tokens",
         "completion_tokens",
         "total_cost",
     ]
-    for prop in callback_properties:
-        value = getattr(cb, prop, 0)
-        st.session_state["usage"].setdefault(prop, 0)
-        st.session_state["usage"][prop] += value
+    usage = {prop: getattr(cb, prop, 0) for prop in callback_properties}
+    if not usage["total_tokens"] and stream.count_tokens is not None:
+        # streamed responses come without usage, use the tokens counted instead
+        usage = stream.usage(st.session_state["model"].name)
+    logger.info(f"Usage: {usage}")
+    add_usage(usage)
+    return usage
+
+
+def update_stream_stats(stream: StreamingResponseHandler) -> None:
+    stats = stream.stats()
+    if stats is None:
+        return
+    logger.info(f"Streaming: {stats}")
+    st.session_state["stream_stats"].append(stats)
+
+
+def get_cached_answer(prompt: str) -> tuple:
+    # (answer or None, question embedding or None)
+    # follow-up questions depend on the chat history and always go to the chain
+    key = st.session_state["answer_cache_key"]
+    if not ENABLE_ANSWER_CACHE or key is None or st.session_state["chat_history"]:
+        return None, None
+    embedding = st.session_state["query_embeddings"].embed_query(prompt)
+    cached = answer_cache.get(key, prompt, embedding)
+    if cached is None:
+        return None, embedding
+    add_usage(
+        {
+            "total_tokens": 0,
+            "total_cost": 0.0,
+            "saved_tokens": cached.usage.get("total_tokens", 0),
+            "saved_cost": cached.usage.get("total_cost", 0.0),
+        }
+    )
+    return cached.answer, embedding
 
 
-def generate_response(prompt: str) -> str:
+def generate_response(
+    prompt: str, render: Optional[Callable[[str], None]] = None
+) -> str:
     # call the chain & generate responses and append to chat history
-    with st.spinner("Generating response"), get_openai_callback() as cb:
-        response = st.session_state["chain"](
-            {"question": prompt, "chat_history": st.session_state["chat_history"]}
-        )
-        update_usage(cb)
-    logger.info(f"Response: '{response}'")
-    st.session_state["chat_history"].append((prompt, response["answer"]))
-    return response["answer"]
+    # the partial answer is passed to render while it is generated
+    with tracing() as trace:
+        answer = run_chain(prompt, render, trace)
+    st.session_state["last_trace"] = trace
+    if ENABLE_METRICS_EXPORT:
+        metrics.export()
+    return answer
+
+
+def run_chain(
+    prompt: str, render: Optional[Callable[[str], None]], trace: Trace
+) -> str:
+    # answer from the cache or the chain, the stages are timed into trace
+    history = st.session_state["chat_history"]
+    count_tokens = get_token_counter(get_options())
+    with span("answer_cache"):
+        answer, embedding = get_cached_answer(prompt)
+    if answer is None:
+        if history:
+            # tokens the condense step doesn't pay thanks to the summary
+            add_usage({"history_tokens_saved": history.tokens_saved})
+
+        def call_chain() -> Tuple[str, dict]:
+            stream = StreamingResponseHandler(render, count_tokens)
+            last_assembly.set(None)
+            with get_openai_callback() as cb:
+                response = st.session_state["chain"](
+                    {"question": prompt, "chat_history": chat_history},
+                    callbacks=[stream, StageTimingHandler(trace)],
+                )
+            usage = update_usage(cb, stream)
+            assembly = last_assembly.get()
+            if assembly is not None:
+                # retrieved tokens kept out of the prompt by the context assembler
+                add_usage({"context_tokens_saved": assembly.tokens_saved})
+            update_stream_stats(stream)
+            logger.info(f"Response: '{response}'")
+            return response["answer"], usage
+
+        chat_history = history.for_chain()
+        with st.spinner("Generating response"):
+            if ENABLE_SINGLE_FLIGHT:
+                key = get_flight_key(
+                    st.session_state["answer_cache_key"], prompt, chat_history
+                )
+                (answer, usage), shared = single_flight.do(key, call_chain)
+            else:
+                (answer, usage), shared = call_chain(), False
+        if shared:
+            single_flight.record_saved(usage)
+            add_usage(
+                {
+                    "total_tokens": 0,
+                    "total_cost": 0.0,
+                    "saved_tokens": usage.get("total_tokens", 0),
+                    "saved_cost": usage.get("total_cost", 0.0),
+                }
+            )
+        elif embedding is not None:
+            answer_cache.put(
+                st.session_state["answer_cache_key"], prompt, embedding, answer, usage
+            )
+    # folding older turns into the summary costs tokens as well
+    summary_usage = StreamingResponseHandler(count_tokens=count_tokens)
+    with get_openai_callback() as cb, span("chat_history"):
+        history.append(prompt, answer, callbacks=[summary_usage])
+    if cb.total_tokens or summary_usage.completion_tokens:
+        update_usage(cb, summary_usage)
+    return answer
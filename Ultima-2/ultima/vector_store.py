@@ -1,42 +1,294 @@
-import deeplake
-from langchain.vectorstores import DeepLake, VectorStore
+import hashlib
+import io
+import shutil
+from typing import Dict, List, Optional
 
-from ultima.shared_arrtibs import DATA_PATH
-from ultima.input_output import clean_string_for_storing
-from ultima.load_data import load_data_source, split_docs
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from ultima.shared_arrtibs import DATA_PATH, TEXT_SPLITTER
+from ultima.answer_cache import answer_cache
+from ultima.dataset_pool import dataset_pool
+from ultima.embedding_cache import CachedEmbeddings
+from ultima.input_output import clean_string_for_storing, hash_upload
+from ultima.ingestion import ProgressCallback, ingest_documents, ingest_files
+from ultima.lexical_index import LexicalIndex, get_lexical_index_path
+from ultima.load_data import (
+    Source,
+    get_source_path,
+    list_source_files,
+    load_data_source,
+)
+from ultima.local_vector_store import NumpyVectorStore
 from ultima.logging import logger
+from ultima.metrics import timed
+from ultima.manifest import Manifest, find_base_manifest, hash_file
 from ultima.models import MODES, get_embeddings
 
 
+def is_local(options: dict) -> bool:
+    # LOCAL and OFFLINE mode keep datasets on disk, API mode on the hub
+    return options["mode"] != MODES.OPENAI
+
+
 def get_dataset_path(data_source: str, options: dict, credentials: dict) -> str:
     dataset_name = clean_string_for_storing(data_source)
     dataset_name += f"-{options['chunk_size']}-{options['chunk_overlap']}"
-    if options["mode"] == MODES.LOCAL:
+    splitter = options.get("text_splitter", TEXT_SPLITTER)
+    if splitter != TEXT_SPLITTER:
+        # datasets of the default splitter keep their names
+        dataset_name += f"-{splitter}"
+    if is_local(options):
         dataset_path = str(DATA_PATH / dataset_name)
     else:
         dataset_path = f"hub://{credentials['activeloop_org_name']}/{dataset_name}"
     return dataset_path
 
-def get_vector_store(data_source: str, options: dict, credentials: dict) -> VectorStore:
-    embeddings = get_embeddings(options, credentials)
+
+def dataset_exists(dataset_path: str, options: dict, credentials: dict) -> bool:
+    if is_local(options):
+        return NumpyVectorStore.exists(dataset_path)
+    import deeplake
+
+    return deeplake.exists(dataset_path, token=credentials["activeloop_token"])
+
+
+def open_vector_store(
+    dataset_path: str,
+    embeddings: CachedEmbeddings,
+    options: dict,
+    credentials: dict,
+    read_only: bool = True,
+) -> VectorStore:
+    # opens an existing dataset or creates an empty one
+    # local datasets are kept in process and skip DeepLake entirely
+    if is_local(options):
+        if NumpyVectorStore.exists(dataset_path):
+            return NumpyVectorStore.load(dataset_path, embeddings)
+        return NumpyVectorStore(embeddings, path=dataset_path)
+    from langchain.vectorstores import DeepLake
+
+    return DeepLake(
+        dataset_path=dataset_path,
+        read_only=read_only,
+        embedding_function=embeddings,
+        token=credentials["activeloop_token"],
+    )
+
+
+def get_pool_variant(options: dict, credentials: dict) -> str:
+    # sessions share a store if they embed queries with the same model and key
+    variant = options["model"].embedding
+    if not is_local(options):
+        key = credentials.get("openai_api_key") or ""
+        variant += "-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return variant
+
+
+def open_shared_vector_store(
+    dataset_path: str,
+    embeddings: CachedEmbeddings,
+    options: dict,
+    credentials: dict,
+) -> VectorStore:
+    # the read-only store of the dataset pool, opened once for all sessions
+    return dataset_pool.get(
+        dataset_path,
+        lambda: open_vector_store(dataset_path, embeddings, options, credentials),
+        get_pool_variant(options, credentials),
+    )
+
+
+def get_embedding_function(vector_store: VectorStore) -> Embeddings:
+    if isinstance(vector_store, NumpyVectorStore):
+        return vector_store.embedding_function
+    return vector_store._embedding_function
+
+
+def open_lexical_index(
+    dataset_path: str, vector_store: VectorStore, created: bool
+) -> Optional[LexicalIndex]:
+    # The BM25 index of a dataset. Local datasets that predate it are indexed
+    # from their stored chunks, hub datasets only get one when rebuilt.
+    path = get_lexical_index_path(dataset_path)
+    lexical_index = LexicalIndex.load(path)
+    if lexical_index is not None:
+        return lexical_index
+    if created:
+        return LexicalIndex(path)
+    if isinstance(vector_store, NumpyVectorStore):
+        lexical_index = LexicalIndex(path)
+        lexical_index.add(vector_store.ids, vector_store.texts, vector_store.metadatas)
+        lexical_index.persist()
+        return lexical_index
+    logger.info(f"Dataset '{dataset_path}' has no lexical index, vector search only")
+    return None
+
+
+def open_shared_lexical_index(
+    dataset_path: str, vector_store: VectorStore
+) -> Optional[LexicalIndex]:
+    # the lexical index of the dataset pool, loaded once for all chains
+    return dataset_pool.get_lexical_index(
+        dataset_path,
+        lambda: open_lexical_index(dataset_path, vector_store, created=False),
+    )
+
+
+def copy_dataset(
+    source_path: str, dataset_path: str, options: dict, credentials: dict
+) -> None:
+    source_index = get_lexical_index_path(source_path)
+    if LexicalIndex.exists(source_index):
+        shutil.copytree(
+            source_index, get_lexical_index_path(dataset_path), dirs_exist_ok=True
+        )
+    if is_local(options):
+        shutil.copytree(source_path, dataset_path, dirs_exist_ok=True)
+    else:
+        import deeplake
+
+        deeplake.deepcopy(
+            source_path,
+            dataset_path,
+            token=credentials["activeloop_token"],
+            overwrite=True,
+            verbose=False,
+        )
+    logger.info(f"Copied dataset '{source_path}' to '{dataset_path}'")
+
+
+def persist_vector_store(vector_store: VectorStore) -> None:
+    # DeepLake commits on every write, the local store writes its files once
+    if isinstance(vector_store, NumpyVectorStore):
+        vector_store.persist()
+
+
+def get_file_vector_store(
+    files: Dict[str, Source],
+    dataset_path: str,
+    embeddings: CachedEmbeddings,
+    options: dict,
+    credentials: dict,
+    progress: Optional[ProgressCallback] = None,
+) -> VectorStore:
+    # incrementally (re)builds a dataset of local files or uploads from its manifest
+    hashes = {
+        name: hash_file(path) if isinstance(path, str) else hash_upload(path)
+        for name, path in files.items()
+    }
+    manifest = Manifest.load(dataset_path)
+    exists = dataset_exists(dataset_path, options, credentials)
+    if exists and manifest is None:
+        logger.info(f"Dataset '{dataset_path}' exists without manifest -> loading")
+        vector_store = open_shared_vector_store(
+            dataset_path, embeddings, options, credentials
+        )
+        open_shared_lexical_index(dataset_path, vector_store)
+        return vector_store
+    created = not exists
+    if not exists:
+        manifest = Manifest.for_options(dataset_path, options)
+        base = find_base_manifest(manifest, hashes)
+        if base is not None and dataset_exists(base.dataset_path, options, credentials):
+            copy_dataset(base.dataset_path, dataset_path, options, credentials)
+            manifest = base.copy_to(dataset_path)
+            created = False
+
+    changed, stale_ids = manifest.diff(hashes)
+    if not changed and not stale_ids:
+        logger.info(f"Dataset '{dataset_path}' is up to date -> loading")
+        vector_store = open_shared_vector_store(
+            dataset_path, embeddings, options, credentials
+        )
+        open_shared_lexical_index(dataset_path, vector_store)
+        return vector_store
+
+    logger.info(
+        f"Dataset '{dataset_path}' -> indexing {len(changed)} new or changed files, "
+        f"deleting {len(stale_ids)} stale chunks"
+    )
+    vector_store = open_vector_store(
+        dataset_path, embeddings, options, credentials, read_only=False
+    )
+    lexical_index = open_lexical_index(dataset_path, vector_store, created)
+    # answers given from the previous contents are outdated
+    answer_cache.invalidate(dataset_path)
+    if stale_ids:
+        vector_store.delete(ids=stale_ids)
+        if lexical_index is not None:
+            lexical_index.delete(stale_ids)
+    report = ingest_files(
+        vector_store,
+        {name: files[name] for name in changed},
+        options,
+        chunk_id=lambda name, n: f"{hashes[name][:16]}-{n}",
+        progress=progress,
+        lexical_index=lexical_index,
+    )
+    persist_vector_store(vector_store)
+    if lexical_index is not None:
+        lexical_index.persist()
+    dataset_pool.put(
+        dataset_path,
+        vector_store,
+        get_pool_variant(options, credentials),
+        lexical_index,
+    )
+    # failed files are left out so the next rebuild retries them
+    failed = {failure.path for failure in report.failures}
+    manifest.update(
+        {n: h for n, h in hashes.items() if get_source_path(files[n]) not in failed},
+        report.ids,
+    )
+    manifest.save()
+    return vector_store
+
+
+@timed("vector_store")
+def get_vector_store(
+    data_source: str,
+    options: dict,
+    credentials: dict,
+    progress: Optional[ProgressCallback] = None,
+    uploads: Optional[List[io.BytesIO]] = None,
+) -> VectorStore:
+    # uploads are indexed from memory under a data source named by their content
+    embeddings = CachedEmbeddings(
+        get_embeddings(options, credentials), options["model"].embedding
+    )
     dataset_path = get_dataset_path(data_source, options, credentials)
-    if deeplake.exists(dataset_path, token=credentials["activeloop_token"]):
+    if uploads is not None:
+        files = {upload.name: upload for upload in uploads}
+    else:
+        files = list_source_files(data_source)
+    if files is not None:
+        vector_store = get_file_vector_store(
+            files, dataset_path, embeddings, options, credentials, progress
+        )
+    elif dataset_exists(dataset_path, options, credentials):
         logger.info(f"Dataset '{dataset_path}' exists -> loading")
-        vector_store = DeepLake(
-            dataset_path=dataset_path,
-            read_only=True,
-            embedding_function=embeddings,
-            token=credentials["activeloop_token"],
+        vector_store = open_shared_vector_store(
+            dataset_path, embeddings, options, credentials
         )
+        open_shared_lexical_index(dataset_path, vector_store)
     else:
         logger.info(f"Dataset '{dataset_path}' does not exist -> uploading")
         docs = load_data_source(data_source)
-        docs = split_docs(docs, options)
-        vector_store = DeepLake.from_documents(
-            docs,
-            embeddings,
-            dataset_path=dataset_path,
-            token=credentials["activeloop_token"],
+        vector_store = open_vector_store(
+            dataset_path, embeddings, options, credentials, read_only=False
+        )
+        lexical_index = open_lexical_index(dataset_path, vector_store, created=True)
+        ingest_documents(vector_store, docs, options, progress, lexical_index)
+        persist_vector_store(vector_store)
+        lexical_index.persist()
+        dataset_pool.put(
+            dataset_path,
+            vector_store,
+            get_pool_variant(options, credentials),
+            lexical_index,
         )
     logger.info(f"Vector Store {dataset_path} loaded!")
+    logger.info(f"Embedding cache: {embeddings.cache.stats()}")
+    logger.info(f"Dataset pool: {dataset_pool.stats()}")
     return vector_store